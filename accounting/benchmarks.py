@@ -0,0 +1,189 @@
+"""
+Report benchmarks.
+
+run_benchmarks() seeds (or reuses) one company per dataset size with
+seeding.seed_company, then requests every report in REPORTS through the test
+client, so middleware, views, templates and CSV streaming are all measured.
+Each report gets `warmup` untimed requests and `repetitions` timed ones; the
+report cache is cleared before every request so each one computes the
+report.
+
+Per report and dataset size the results hold p50/p95 latency and the query
+count, plus, from extra untimed requests, peak Python memory (tracemalloc)
+and the rows the database scanned. Rows scanned come from EXPLAIN ANALYZE on
+PostgreSQL; SQLite has no such counter, so there the virtual machine steps
+(in thousands, from the progress handler) are recorded instead, and other
+backends record None.
+"""
+import datetime
+import json
+import random
+import statistics
+import time
+import tracemalloc
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from . import report_cache, seeding, statements
+from .models import Budget, Company
+
+def _url(name):
+    return lambda company: reverse(name)
+
+def _range(first, last):
+    return {'start_date': first.isoformat(), 'end_date': last.isoformat()}
+
+# name -> (method, url(company), params(first posted date, last posted date))
+REPORTS = {
+    'balance_sheet': ('get', _url('balance_sheet'), lambda first, last: {'target_date': last.isoformat()}),
+    'income_statement': ('get', _url('income_statement'), _range),
+    'custom_report': ('post', _url('custom_report'), _range),
+    'budget_variance': ('get', lambda company: reverse('budget_variance', args=[Budget.objects.filter(company=company).latest('id').id]),
+                        lambda first, last: {}),
+    'dashboard': ('get', _url('dashboard'), lambda first, last: {}),
+    'trial_balance_csv': ('get', _url('download_trial_balance'), lambda first, last: {'end_date': last.isoformat()}),
+    'vouchers_csv': ('get', _url('download_all_vouchers'), lambda first, last: {}),
+}
+SQLITE_STEP = 1000
+# Columns of compare() and their labels. vm_steps_k is SQLite's stand-in for
+# rows_scanned: a measure of work done, not a row count.
+COMPARED = {
+    'p50_ms': 'p50 ms', 'p95_ms': 'p95 ms', 'queries': 'queries', 'peak_kb': 'peak KB',
+    'rows_scanned': 'rows scanned', 'vm_steps_k': 'SQLite VM steps (k)',
+}
+
+
+def dataset_profile(vouchers):
+    """The 'small' seeding profile scaled so the journal has `vouchers` vouchers."""
+    base = seeding.PROFILES['small']
+    scale = vouchers / base['vouchers']
+    return {key: value if key == 'days' else max(1, round(value * scale)) for key, value in base.items()}
+
+def dataset(vouchers, seed, end_date, log):
+    """The benchmark company with `vouchers` vouchers, seeded on first use."""
+    index = f"bench-{vouchers}-{seed}"
+    user = User.objects.filter(username=f"seed-{index}").first()
+    if user:
+        return Company.objects.get(owner=user)
+    log(f"Seeding dataset of {vouchers} vouchers...")
+    return seeding.seed_company(random.Random(f"bench-{seed}-{vouchers}"), index, dataset_profile(vouchers), end_date, password=None, log=log)
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, round(pct / 100 * (len(ordered) - 1)))]
+
+def rows_scanned(queries):
+    """Rows read by the plan nodes of the captured SELECTs (PostgreSQL only)."""
+    total = 0
+    with connection.cursor() as cursor:
+        for q in queries:
+            if not q['sql'].lstrip().upper().startswith('SELECT'):
+                continue
+            cursor.execute('EXPLAIN (ANALYZE, FORMAT JSON) ' + q['sql'])
+            stack = [cursor.fetchone()[0][0]['Plan']]
+            while stack:
+                node = stack.pop()
+                if 'Scan' in node['Node Type']:
+                    total += node.get('Actual Rows', 0) * node.get('Actual Loops', 1) + node.get('Rows Removed by Filter', 0)
+                stack.extend(node.get('Plans', []))
+    return total
+
+class SqliteSteps:
+    """Counts SQLite virtual machine steps, in units of SQLITE_STEP, while active."""
+
+    def __enter__(self):
+        self.count = 0
+        connection.ensure_connection()
+
+        def tick():
+            self.count += 1
+            return 0
+        connection.connection.set_progress_handler(tick, SQLITE_STEP)
+        return self
+
+    def __exit__(self, *exc):
+        connection.connection.set_progress_handler(None, SQLITE_STEP)
+
+def measure(client, method, url, params):
+    """(seconds, captured queries) of one request, response body included."""
+    report_cache.get_cache().clear()
+    with CaptureQueriesContext(connection) as ctx:
+        started = time.perf_counter()
+        resp = getattr(client, method)(url, params)
+        if resp.streaming:
+            for _ in resp.streaming_content:
+                pass
+        elapsed = time.perf_counter() - started
+    if resp.status_code >= 400:
+        raise RuntimeError(f"{url} answered {resp.status_code}")
+    return elapsed, ctx.captured_queries
+
+def benchmark_report(client, company, name, warmup, repetitions):
+    method, url, params = REPORTS[name]
+    first, last = statements.posted_date_range(company)
+    url, data = url(company), params(first, last)
+    for _ in range(warmup):
+        measure(client, method, url, data)
+    timings, queries = [], []
+    for _ in range(repetitions):
+        seconds, captured = measure(client, method, url, data)
+        timings.append(seconds * 1000)
+        queries.append(len(captured))
+    row = {'p50_ms': round(statistics.median(timings), 2), 'p95_ms': round(percentile(timings, 95), 2), 'queries': max(queries)}
+
+    # Memory and scan counts slow the request down, so they get untimed runs of their own
+    tracemalloc.start()
+    measure(client, method, url, data)
+    row['peak_kb'] = round(tracemalloc.get_traced_memory()[1] / 1024)
+    tracemalloc.stop()
+    if connection.vendor == 'postgresql':
+        row['rows_scanned'] = rows_scanned(captured)
+    elif connection.vendor == 'sqlite':
+        with SqliteSteps() as steps:
+            measure(client, method, url, data)
+        row['vm_steps_k'] = steps.count
+    else:
+        row['rows_scanned'] = None
+    return row
+
+def run_benchmarks(sizes, reports, warmup=1, repetitions=5, seed=1, end_date=None, log=lambda message: None):
+    """{'created', 'database', 'results': {'<report>@<vouchers>': {...}}}"""
+    end_date = end_date or datetime.date.today()
+    results = {}
+    for vouchers in sizes:
+        company = dataset(vouchers, seed, end_date, log)
+        client = Client()
+        client.force_login(company.owner)
+        for name in reports:
+            results[f"{name}@{vouchers}"] = row = benchmark_report(client, company, name, warmup, repetitions)
+            scan = next((f", {COMPARED[m]} {row[m]}" for m in ('rows_scanned', 'vm_steps_k') if row.get(m) is not None), '')
+            log(f"{name} @ {vouchers} vouchers: p50 {row['p50_ms']} ms, p95 {row['p95_ms']} ms, {row['queries']} queries, "
+                f"peak {row['peak_kb']} KB{scan}")
+    return {'created': datetime.datetime.now().isoformat(timespec='seconds'), 'database': connection.vendor, 'results': results}
+
+def compare(baseline, current):
+    """
+    Rows of (key, p50 change %, {metric: (baseline, current)}) for every key
+    in either run, with every metric in COMPARED; missing values are None.
+    """
+    rows = []
+    by_report_and_size = lambda key: (key.rsplit('@', 1)[0], int(key.rsplit('@', 1)[1]))
+    for key in sorted(set(baseline['results']) | set(current['results']), key=by_report_and_size):
+        old, new = baseline['results'].get(key, {}), current['results'].get(key, {})
+        change = None
+        if old.get('p50_ms') and 'p50_ms' in new:
+            change = round((new['p50_ms'] - old['p50_ms']) / old['p50_ms'] * 100, 1)
+        rows.append((key, change, {metric: (old.get(metric), new.get(metric)) for metric in COMPARED}))
+    return rows
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+def save(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
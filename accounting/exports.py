@@ -0,0 +1,175 @@
+"""
+Row generators for the CSV exports.
+
+Each export is a generator of plain rows read with a single joined query
+through .iterator(), so memory stays flat however large the ledger is. The
+same generators feed the streaming download views and the background
+export jobs.
+"""
+import csv
+import datetime
+import os
+import tempfile
+import zlib
+
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import statements
+from .models import Account, ExportJob, JournalVoucherLine
+
+ITERATOR_CHUNK_SIZE = 2000
+GZIP_FLUSH_BYTES = 64 * 1024
+PROGRESS_EVERY = 5000
+
+VOUCHER_HEADER = ['JV Number', 'Date', 'Description', 'Status', 'Account', 'Debit', 'Credit', 'Line Desc']
+
+
+class Echo:
+    """File-like object for csv.writer that hands each formatted row straight back."""
+    def write(self, value):
+        return value
+
+def csv_lines(rows):
+    """Format an iterable of rows as CSV text, one string per row."""
+    writer = csv.writer(Echo())
+    for row in rows:
+        yield writer.writerow(row)
+
+def gzip_stream(chunks):
+    """Gzip an iterable of str/bytes chunks, yielding compressed blocks of roughly GZIP_FLUSH_BYTES."""
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    pending = []
+    size = 0
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+        if data:
+            pending.append(data)
+            size += len(data)
+        if size >= GZIP_FLUSH_BYTES:
+            yield b''.join(pending)
+            pending, size = [], 0
+    pending.append(compressor.flush())
+    yield b''.join(pending)
+
+
+def voucher_lines(company, start=None, end=None, status=None):
+    lines = JournalVoucherLine.objects.filter(company=company)
+    if start:
+        lines = lines.filter(posting_date__gte=start)
+    if end:
+        lines = lines.filter(posting_date__lte=end)
+    if status:
+        lines = lines.filter(status=status)
+    return lines
+
+def voucher_rows(company, start=None, end=None, status=None):
+    """
+    Header plus one row per journal line of the company's vouchers, optionally
+    limited to a posting date range and a status. Voucher and account fields
+    are joined into the same query.
+    """
+    yield VOUCHER_HEADER
+    yield from (voucher_lines(company, start, end, status).order_by('posting_date', 'journal_voucher_id', 'id')
+                .values_list('journal_voucher__jv_number', 'posting_date', 'journal_voucher__description', 'status',
+                             'account__account_number', 'debit_amount', 'credit_amount', 'line_description')
+                .iterator(chunk_size=ITERATOR_CHUNK_SIZE))
+
+def single_voucher_rows(voucher):
+    """Voucher header block followed by its lines with account number and name."""
+    yield ['JV Number', 'Date', 'Description', 'Status']
+    yield [voucher.jv_number, voucher.jv_date, voucher.description, voucher.status]
+    yield []
+    yield ['Account', 'Name', 'Debit', 'Credit', 'Line Desc']
+    yield from (JournalVoucherLine.objects.filter(journal_voucher=voucher).order_by('id')
+                .values_list('account__account_number', 'account__account_name', 'debit_amount', 'credit_amount', 'line_description')
+                .iterator(chunk_size=ITERATOR_CHUNK_SIZE))
+
+def trial_balance_rows(tb):
+    """Rows of a statements.trial_balance() result, with a totals line."""
+    yield ['Account Number', 'Account Name', 'Debit', 'Credit']
+    for line in tb['report_lines']:
+        yield [line['number'], line['name'], f"{line['debit']:.2f}", f"{line['credit']:.2f}"]
+    yield ['', 'Total', f"{tb['total_debits']:.2f}", f"{tb['total_credits']:.2f}"]
+
+def report_accounts(company, account_ids=None, account_types=None):
+    """The custom report's account selection: explicit ids win over types."""
+    accounts = Account.objects.filter(company=company).order_by('account_number')
+    if account_ids:
+        return accounts.filter(id__in=account_ids)
+    if account_types:
+        return accounts.filter(account_type__in=account_types)
+    return accounts
+
+def account_activity_rows(company, accounts, start, end):
+    """The custom report (statements.account_activity) flattened to one row per line."""
+    yield ['Account Number', 'Account Name', 'Date', 'Reference', 'Description', 'Debit', 'Credit', 'Balance']
+    for block in statements.account_activity(company, accounts, start, end):
+        acc = block['account']
+        yield [acc.account_number, acc.account_name, start, '', 'Opening Balance', '', '', f"{block['starting_balance']:.2f}"]
+        for line in block['lines']:
+            yield [acc.account_number, acc.account_name, line['date'], line['ref'], line['desc'],
+                   line['debit'], line['credit'], f"{line['balance']:.2f}"]
+
+
+# --- BACKGROUND JOBS ---
+def job_rows(job):
+    """(row iterator, expected data row count) for an ExportJob's kind and params."""
+    p, company = job.params, job.company
+    if job.kind == 'vouchers':
+        lines = voucher_lines(company, p.get('start_date'), p.get('end_date'), p.get('status'))
+        return voucher_rows(company, p.get('start_date'), p.get('end_date'), p.get('status')), lines.count()
+    if job.kind == 'account_activity':
+        accounts = report_accounts(company, p.get('accounts'), p.get('account_types'))
+        lines = JournalVoucherLine.objects.filter(company=company, account__in=accounts, status='Posted',
+                                                  posting_date__range=[p['start_date'], p['end_date']])
+        return account_activity_rows(company, accounts, p['start_date'], p['end_date']), lines.count()
+    if job.kind == 'trial_balance':
+        tb = statements.trial_balance(company, p.get('end_date'))
+        return trial_balance_rows(tb), len(tb['report_lines'])
+    raise ValueError(f"Unknown export kind: {job.kind}")
+
+def claim_next_job(stale_after=datetime.timedelta(hours=1)):
+    """
+    Atomically take the oldest pending job (or one whose worker died while
+    running it). SKIP LOCKED lets several workers poll the same table.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        job = (ExportJob.objects.select_for_update(skip_locked=True)
+               .filter(Q(status='Pending') | Q(status='Running', started_at__lt=now - stale_after))
+               .order_by('created_at', 'id').first())
+        if job is None:
+            return None
+        job.status, job.started_at, job.rows_written, job.error = 'Running', now, 0, ''
+        job.save(update_fields=['status', 'started_at', 'rows_written', 'error'])
+    return job
+
+def run_job(job):
+    """Write the job's CSV to a temp file, then store it under exports/ and mark the job Done."""
+    try:
+        rows, job.total_rows = job_rows(job)
+        ExportJob.objects.filter(pk=job.pk).update(total_rows=job.total_rows)
+        written = -1  # the header row is not counted
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        try:
+            with os.fdopen(fd, 'w', newline='') as tmp:
+                writer = csv.writer(tmp)
+                for row in rows:
+                    writer.writerow(row)
+                    written += 1
+                    if written and written % PROGRESS_EVERY == 0:
+                        ExportJob.objects.filter(pk=job.pk).update(rows_written=written)
+            with open(path, 'rb') as fh:
+                name = default_storage.save(f"exports/{job.company_id}/{job.kind}-{job.pk}.csv", File(fh))
+        finally:
+            os.unlink(path)
+        job.file.name, job.rows_written, job.status = name, max(written, 0), 'Done'
+    except Exception as e:
+        job.status, job.error = 'Failed', str(e)
+    job.finished_at = timezone.now()
+    job.save(update_fields=['file', 'rows_written', 'total_rows', 'status', 'error', 'finished_at'])
+    return job
@@ -0,0 +1,562 @@
+"""
+Journal voucher and bank statement imports.
+
+The upload is read as a stream, one row at a time, and account numbers are
+resolved from a map loaded with a single query. Rows are grouped into
+vouchers by a voucher key column; each voucher is checked for balance and
+the vouchers (bulk_create) and their lines (one executemany) are written in
+batches. The whole file is imported in one transaction: if any row has an
+error nothing is saved and the caller gets the list of problems instead.
+
+Two layouts are accepted (the first row is always a header):
+
+* Multi-voucher: named columns ``Voucher, Date, Description, Account,
+  Debit, Credit, Line Description`` (any order; aliases below). Rows of one
+  voucher must be contiguous.
+* Legacy: ``AccountNumber, Debit, Credit, Description`` in that order,
+  imported as a single voucher dated today.
+
+Bank statements may be CSV, OFX/QFX, QIF or ISO 20022 camt.053 XML. Each
+format has a parser that yields StatementRows; they all go through the same
+de-duplicating, chunked insert (import_statement_lines).
+"""
+import codecs
+import collections
+import csv
+import datetime
+import decimal
+import hashlib
+import html
+import io
+import itertools
+import re
+from xml.etree import ElementTree
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from . import reconciliation, report_cache
+from .models import Account, BankAccount, BankStatementLine, JournalVoucher, JournalVoucherLine
+
+BATCH_SIZE = 5000
+MAX_REPORTED_ERRORS = 500
+DATE_FORMATS = ['%Y-%m-%d', '%m/%d/%Y', '%d-%m-%Y', '%Y/%m/%d']
+
+COLUMN_ALIASES = {
+    'voucher': ['voucher', 'voucher key', 'voucher number', 'jv', 'jv number', 'reference', 'ref'],
+    'date': ['date', 'jv date', 'voucher date'],
+    'description': ['description', 'memo', 'voucher description'],
+    'account': ['account', 'account number', 'accountnumber'],
+    'debit': ['debit', 'dr'],
+    'credit': ['credit', 'cr'],
+    'line_description': ['line description', 'line desc', 'line memo'],
+}
+LEGACY_COLUMNS = {'account': 0, 'debit': 1, 'credit': 2, 'line_description': 3}
+LINE_FIELDS = ['company', 'journal_voucher', 'account', 'debit_amount', 'credit_amount', 'line_description', 'posting_date', 'status']
+
+
+class RowError(Exception):
+    """A problem with one row (or the voucher that ends on it)."""
+
+
+def map_columns(header):
+    """Column indexes by field name for the multi-voucher layout, or None for the legacy layout."""
+    names = [h.strip().lower().replace('_', ' ') for h in header]
+    columns = {}
+    for field, aliases in COLUMN_ALIASES.items():
+        for i, name in enumerate(names):
+            if name in aliases:
+                columns[field] = i
+                break
+    if 'voucher' not in columns and 'date' not in columns:
+        return None
+    missing = {'account', 'debit', 'credit'} - set(columns)
+    if missing:
+        raise RowError(f"Missing column(s): {', '.join(sorted(missing))}")
+    return columns
+
+def parse_date(value):
+    value = value.strip()
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, fmt).date()
+        except ValueError:
+            continue
+    raise RowError(f"Unrecognised date '{value}'")
+
+def parse_amount(value):
+    try:
+        amount = decimal.Decimal(value.strip().replace(',', '') or 0)
+    except decimal.InvalidOperation:
+        raise RowError(f"Invalid amount '{value}'")
+    if amount < 0:
+        raise RowError(f"Negative amount '{value}'")
+    return amount
+
+
+class VoucherImport:
+    """One import run; use import_vouchers() rather than this class directly."""
+
+    def __init__(self, company, filename):
+        self.company = company
+        self.filename = filename
+        self.accounts = dict(Account.objects.filter(company=company).values_list('account_number', 'id'))
+        self.errors = []
+        self.error_count = 0
+        self.voucher_count = 0
+        self.line_count = 0
+        self.seen_keys = set()
+        self.legacy = self.keyed = False
+        self.stamp = ''
+        self.pending = []  # [(JournalVoucher, [JournalVoucherLine])] waiting for the next flush
+        self.pending_lines = 0
+
+    def error(self, row_number, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((row_number, message))
+
+    def cell(self, row, columns, field):
+        i = columns.get(field)
+        return row[i].strip() if i is not None and i < len(row) else ''
+
+    def run(self, rows, columns):
+        self.legacy = columns is None
+        columns = columns or LEGACY_COLUMNS
+        self.keyed = 'voucher' in columns
+        self.stamp = timezone.now().strftime('%Y%m%d-%H%M%S')
+        group = None  # [key, date, description, first_row, lines, debit, credit, errors before the voucher]
+        for row_number, row in rows:
+            if not any(c.strip() for c in row):
+                continue
+            try:
+                key = 'upload' if self.legacy else (self.cell(row, columns, 'voucher') or self.cell(row, columns, 'date'))
+                if group is None or key != group[0]:
+                    if group is not None:
+                        self.finish(group)
+                    group = [key, None, '', row_number, [], decimal.Decimal(0), decimal.Decimal(0), self.error_count]
+                    if key in self.seen_keys:
+                        raise RowError(f"Voucher '{key}' continues after other vouchers; keep its rows together")
+                    self.seen_keys.add(key)
+                    group[1] = timezone.now().date() if self.legacy else parse_date(self.cell(row, columns, 'date'))
+                    group[2] = f"Upload: {self.filename}" if self.legacy else (self.cell(row, columns, 'description') or f"Import: {key}")
+                number = self.cell(row, columns, 'account')
+                if number not in self.accounts:
+                    raise RowError(f"Unknown account number: {number}")
+                d, c = parse_amount(self.cell(row, columns, 'debit')), parse_amount(self.cell(row, columns, 'credit'))
+                group[4].append((self.accounts[number], d, c, self.cell(row, columns, 'line_description')[:255]))
+                group[5] += d
+                group[6] += c
+            except RowError as e:
+                self.error(row_number, str(e))
+        if group is not None:
+            self.finish(group)
+        self.flush()
+
+    def finish(self, group):
+        key, jv_date, description, first_row, lines, debit, credit, errors_before = group
+        if self.error_count > errors_before:
+            return  # its rows were already reported; the totals would only add noise
+        if debit != credit:
+            self.error(first_row, f"Voucher '{key}' does not balance (debits {debit}, credits {credit})")
+            return
+        if self.error_count:
+            return  # the import will be rolled back; stop building objects
+        # Files without a voucher column get generated numbers, as single uploads always did
+        if self.keyed:
+            number = key[:50]
+        elif self.legacy:
+            number = f"JV-CSV-{self.stamp}"
+        else:
+            number = f"JV-CSV-{self.stamp}-{len(self.seen_keys)}"
+        voucher = JournalVoucher(company=self.company, jv_number=number, jv_date=jv_date, description=description, status='Draft')
+        voucher.first_row = first_row
+        self.pending.append((voucher, lines))
+        self.pending_lines += len(lines)
+        if self.pending_lines >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Insert the pending vouchers with bulk_create, then all of their lines with one executemany."""
+        if not self.pending or self.error_count:
+            self.pending, self.pending_lines = [], 0
+            return
+        vouchers = [v for v, _ in self.pending]
+        # Numbers are unique across companies; the message must not tell whether another tenant holds one
+        taken = set(JournalVoucher.objects.filter(jv_number__in=[v.jv_number for v in vouchers]).values_list('jv_number', flat=True))
+        for v in vouchers:
+            if v.jv_number in taken:
+                self.error(v.first_row, f"Voucher number '{v.jv_number}' cannot be used; choose another")
+        if not self.error_count:
+            JournalVoucher.objects.bulk_create(vouchers)
+            ops = connection.ops
+            rows = [
+                (self.company.pk, voucher.pk, account_id, ops.adapt_decimalfield_value(d, 19, 2), ops.adapt_decimalfield_value(c, 19, 2),
+                 memo, ops.adapt_datefield_value(voucher.jv_date), voucher.status)
+                for voucher, lines in self.pending for account_id, d, c, memo in lines
+            ]
+            insert_lines(rows)
+            self.voucher_count += len(vouchers)
+            self.line_count += len(rows)
+        self.pending, self.pending_lines = [], 0
+
+
+def insert_lines(rows):
+    """
+    INSERT journal lines, given as DB-ready tuples in LINE_FIELDS order, with
+    one executemany. At import volumes model instantiation and per-field
+    preparation in bulk_create cost more than the database work itself.
+    No signals are sent, so the cached reports of the companies written to
+    are invalidated here.
+    """
+    meta, qn = JournalVoucherLine._meta, connection.ops.quote_name
+    columns = [meta.get_field(name).column for name in LINE_FIELDS]
+    sql = f"INSERT INTO {qn(meta.db_table)} ({', '.join(qn(c) for c in columns)}) VALUES ({', '.join(['%s'] * len(columns))})"
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, rows)
+    for company_id in {row[0] for row in rows}:
+        report_cache.invalidate(company_id)
+
+
+def import_vouchers(company, upload):
+    """
+    Import an uploaded CSV of journal vouchers as Drafts.
+    Returns {'vouchers': n, 'lines': n, 'errors': [(row number, message)], 'error_count': n};
+    when there are errors nothing has been saved.
+    """
+    stream = io.TextIOWrapper(upload.file, encoding='utf-8-sig', newline='')
+    reader = csv.reader(stream)
+    importer = VoucherImport(company, upload.name)
+    try:
+        try:
+            columns = map_columns(next(reader, []))
+        except RowError as e:
+            importer.error(1, str(e))
+        else:
+            with transaction.atomic():
+                importer.run(enumerate(reader, start=2), columns)
+                if importer.error_count:
+                    transaction.set_rollback(True)
+    except (UnicodeDecodeError, csv.Error) as e:
+        importer.error(reader.line_num, f"Unreadable file: {e}")
+    finally:
+        stream.detach()
+    if importer.error_count:
+        importer.voucher_count = importer.line_count = 0
+    return {'vouchers': importer.voucher_count, 'lines': importer.line_count,
+            'errors': importer.errors, 'error_count': importer.error_count}
+
+
+# --- BANK STATEMENTS ---
+STATEMENT_DATE_FORMATS = ['%m/%d/%Y', '%Y-%m-%d', '%d/%m/%Y', '%m-%d-%Y']
+STATEMENT_CHUNK_SIZE = 2000
+DATE_SAMPLE_ROWS = 200
+
+StatementRow = collections.namedtuple('StatementRow', 'row_number date description amount error')
+
+
+def statement_line_hash(date, amount, description, occurrence):
+    """
+    Identity of a statement line for de-duplication. occurrence numbers
+    identical lines within one file (two equal card payments on the same day)
+    so they are kept apart, while re-importing the same file maps every line
+    onto the hash it had the first time.
+    """
+    key = f"{date.isoformat()}|{amount:.2f}|{' '.join(description.split()).lower()}|{occurrence}"
+    return hashlib.sha256(key.encode()).hexdigest()
+
+def clean_statement_amount(value):
+    """'$1,234.50' -> 1234.50 and '(12.00)' -> -12.00; None for an empty cell."""
+    value = value.replace('$', '').replace(',', '').replace(' ', '')
+    if value.startswith('(') and value.endswith(')'):
+        value = '-' + value[1:-1]
+    if not value:
+        return None
+    try:
+        return decimal.Decimal(value)
+    except decimal.InvalidOperation:
+        raise RowError(f"Invalid amount '{value}'")
+
+def detect_date_format(values, formats=STATEMENT_DATE_FORMATS):
+    """The format that parses the most sampled date strings (earliest listed wins a tie), or None."""
+    def parses(value, fmt):
+        try:
+            datetime.datetime.strptime(value, fmt)
+            return True
+        except ValueError:
+            return False
+    values = [v for v in values if v]
+    scores = [(sum(parses(v, fmt) for v in values), -i, fmt) for i, fmt in enumerate(formats)]
+    best = max(scores, default=(0, 0, None))
+    return best[2] if best[0] else None
+
+def parse_csv_statement(fileobj):
+    """
+    StatementRows from a 'Date, Description, Amount' CSV with a header row.
+    The date format is detected once from the first rows instead of trying
+    every format on every line.
+    """
+    stream = io.TextIOWrapper(fileobj, encoding='utf-8-sig', newline='')
+    try:
+        reader = csv.reader(stream)
+        next(reader, None)  # header
+        rows = ((n, r) for n, r in enumerate(reader, start=2) if len(r) >= 3 and any(c.strip() for c in r))
+        sample = list(itertools.islice(rows, DATE_SAMPLE_ROWS))
+        fmt = detect_date_format([r[0].strip() for _, r in sample])
+        for row_number, row in itertools.chain(sample, rows):
+            try:
+                amount = clean_statement_amount(row[2].strip())
+                if amount is None:
+                    continue
+                try:
+                    date = datetime.datetime.strptime(row[0].strip(), fmt).date() if fmt else None
+                except ValueError:
+                    date = None
+                if date is None:
+                    raise RowError(f"Unrecognised date '{row[0].strip()}'")
+                yield StatementRow(row_number, date, row[1].strip()[:255], amount, None)
+            except RowError as e:
+                yield StatementRow(row_number, None, '', None, str(e))
+    finally:
+        stream.detach()  # leave the caller's file open
+
+def import_statement_lines(bank_account, rows):
+    """
+    Insert StatementRows for a bank account in chunks. Lines whose content
+    hash is already stored for the account are skipped, so overlapping
+    statements can be uploaded again safely. The inserted total is added to
+    the account's statement_balance.
+
+    The bank account row is locked first, so concurrent uploads for the same
+    account run one after the other, and the counts and total come from the
+    hashes found in the table after each chunk's insert, never from the rows
+    that were merely sent.
+    Returns {'inserted': n, 'skipped': n, 'amount': inserted total, 'errors': [(row number, message)], 'error_count': n}.
+    """
+    result = {'inserted': 0, 'skipped': 0, 'amount': reconciliation.ZERO, 'errors': [], 'error_count': 0}
+    occurrences = collections.Counter()
+
+    def flush(chunk):
+        existing = set(BankStatementLine.objects.filter(bank_account=bank_account, content_hash__in=[l.content_hash for l in chunk])
+                       .values_list('content_hash', flat=True))
+        new = [l for l in chunk if l.content_hash not in existing]
+        BankStatementLine.objects.bulk_create(new, batch_size=500, ignore_conflicts=True)
+        landed = set(BankStatementLine.objects.filter(bank_account=bank_account, content_hash__in=[l.content_hash for l in new])
+                     .values_list('content_hash', flat=True))
+        written = [l for l in new if l.content_hash in landed]
+        result['inserted'] += len(written)
+        result['amount'] += sum(l.amount for l in written)
+        result['skipped'] += len(chunk) - len(written)
+
+    chunk = []
+    with transaction.atomic():
+        BankAccount.objects.select_for_update().filter(pk=bank_account.pk).exists()
+        for row in rows:
+            if row.error:
+                result['error_count'] += 1
+                if len(result['errors']) < MAX_REPORTED_ERRORS:
+                    result['errors'].append((row.row_number, row.error))
+                continue
+            key = (row.date, row.amount, ' '.join(row.description.split()).lower())
+            occurrences[key] += 1
+            chunk.append(BankStatementLine(
+                company_id=bank_account.company_id, bank_account=bank_account, date=row.date, description=row.description,
+                amount=row.amount, content_hash=statement_line_hash(row.date, row.amount, row.description, occurrences[key]),
+            ))
+            if len(chunk) >= STATEMENT_CHUNK_SIZE:
+                flush(chunk)
+                chunk = []
+        if chunk:
+            flush(chunk)
+        reconciliation.adjust_totals(bank_account, statement=result['amount'])
+    return result
+
+
+# --- STATEMENT FORMATS ---
+READ_SIZE = 64 * 1024
+OFX_TAG = re.compile(r'<(/?)([A-Za-z0-9.]+)>([^<]*)')
+QIF_DATE_FORMATS = ['%m/%d/%Y', '%m/%d/%y', '%d/%m/%Y', '%d/%m/%y', '%Y-%m-%d']
+
+
+def read_blocks(fileobj):
+    return iter(lambda: fileobj.read(READ_SIZE), b'')
+
+def ofx_elements(fileobj):
+    """
+    (closing, TAG, text) for every tag of an OFX file, read in blocks. The
+    same scan handles 1.x SGML, where leaf elements have no closing tag, and
+    2.x XML.
+    """
+    head = fileobj.read(1024)  # the OFX 1.x header names the character set
+    blocks = read_blocks(fileobj)
+    encoding = 'cp1252' if b'CHARSET:1252' in head.upper() else 'utf-8'
+    decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+    buffer = ''
+    for block in itertools.chain([head], blocks, [None]):
+        if block is not None:
+            buffer += decoder.decode(block)
+            cut = buffer.rfind('<')  # the last tag may continue in the next block
+            if cut <= 0:
+                continue
+        else:
+            buffer += decoder.decode(b'', final=True)
+            cut = len(buffer)
+        for m in OFX_TAG.finditer(buffer, 0, cut):
+            yield m.group(1) == '/', m.group(2).upper(), html.unescape(m.group(3).strip())
+        buffer = buffer[cut:]
+
+def ofx_row(number, txn):
+    try:
+        try:
+            date = datetime.datetime.strptime(txn.get('DTPOSTED', '')[:8], '%Y%m%d').date()
+        except ValueError:
+            raise RowError(f"Unrecognised date '{txn.get('DTPOSTED', '')}'")
+        value = txn.get('TRNAMT', '')
+        if ',' in value and '.' not in value:  # OFX allows a decimal comma
+            value = value.replace(',', '.')
+        amount = clean_statement_amount(value)
+        if amount is None:
+            raise RowError("Missing TRNAMT")
+        name, memo = txn.get('NAME') or txn.get('PAYEE', ''), txn.get('MEMO', '')
+        description = f"{name} - {memo}" if name and memo and memo != name else (name or memo)
+        return StatementRow(number, date, description[:255], amount, None)
+    except RowError as e:
+        return StatementRow(number, None, '', None, str(e))
+
+def parse_ofx_statement(fileobj):
+    """StatementRows from the <STMTTRN> records of an OFX/QFX download; row numbers count transactions."""
+    txn, number = None, 0
+    for closing, tag, text in ofx_elements(fileobj):
+        if tag == 'STMTTRN':
+            if txn is not None:
+                yield ofx_row(number, txn)
+            txn = None if closing else {}
+            number += not closing
+        elif txn is not None and not closing:
+            txn[tag] = text
+    if txn is not None:
+        yield ofx_row(number, txn)
+
+def qif_records(lines):
+    """(record number, {code: value}) for each '^'-terminated record; the first value of a code wins (split lines follow)."""
+    record, number = {}, 0
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('!'):
+            continue
+        if line.startswith('^'):
+            if record:
+                number += 1
+                yield number, record
+            record = {}
+        else:
+            record.setdefault(line[0], line[1:].strip())
+    if record:
+        yield number + 1, record
+
+def parse_qif_statement(fileobj):
+    """
+    StatementRows from a QIF bank export (D date, T amount, P payee, M memo,
+    ^ end of record). Quicken writes years after 1999 as 1/5'24, which is
+    read as 1/5/24; the date format is detected once as for CSV.
+    """
+    records = qif_records(io.TextIOWrapper(fileobj, encoding='utf-8-sig', errors='replace'))
+    qif_date = lambda r: r.get('D', '').replace("'", '/').replace(' ', '')
+    sample = list(itertools.islice(records, DATE_SAMPLE_ROWS))
+    fmt = detect_date_format([qif_date(r) for _, r in sample], QIF_DATE_FORMATS)
+    for number, record in itertools.chain(sample, records):
+        try:
+            amount = clean_statement_amount(record.get('T') or record.get('U', ''))
+            if amount is None:
+                raise RowError("Missing amount")
+            try:
+                date = datetime.datetime.strptime(qif_date(record), fmt).date() if fmt else None
+            except ValueError:
+                date = None
+            if date is None:
+                raise RowError(f"Unrecognised date '{record.get('D', '')}'")
+            payee, memo = record.get('P', ''), record.get('M', '')
+            description = f"{payee} - {memo}" if payee and memo else (payee or memo)
+            yield StatementRow(number, date, description[:255], amount, None)
+        except RowError as e:
+            yield StatementRow(number, None, '', None, str(e))
+
+def camt_row(number, entry, ns):
+    text = lambda path: (entry.findtext(path.format(ns=ns)) or '').strip()
+    try:
+        try:
+            amount = decimal.Decimal(text('{ns}Amt'))
+        except decimal.InvalidOperation:
+            raise RowError(f"Invalid amount '{text('{ns}Amt')}'")
+        debit = text('{ns}CdtDbtInd') == 'DBIT'
+        booked = (text('{ns}BookgDt/{ns}Dt') or text('{ns}BookgDt/{ns}DtTm')
+                  or text('{ns}ValDt/{ns}Dt') or text('{ns}ValDt/{ns}DtTm'))
+        try:
+            date = datetime.date.fromisoformat(booked[:10])
+        except ValueError:
+            raise RowError(f"Unrecognised date '{booked}'")
+        party = text(f".//{{ns}}RltdPties/{{ns}}{'Cdtr' if debit else 'Dbtr'}/{{ns}}Nm")
+        remittance = ' '.join(e.text.strip() for e in entry.iterfind('.//{ns}RmtInf/{ns}Ustrd'.format(ns=ns)) if e.text)
+        description = ' - '.join(filter(None, [party, remittance])) or text('{ns}AddtlNtryInf')
+        return StatementRow(number, date, description[:255], -amount if debit else amount, None)
+    except RowError as e:
+        return StatementRow(number, None, '', None, str(e))
+
+def parse_camt053_statement(fileobj):
+    """
+    StatementRows from the <Ntry> entries of an ISO 20022 camt.053 statement
+    (any schema version). The XML is fed to a pull parser in blocks and every
+    entry is removed from the tree once read, so memory stays flat however
+    long the statement is. Files with a DTD are refused (entity expansion).
+    """
+    parser = ElementTree.XMLPullParser(events=('start', 'end'))
+    stack, number, prolog, ns = [], 0, b'', ''
+    try:
+        for block in itertools.chain(read_blocks(fileobj), [None]):
+            if block is None:
+                parser.close()
+            else:
+                if prolog is not None:
+                    prolog += block
+                    if b'<!DOCTYPE' in prolog.upper():
+                        yield StatementRow(0, None, '', None, "Statement files with a DOCTYPE are not accepted")
+                        return
+                parser.feed(block)
+            for event, elem in parser.read_events():
+                prolog = None  # the root element has started, no DTD can follow
+                if event == 'start':
+                    if not stack:  # the schema version varies; entries share the root's namespace
+                        ns = elem.tag[:elem.tag.find('}') + 1]
+                    stack.append(elem)
+                    continue
+                stack.pop()
+                if elem.tag == ns + 'Ntry':
+                    number += 1
+                    yield camt_row(number, elem, ns)
+                    elem.clear()
+                    if stack:
+                        stack[-1].remove(elem)
+    except ElementTree.ParseError as e:
+        yield StatementRow(number + 1, None, '', None, f"Invalid XML: {e}")
+
+STATEMENT_PARSERS = {
+    '.csv': parse_csv_statement,
+    '.ofx': parse_ofx_statement,
+    '.qfx': parse_ofx_statement,
+    '.qif': parse_qif_statement,
+    '.xml': parse_camt053_statement,
+}
+
+def statement_parser(filename, fileobj):
+    """
+    The parser for an uploaded statement, chosen by file extension. An .xml
+    file is sniffed, since some banks export OFX 2.x with that extension.
+    None for an unsupported file.
+    """
+    parser = STATEMENT_PARSERS.get(filename[filename.rfind('.'):].lower() if '.' in filename else '')
+    if parser is parse_camt053_statement:
+        head = fileobj.read(4096)
+        fileobj.seek(0)
+        if b'<OFX' in head.upper():
+            return parse_ofx_statement
+    return parser
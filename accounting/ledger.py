@@ -0,0 +1,258 @@
+"""
+Ledger projections used by the reports.
+
+AccountPeriodBalance holds one row of posted debit/credit totals per account
+per calendar month. A balance "as of" any date is the sum of the whole months
+before it (read from the snapshot rows) plus the posted lines of the partial
+month, so report cost no longer grows with the age of the ledger.
+"""
+import datetime
+import decimal
+import functools
+import operator
+
+from django.db import transaction
+from django.db.models import Case, DecimalField, ExpressionWrapper, F, Q, Sum, Value, When, Window
+from django.db.models.functions import TruncMonth
+
+from .models import AccountPeriodBalance, JournalVoucherLine
+
+ZERO = decimal.Decimal(0)
+MONEY = DecimalField(max_digits=19, decimal_places=2)
+
+
+# --- DATE HELPERS ---
+def to_date(value):
+    """Accept a date or an ISO 'YYYY-MM-DD' string (as posted by the forms)."""
+    if value is None or isinstance(value, datetime.date):
+        return value
+    return datetime.date.fromisoformat(str(value)[:10])
+
+def month_start(d):
+    return d.replace(day=1)
+
+def next_month(d):
+    return (d.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+
+
+# --- POSTING HOOK ---
+def increment_by_case(queryset, key_fields, field_deltas):
+    """
+    Add amounts to numeric fields of several rows in one statement:
+    UPDATE ... SET f = f + CASE WHEN <key> THEN amount ... END.
+    field_deltas maps a field name to {key tuple (values of key_fields): amount}.
+    The rows are locked in key order first (SELECT ... FOR UPDATE where the
+    database supports it) so concurrent postings always take row locks in the
+    same order and cannot deadlock each other.
+    """
+    if not any(field_deltas.values()):
+        return
+    list(queryset.select_for_update().order_by(*key_fields).values_list('pk', flat=True))
+    queryset.update(**{
+        field: F(field) + Case(*[When(then=Value(amount), **dict(zip(key_fields, key))) for key, amount in deltas.items()],
+                               default=Value(ZERO), output_field=MONEY)
+        for field, deltas in field_deltas.items()
+    })
+
+def posted_line_totals(lines):
+    """Group a queryset of lines into per (account, month) debit/credit totals."""
+    return (lines.annotate(period=TruncMonth('posting_date'))
+            .values('company_id', 'account_id', 'period')
+            .annotate(debit=Sum('debit_amount'), credit=Sum('credit_amount'))
+            .order_by())
+
+def record_posting(voucher, sign=1):
+    """
+    Add the lines of a voucher that just reached 'Posted' to the period rows.
+    Must run inside the same transaction that posts the voucher. Pass sign=-1
+    to take a posted voucher back out again.
+    """
+    rows = list(posted_line_totals(JournalVoucherLine.objects.filter(journal_voucher=voucher)))
+    if not rows:
+        return
+    with transaction.atomic():
+        # Make sure every (account, month) row exists, then increment in the DB
+        # so two vouchers posted at once cannot overwrite each other's totals.
+        AccountPeriodBalance.objects.bulk_create([
+            AccountPeriodBalance(company_id=voucher.company_id, account_id=r['account_id'], period=r['period'])
+            for r in rows
+        ], ignore_conflicts=True)
+        target = AccountPeriodBalance.objects.filter(
+            functools.reduce(operator.or_, (Q(account_id=r['account_id'], period=r['period']) for r in rows)))
+        increment_by_case(target, ['account_id', 'period'], {
+            'debit_total': {(r['account_id'], r['period']): sign * (r['debit'] or ZERO) for r in rows},
+            'credit_total': {(r['account_id'], r['period']): sign * (r['credit'] or ZERO) for r in rows},
+        })
+
+
+# --- BALANCE QUERIES ---
+def account_totals(company, start=None, end=None):
+    """
+    Posted debit/credit totals per account for lines dated start..end
+    (both inclusive, either may be None for an open range).
+
+    Returns {account_id: (debit, credit)}. Whole months inside the range come
+    from AccountPeriodBalance; the partial months at either edge are summed
+    from the raw lines. One query, whatever the size of the ledger or chart.
+    """
+    start, end = to_date(start), to_date(end)
+
+    # Whole months are those in [first_full, cutoff)
+    first_full = None if start is None else (start if start.day == 1 else next_month(start))
+    if end is None:
+        cutoff = None
+    else:
+        cutoff = next_month(end) if next_month(end) - datetime.timedelta(days=1) == end else month_start(end)
+
+    lines = JournalVoucherLine.objects.filter(company=company, status='Posted')
+    if first_full is not None and cutoff is not None and first_full >= cutoff:
+        # Range sits inside a single month: nothing to read from the snapshot
+        snapshot = AccountPeriodBalance.objects.none()
+        lines = lines.filter(posting_date__range=[start, end])
+    else:
+        snapshot = AccountPeriodBalance.objects.filter(company=company)
+        edges = Q(pk__in=[])
+        if first_full is not None:
+            snapshot = snapshot.filter(period__gte=first_full)
+            if start < first_full:
+                edges |= Q(posting_date__gte=start, posting_date__lt=first_full)
+        if cutoff is not None:
+            snapshot = snapshot.filter(period__lt=cutoff)
+            if cutoff <= end:
+                edges |= Q(posting_date__gte=cutoff, posting_date__lte=end)
+        lines = lines.filter(edges)
+
+    # Both halves are grouped per account and sent as one UNION ALL query
+    snapshot_rows = snapshot.values('account_id').annotate(debit=Sum('debit_total'), credit=Sum('credit_total')).order_by()
+    line_rows = lines.values('account_id').annotate(debit=Sum('debit_amount'), credit=Sum('credit_amount')).order_by()
+    totals = {}
+    for row in snapshot_rows.union(line_rows, all=True):
+        d, c = totals.get(row['account_id'], (ZERO, ZERO))
+        totals[row['account_id']] = (d + (row['debit'] or ZERO), c + (row['credit'] or ZERO))
+    return totals
+
+def balances_as_of(company, as_of):
+    """Posted totals per account for everything dated on or before as_of."""
+    return account_totals(company, None, as_of)
+
+def net_balance(account, debit, credit):
+    """Signed balance of an account in the direction of its normal balance."""
+    return (debit - credit) if account.normal_balance == 'Debit' else (credit - debit)
+
+
+# --- ACCOUNT LEDGER ---
+LEDGER_PAGE_SIZE = 100
+
+def account_balance_before(account, before, through_id=None):
+    """
+    Balance of one account (signed by its normal balance) from everything
+    posted before the date `before`, plus the lines dated `before` with
+    id <= through_id when given. Whole months come from the snapshot rows,
+    the rest of the month from the lines; one query.
+    """
+    month = month_start(before)
+    edge = Q(posting_date__gte=month, posting_date__lt=before)
+    if through_id is not None:
+        edge |= Q(posting_date=before, id__lte=through_id)
+    snapshot_rows = (AccountPeriodBalance.objects.filter(account=account, period__lt=month)
+                     .values('account_id').annotate(debit=Sum('debit_total'), credit=Sum('credit_total')).order_by())
+    line_rows = (JournalVoucherLine.objects.filter(edge, company_id=account.company_id, account=account, status='Posted')
+                 .values('account_id').annotate(debit=Sum('debit_amount'), credit=Sum('credit_amount')).order_by())
+    debit = credit = ZERO
+    for row in snapshot_rows.union(line_rows, all=True):
+        debit += row['debit'] or ZERO
+        credit += row['credit'] or ZERO
+    return net_balance(account, debit, credit)
+
+def parse_cursor(value):
+    """'YYYY-MM-DD.<line id>' -> (date, id); None for a missing or malformed cursor."""
+    try:
+        day, line_id = str(value).split('.')
+        return datetime.date.fromisoformat(day), int(line_id)
+    except (TypeError, ValueError):
+        return None
+
+def ledger_page(account, after=None, start=None, end=None, search='', page_size=LEDGER_PAGE_SIZE):
+    """
+    One keyset page of an account's posted lines in (posting_date, id) order,
+    starting after the (date, id) cursor `after`.
+
+    Each row carries its voucher's number and description (joined in the same
+    query) and a running balance computed by a window function, offset by the
+    opening balance of the page. With a search filter the running balance
+    only covers the matching lines.
+
+    Returns (rows, opening_balance, next_cursor); next_cursor is None on the
+    last page.
+    """
+    start, end = to_date(start), to_date(end)
+    lines = JournalVoucherLine.objects.filter(company_id=account.company_id, account=account, status='Posted')
+    if start:
+        lines = lines.filter(posting_date__gte=start)
+    if end:
+        lines = lines.filter(posting_date__lte=end)
+    if search:
+        lines = lines.filter(Q(journal_voucher__jv_number__icontains=search) | Q(journal_voucher__description__icontains=search)
+                             | Q(line_description__icontains=search))
+
+    if after:
+        lines = lines.filter(Q(posting_date__gt=after[0]) | Q(posting_date=after[0], id__gt=after[1]))
+        opening = ZERO if search else account_balance_before(account, after[0], after[1])
+    else:
+        opening = account_balance_before(account, start) if start and not search else ZERO
+
+    if account.normal_balance == 'Debit':
+        signed = ExpressionWrapper(F('debit_amount') - F('credit_amount'), output_field=MONEY)
+    else:
+        signed = ExpressionWrapper(F('credit_amount') - F('debit_amount'), output_field=MONEY)
+    rows = list(lines.order_by('posting_date', 'id').values(
+        'id', 'posting_date', 'debit_amount', 'credit_amount', 'line_description', 'journal_voucher_id',
+        jv_number=F('journal_voucher__jv_number'), description=F('journal_voucher__description'),
+    ).annotate(
+        running=Window(Sum(signed), order_by=[F('posting_date').asc(), F('id').asc()], output_field=MONEY),
+    )[:page_size + 1])
+
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = f"{rows[-1]['posting_date'].isoformat()}.{rows[-1]['id']}"
+    for row in rows:
+        row['balance'] = opening + row.pop('running')
+    return rows, opening, next_cursor
+
+
+# --- MAINTENANCE ---
+@transaction.atomic
+def rebuild_period_balances(company):
+    """Throw away and regenerate a company's period rows from the raw lines."""
+    AccountPeriodBalance.objects.filter(company=company).delete()
+    rows = posted_line_totals(JournalVoucherLine.objects.filter(company=company, status='Posted'))
+    objs = [
+        AccountPeriodBalance(company=company, account_id=r['account_id'], period=r['period'],
+                             debit_total=r['debit'] or ZERO, credit_total=r['credit'] or ZERO)
+        for r in rows.iterator()
+    ]
+    AccountPeriodBalance.objects.bulk_create(objs, batch_size=1000)
+    return len(objs)
+
+def check_period_balances(company):
+    """
+    Compare the period rows with the raw posted lines.
+    Returns a list of (account_id, period, expected, stored) for every
+    mismatch, where expected/stored are (debit, credit) tuples.
+    """
+    expected = {
+        (r['account_id'], r['period']): (r['debit'] or ZERO, r['credit'] or ZERO)
+        for r in posted_line_totals(JournalVoucherLine.objects.filter(company=company, status='Posted'))
+    }
+    stored = {
+        (r['account_id'], r['period']): (r['debit_total'], r['credit_total'])
+        for r in AccountPeriodBalance.objects.filter(company=company).values('account_id', 'period', 'debit_total', 'credit_total')
+    }
+    problems = []
+    for key in sorted(set(expected) | set(stored)):
+        exp = expected.get(key, (ZERO, ZERO))
+        got = stored.get(key, (ZERO, ZERO))
+        if exp != got:
+            problems.append((key[0], key[1], exp, got))
+    return problems
@@ -0,0 +1,257 @@
+"""
+Concurrent write load test.
+
+run_load_test() drives the posting views (create_invoice, receive_payment,
+create_expense and post_voucher) from many workers at once against one
+company in the configured database, through the test client so the whole
+request path, transactions included, is exercised. Workers are threads by
+default, or processes (each with its own connection pool) with
+processes=True. Each worker picks operations from a weighted mix with its
+own random.Random, so a run is reproducible up to scheduling.
+
+Every request is recorded as ok or as a failure kind: 'unique' for unique
+constraint violations (e.g. two INV-/JV- numbers built from the same
+second), 'deadlock' for deadlocks, lock timeouts and SQLite's "database is
+locked", and 'error' for anything else. After the run the ledger of the
+company is checked: stored account balances against the posted lines,
+period balances against the lines, and every posted voucher for balance.
+"""
+import datetime
+import decimal
+import logging
+import multiprocessing
+import random
+import statistics
+import threading
+import time
+import uuid
+
+import django
+from django.db import IntegrityError, OperationalError, connection, connections
+from django.db.models import Q, Sum
+from django.test import Client
+from django.urls import resolve, reverse
+from django.utils import timezone
+
+from . import benchmarks, ledger, posting, seeding
+from .models import Account, Company, Customer, Invoice, JournalVoucher, JournalVoucherLine, Product, Vendor
+
+OPERATIONS = ['create_invoice', 'receive_payment', 'create_expense', 'post_voucher']
+DEFAULT_MIX = {'create_invoice': 3, 'receive_payment': 2, 'create_expense': 3, 'post_voucher': 2}
+DEADLOCK_MARKERS = ('deadlock', 'database is locked', 'database table is locked', 'lock wait timeout', 'could not serialize')
+EXAMPLES_PER_KIND = 3
+HALF_CENT = decimal.Decimal('0.005')
+
+
+def parse_mix(value):
+    """'create_invoice=3,post_voucher=1' -> {'create_invoice': 3, 'post_voucher': 1}"""
+    mix = {}
+    for part in filter(None, value.split(',')):
+        name, _, weight = part.partition('=')
+        if name not in OPERATIONS:
+            raise ValueError(f"Unknown operation {name!r}; expected one of {', '.join(OPERATIONS)}")
+        mix[name] = int(weight or 1)
+    if not any(mix.values()):
+        raise ValueError("The mix needs at least one operation with a positive weight")
+    return mix
+
+def classify(exc):
+    message = str(exc).lower()
+    if isinstance(exc, IntegrityError) and ('unique' in message or 'duplicate' in message):
+        return 'unique'
+    if isinstance(exc, OperationalError) and any(marker in message for marker in DEADLOCK_MARKERS):
+        return 'deadlock'
+    return 'error'
+
+def dataset(seed, end_date, log):
+    """The load test company for `seed`, seeded on first use (about 500 vouchers)."""
+    index = f"load-{seed}"
+    company = Company.objects.filter(owner__username=f"seed-{index}").first()
+    if company:
+        return company
+    log("Seeding the load test company...")
+    return seeding.seed_company(random.Random(f"load-{seed}"), index, benchmarks.dataset_profile(500), end_date, password=None, log=log)
+
+
+class Worker:
+    """One simulated clerk: a logged-in client posting documents for the company."""
+
+    def __init__(self, company_id, index, workers, mix, seed):
+        self.company_id, self.index, self.rng, self.count = company_id, index, random.Random(f"{seed}-{index}"), 0
+        self.names, self.weights = list(mix), list(mix.values())
+        company = Company.objects.select_related('owner').get(pk=company_id)
+        self.client = Client()
+        self.client.force_login(company.owner)
+        self.today = timezone.localdate().isoformat()
+        self.customers = list(Customer.objects.filter(company=company, is_active=True).values_list('id', flat=True))
+        self.vendors = list(Vendor.objects.filter(company=company, is_active=True).values_list('id', flat=True))
+        self.products = list(Product.objects.filter(company=company, is_active=True).values_list('id', 'unit_price'))
+        accounts = Account.objects.filter(company=company, is_active=True)
+        self.banks = list(accounts.filter(account_type='Bank').values_list('id', flat=True))
+        self.expense_accounts = list(accounts.filter(account_type='Expenses').values_list('id', flat=True))
+        self.accounts = list(accounts.values_list('id', flat=True))
+        # Open invoices are shared out between the workers so no two pay the same one
+        open_ids = Invoice.objects.filter(company=company, status='Sent').order_by('id').values_list('id', flat=True)
+        self.open_invoices = list(open_ids)[index::workers]
+
+    def post(self, name, data, *args):
+        resp = self.client.post(reverse(name, args=args), data)
+        if resp.status_code != 302:
+            raise RuntimeError(f"{name} answered {resp.status_code}")
+        return resp
+
+    def create_invoice(self):
+        lines = self.rng.sample(self.products, min(len(self.products), self.rng.randint(1, 3)))
+        resp = self.post('create_invoice', {
+            'customer': self.rng.choice(self.customers), 'invoice_date': self.today, 'due_date': self.today, 'payment_terms': 'Net 30',
+            'product': [p for p, _ in lines], 'account': ['' for _ in lines],
+            'quantity': [self.rng.randint(1, 5) for _ in lines], 'unit_price': [str(price) for _, price in lines],
+        })
+        self.open_invoices.append(resolve(resp['Location']).kwargs['invoice_id'])
+
+    def receive_payment(self):
+        if not self.open_invoices:
+            self.create_invoice()
+        invoice_id = self.open_invoices.pop(self.rng.randrange(len(self.open_invoices)))
+        self.post('receive_payment', {'deposit_account': self.rng.choice(self.banks), 'payment_date': self.today}, invoice_id)
+
+    def create_expense(self):
+        accounts = self.rng.sample(self.expense_accounts, min(len(self.expense_accounts), self.rng.randint(1, 3)))
+        self.post('create_expense', {
+            'vendor': self.rng.choice(self.vendors), 'expense_date': self.today, 'payment_account': self.rng.choice(self.banks),
+            'reference_number': f"LOAD-{self.index}-{self.count}", 'account': accounts,
+            'amount': [f"{self.rng.randint(100, 50000) / 100:.2f}" for _ in accounts], 'line_description': ['Load test' for _ in accounts],
+        })
+
+    def post_voucher(self):
+        """Enter a balanced draft through create_voucher, then post it."""
+        debit, credit = self.rng.sample(self.accounts, 2)
+        amount = f"{self.rng.randint(100, 500000) / 100:.2f}"
+        description = f"Load test {self.index}-{self.count}-{uuid.uuid4().hex[:12]}"
+        self.post('create_voucher', {
+            'jv_date': self.today, 'description': description, 'account': [debit, credit],
+            'debit': [amount, '0'], 'credit': ['0', amount], 'line_description': ['', ''],
+        })
+        voucher = JournalVoucher.objects.get(company_id=self.company_id, description=description)
+        self.post('post_voucher', {}, voucher.id)
+
+    def run(self, operations=None, deadline=None):
+        """[(operation, seconds, kind, message)] for `operations` requests or until `deadline` (time.monotonic())."""
+        samples = []
+        while (operations is None or self.count < operations) and (deadline is None or time.monotonic() < deadline):
+            name = self.rng.choices(self.names, self.weights)[0]
+            started = time.perf_counter()
+            kind, message = 'ok', ''
+            try:
+                getattr(self, name)()
+            except Exception as exc:
+                kind, message = classify(exc), f"{type(exc).__name__}: {exc}"
+            samples.append((name, time.perf_counter() - started, kind, message))
+            self.count += 1
+        return samples
+
+
+def run_worker(company_id, index, workers, mix, seed, operations, duration, barrier=None):
+    try:
+        try:
+            worker = Worker(company_id, index, workers, mix, seed)
+        except Exception:
+            if barrier is not None:
+                barrier.abort()
+            raise
+        if barrier is not None:
+            barrier.wait()
+        return worker.run(operations, time.monotonic() + duration if duration else None)
+    finally:
+        connection.close()
+
+def _process_worker(args):
+    django.setup()
+    logging.getLogger('django.request').setLevel(logging.CRITICAL)
+    return run_worker(*args)
+
+def check_integrity(company):
+    """{'balance_drift', 'period_mismatches', 'unbalanced_vouchers'}: counts, all zero for a consistent ledger."""
+    # Compared with a tolerance because SQLite sums decimals as floats
+    unbalanced = (JournalVoucherLine.objects.filter(company=company, status='Posted').values('journal_voucher_id')
+                  .annotate(diff=Sum('debit_amount') - Sum('credit_amount')).filter(Q(diff__gt=HALF_CENT) | Q(diff__lt=-HALF_CENT)).order_by())
+    return {
+        'balance_drift': len(posting.recalculate_balances(company, dry_run=True)),
+        'period_mismatches': len(ledger.check_period_balances(company)),
+        'unbalanced_vouchers': unbalanced.count(),
+    }
+
+def summarize(samples, elapsed):
+    """Per operation and overall: requests, ok, failures by kind, ok/s and latency percentiles of the ok requests."""
+    def stats(rows):
+        ok = [seconds * 1000 for _, seconds, kind, _ in rows if kind == 'ok']
+        row = {'requests': len(rows), 'ok': len(ok), 'throughput': round(len(ok) / elapsed, 2) if elapsed else None}
+        for kind in ('unique', 'deadlock', 'error'):
+            row[kind] = sum(1 for r in rows if r[2] == kind)
+        row.update({'p50_ms': None, 'p95_ms': None, 'p99_ms': None})
+        if ok:
+            row.update({'p50_ms': round(statistics.median(ok), 2), 'p95_ms': round(benchmarks.percentile(ok, 95), 2),
+                        'p99_ms': round(benchmarks.percentile(ok, 99), 2)})
+        return row
+    names = [name for name in OPERATIONS if any(s[0] == name for s in samples)]
+    return {**{name: stats([s for s in samples if s[0] == name]) for name in names}, 'total': stats(samples)}
+
+def run_workers(args, processes):
+    """(samples of every worker, wall-clock seconds from the moment all workers are ready)."""
+    if processes:
+        # Children must not inherit the parent's open connections
+        connections.close_all()
+        started = time.monotonic()
+        with multiprocessing.Pool(len(args)) as pool:
+            per_worker = pool.map(_process_worker, args)
+        return [s for rows in per_worker for s in rows], time.monotonic() - started
+
+    barrier = threading.Barrier(len(args) + 1)
+    per_worker = [None] * len(args)
+
+    def target(i):
+        try:
+            per_worker[i] = run_worker(*args[i], barrier=barrier)
+        except threading.BrokenBarrierError:
+            per_worker[i] = []
+    threads = [threading.Thread(target=target, args=(i,)) for i in range(len(args))]
+    for t in threads:
+        t.start()
+    try:
+        barrier.wait()
+    except threading.BrokenBarrierError:
+        pass
+    started = time.monotonic()
+    for t in threads:
+        t.join()
+    if any(rows is None for rows in per_worker):
+        raise RuntimeError("A load test worker failed to start")
+    return [s for rows in per_worker for s in rows], time.monotonic() - started
+
+def run_load_test(company, workers=8, operations=25, duration=None, mix=None, seed=1, processes=False):
+    """
+    Run `workers` workers against `company`, each doing `operations` requests
+    (or running for `duration` seconds when given), and check the ledger after.
+    """
+    mix = mix or DEFAULT_MIX
+    if duration:
+        operations = None
+    args = [(company.pk, i, workers, mix, seed, operations, duration) for i in range(workers)]
+    # Failures are counted in the results; django.request's traceback for each one is only noise here
+    request_logger = logging.getLogger('django.request')
+    level = request_logger.level
+    request_logger.setLevel(logging.CRITICAL)
+    try:
+        samples, elapsed = run_workers(args, processes)
+    finally:
+        request_logger.setLevel(level)
+
+    examples = {}
+    for _, _, kind, message in samples:
+        if kind != 'ok' and len(examples.setdefault(kind, [])) < EXAMPLES_PER_KIND and message not in examples[kind]:
+            examples[kind].append(message)
+    return {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'), 'database': connection.vendor, 'company': company.pk,
+        'workers': workers, 'processes': processes, 'mix': mix, 'seconds': round(elapsed, 2),
+        'results': summarize(samples, elapsed), 'failures': examples, 'integrity': check_integrity(company),
+    }
@@ -0,0 +1,78 @@
+import datetime
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from accounting import benchmarks
+
+RESULTS_DIR = 'benchmark_results'
+
+
+def int_list(value):
+    return [int(v) for v in value.split(',') if v]
+
+
+class Command(BaseCommand):
+    help = ("Benchmark the reports and CSV exports against seeded datasets of increasing size, "
+            "save the results as JSON and compare them with a baseline run (p50, p95, queries, peak memory "
+            "and rows scanned; on SQLite, which cannot count rows scanned, VM steps in thousands instead).")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int_list, default=[1000, 10000, 100000],
+                            help="Comma-separated journal voucher counts, one dataset each (seeded on first use).")
+        parser.add_argument('--reports', default=','.join(benchmarks.REPORTS),
+                            help=f"Comma-separated subset of: {', '.join(benchmarks.REPORTS)}.")
+        parser.add_argument('--warmup', type=int, default=1, help="Untimed requests per report before measuring.")
+        parser.add_argument('--repetitions', type=int, default=5, help="Timed requests per report.")
+        parser.add_argument('--seed', type=int, default=1, help="Seed of the generated datasets.")
+        parser.add_argument('--output', help=f"Results file. Defaults to {RESULTS_DIR}/reports-<timestamp>.json.")
+        parser.add_argument('--baseline', default=os.path.join(RESULTS_DIR, 'baseline.json'),
+                            help="Earlier results to compare with (skipped when the file does not exist).")
+        parser.add_argument('--save-baseline', action='store_true', help="Also write this run to --baseline.")
+        parser.add_argument('--fail-over', type=float,
+                            help="Exit with an error when any p50 is more than this many percent slower than the baseline.")
+
+    def handle(self, *args, **options):
+        reports = [r for r in options['reports'].split(',') if r]
+        unknown = set(reports) - set(benchmarks.REPORTS)
+        if unknown:
+            raise CommandError(f"Unknown report(s): {', '.join(sorted(unknown))}")
+
+        results = benchmarks.run_benchmarks(options['sizes'], reports, warmup=options['warmup'],
+                                            repetitions=options['repetitions'], seed=options['seed'], log=self.stdout.write)
+        output = options['output'] or os.path.join(RESULTS_DIR, f"reports-{datetime.datetime.now():%Y%m%d-%H%M%S}.json")
+        os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+        benchmarks.save(results, output)
+        self.stdout.write(f"Results written to {output}.")
+
+        baseline = options['baseline']
+        regressions = []
+        if os.path.exists(baseline) and not options['save_baseline']:
+            rows = benchmarks.compare(benchmarks.load(baseline), results)
+            self.print_table(baseline, rows)
+            if options['fail_over'] is not None:
+                regressions = [key for key, change, _ in rows if change is not None and change > options['fail_over']]
+        if options['save_baseline']:
+            os.makedirs(os.path.dirname(baseline) or '.', exist_ok=True)
+            benchmarks.save(results, baseline)
+            self.stdout.write(f"Baseline saved to {baseline}.")
+        if regressions:
+            raise CommandError(f"p50 more than {options['fail_over']}% slower than the baseline: {', '.join(regressions)}")
+
+    def print_table(self, baseline, rows):
+        fmt = lambda v, suffix='': '-' if v is None else f"{v}{suffix}"
+        # Metrics neither run recorded (e.g. rows scanned on SQLite) get no columns
+        metrics = [m for m in benchmarks.COMPARED if any(v is not None for _, _, values in rows for v in values[m])]
+        table = [('report @ vouchers', 'p50 change') + tuple(h for m in metrics for h in (f"base {benchmarks.COMPARED[m]}", benchmarks.COMPARED[m]))]
+        table += [(key, fmt(change if change is None else f"{change:+}", '%')) + tuple(fmt(v) for m in metrics for v in values[m])
+                  for key, change, values in rows]
+        widths = [max(len(row[i]) for row in table) for i in range(len(table[0]))]
+        self.stdout.write(f"Compared with {baseline}:")
+        for n, row in enumerate(table):
+            line = '  '.join(cell.ljust(w) if i == 0 else cell.rjust(w) for i, (cell, w) in enumerate(zip(row, widths)))
+            change = rows[n - 1][1] if n else None
+            if change is not None and change > 10:
+                line = self.style.ERROR(line)
+            elif change is not None and change < -10:
+                line = self.style.SUCCESS(line)
+            self.stdout.write(line)
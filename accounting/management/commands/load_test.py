@@ -0,0 +1,70 @@
+import datetime
+import json
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from accounting import loadtest
+from accounting.models import Company
+
+
+def mix(value):
+    try:
+        return loadtest.parse_mix(value)
+    except ValueError as exc:
+        raise CommandError(str(exc))
+
+
+class Command(BaseCommand):
+    help = ("Post invoices, payments, expenses and journal vouchers from many concurrent workers against one company, "
+            "then report throughput, latency, failures and ledger integrity.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--company', type=int, help="Company id to load. Defaults to a seeded load test company (seed-load-<seed>).")
+        parser.add_argument('--workers', type=int, default=8, help="Concurrent workers.")
+        parser.add_argument('--processes', action='store_true', help="Run the workers as processes instead of threads.")
+        parser.add_argument('--operations', type=int, default=25, help="Requests per worker.")
+        parser.add_argument('--duration', type=float, help="Run for this many seconds instead of a fixed number of requests.")
+        parser.add_argument('--mix', type=mix, default=loadtest.DEFAULT_MIX,
+                            help=f"Weighted operations, e.g. create_invoice=3,post_voucher=1. Operations: {', '.join(loadtest.OPERATIONS)}.")
+        parser.add_argument('--seed', type=int, default=1, help="Seed of the workers' choices and of the seeded company.")
+        parser.add_argument('--output', help="Also write the results as JSON to this file.")
+
+    def handle(self, *args, **options):
+        if options['company']:
+            company = Company.objects.filter(pk=options['company']).first()
+            if company is None:
+                raise CommandError(f"Company {options['company']} does not exist.")
+        else:
+            company = loadtest.dataset(options['seed'], datetime.date.today(), log=self.stdout.write)
+
+        kind = 'processes' if options['processes'] else 'threads'
+        self.stdout.write(f"Loading {company.name} (id {company.pk}) with {options['workers']} {kind}...")
+        run = loadtest.run_load_test(company, workers=options['workers'], operations=options['operations'], duration=options['duration'],
+                                     mix=options['mix'], seed=options['seed'], processes=options['processes'])
+        self.print_results(run)
+        if options['output']:
+            os.makedirs(os.path.dirname(options['output']) or '.', exist_ok=True)
+            with open(options['output'], 'w') as f:
+                json.dump(run, f, indent=2, sort_keys=True)
+            self.stdout.write(f"Results written to {options['output']}.")
+
+        broken = {check: count for check, count in run['integrity'].items() if count}
+        if broken:
+            raise CommandError("Ledger integrity check failed: " + ', '.join(f"{check} {count}" for check, count in broken.items()))
+        self.stdout.write(self.style.SUCCESS("Ledger integrity: ok."))
+
+    def print_results(self, run):
+        columns = ['requests', 'ok', 'throughput', 'p50_ms', 'p95_ms', 'p99_ms', 'unique', 'deadlock', 'error']
+        table = [['operation', 'requests', 'ok', 'ok/s', 'p50 ms', 'p95 ms', 'p99 ms', 'unique', 'deadlock', 'error']]
+        table += [[name] + ['-' if row[c] is None else str(row[c]) for c in columns] for name, row in run['results'].items()]
+        widths = [max(len(row[i]) for row in table) for i in range(len(table[0]))]
+        self.stdout.write(f"{run['seconds']}s on {run['database']}:")
+        for row in table:
+            line = '  '.join(cell.ljust(w) if i == 0 else cell.rjust(w) for i, (cell, w) in enumerate(zip(row, widths)))
+            failed = row is not table[0] and any(cell not in ('0', '-') for cell in row[-3:])
+            self.stdout.write(self.style.ERROR(line) if failed else line)
+        for kind, messages in run['failures'].items():
+            self.stdout.write(f"{kind} failures, e.g.:")
+            for message in messages:
+                self.stdout.write(f"  {message[:300]}")
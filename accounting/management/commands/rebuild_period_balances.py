@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from accounting.ledger import check_period_balances, rebuild_period_balances
+from accounting.models import Company
+
+
+class Command(BaseCommand):
+    help = "Rebuild (or with --check, verify) the per-account monthly balance rows from the journal lines."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--company', type=int, action='append', dest='companies',
+                            help="Company id to process (repeatable). Defaults to every company.")
+        parser.add_argument('--check', action='store_true',
+                            help="Only compare the stored rows with the journal lines; change nothing.")
+
+    def handle(self, *args, **options):
+        companies = Company.objects.order_by('id')
+        if options['companies']:
+            companies = companies.filter(id__in=options['companies'])
+
+        mismatched = 0
+        for company in companies:
+            if options['check']:
+                problems = check_period_balances(company)
+                for account_id, period, expected, stored in problems:
+                    self.stdout.write(
+                        f"{company.name}: account {account_id} {period:%Y-%m} "
+                        f"expected Dr {expected[0]} / Cr {expected[1]}, stored Dr {stored[0]} / Cr {stored[1]}"
+                    )
+                mismatched += len(problems)
+            else:
+                count = rebuild_period_balances(company)
+                self.stdout.write(f"{company.name}: {count} period rows rebuilt.")
+
+        if options['check']:
+            if mismatched:
+                raise CommandError(f"{mismatched} period balance row(s) do not match the journal.")
+            self.stdout.write(self.style.SUCCESS("Period balances match the journal."))
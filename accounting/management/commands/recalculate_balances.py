@@ -0,0 +1,65 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from accounting.models import Company
+from accounting.posting import recalculate_balances
+
+
+def _init_worker():
+    # Spawned workers start with a fresh interpreter
+    django.setup()
+
+def _recalculate(company_id, dry_run):
+    """Runs in a worker process; returns plain data so it pickles cleanly."""
+    try:
+        company = Company.objects.get(pk=company_id)
+        drift = recalculate_balances(company, dry_run=dry_run)
+        return company.id, company.name, [(str(acc), stored, ledger) for acc, stored, ledger in drift]
+    finally:
+        connections.close_all()
+
+
+class Command(BaseCommand):
+    help = "Recalculate account balances from the posted ledger for every company (or the ones given), in parallel."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--company', type=int, action='append', dest='companies',
+                            help="Company id to process (repeatable). Defaults to every company.")
+        parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+                            help="Number of worker processes (1 runs in this process).")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Only report accounts whose current_balance drifted from the ledger.")
+
+    def handle(self, *args, **options):
+        company_ids = Company.objects.order_by('id')
+        if options['companies']:
+            company_ids = company_ids.filter(id__in=options['companies'])
+        company_ids = list(company_ids.values_list('id', flat=True))
+        dry_run = options['dry_run']
+
+        if options['workers'] <= 1 or len(company_ids) <= 1:
+            results = (_recalculate(cid, dry_run) for cid in company_ids)
+            self.report(results, dry_run)
+            return
+
+        # Workers open their own connections; never share this process's one
+        connections.close_all()
+        ctx = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=options['workers'], mp_context=ctx, initializer=_init_worker) as pool:
+            futures = [pool.submit(_recalculate, cid, dry_run) for cid in company_ids]
+            self.report((f.result() for f in as_completed(futures)), dry_run)
+
+    def report(self, results, dry_run):
+        drifted = 0
+        for company_id, name, drift in results:
+            for account, stored, ledger in drift:
+                self.stdout.write(f"{name}: {account} stored {stored}, ledger {ledger} (diff {ledger - stored})")
+            drifted += len(drift)
+            if not dry_run:
+                self.stdout.write(f"{name}: recalculated ({len(drift)} corrected).")
+        verb = "drifted from" if dry_run else "were corrected to match"
+        self.stdout.write(self.style.SUCCESS(f"{drifted} account balance(s) {verb} the ledger."))
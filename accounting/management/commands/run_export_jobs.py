@@ -0,0 +1,36 @@
+import datetime
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from accounting import exports
+
+
+class Command(BaseCommand):
+    help = "Worker that produces queued export jobs (ExportJob) into the media storage."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help="Process every job that is waiting, then exit.")
+        parser.add_argument('--sleep', type=float, default=5.0,
+                            help="Seconds to wait between polls when the queue is empty.")
+        parser.add_argument('--stale-minutes', type=int, default=60,
+                            help="Re-run jobs left 'Running' longer than this by a worker that died.")
+
+    def handle(self, *args, **options):
+        stale_after = datetime.timedelta(minutes=options['stale_minutes'])
+        while True:
+            close_old_connections()
+            job = exports.claim_next_job(stale_after)
+            if job is None:
+                if options['once']:
+                    return
+                time.sleep(options['sleep'])
+                continue
+            self.stdout.write(f"Running {job} for {job.company}...")
+            job = exports.run_job(job)
+            if job.status == 'Done':
+                self.stdout.write(self.style.SUCCESS(f"{job}: {job.rows_written} rows -> {job.file.name}"))
+            else:
+                self.stdout.write(self.style.ERROR(f"{job}: {job.error}"))
@@ -0,0 +1,39 @@
+import datetime
+import random
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from accounting.seeding import PROFILES, seed_company
+
+
+class Command(BaseCommand):
+    help = "Generate synthetic companies with a full ledger (deterministic for a given --seed, --profile and --end-date)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--companies', type=int, default=1, help="Number of companies to create.")
+        parser.add_argument('--profile', choices=sorted(PROFILES), default='small',
+                            help="Data volume per company: small (~10k journal lines), medium (~450k), huge (~5M).")
+        parser.add_argument('--seed', type=int, default=1, help="Random seed; the same seed gives the same data.")
+        parser.add_argument('--end-date', type=datetime.date.fromisoformat, default=datetime.date.today(),
+                            help="Last date of the generated history (YYYY-MM-DD). Defaults to today.")
+        parser.add_argument('--vouchers', type=int, help="Override the profile's number of journal vouchers per company.")
+        parser.add_argument('--password', default='seed', help="Password of the generated company owners (seed-<n>).")
+
+    def handle(self, *args, **options):
+        profile = dict(PROFILES[options['profile']])
+        if options['vouchers'] is not None:
+            profile['vouchers'] = options['vouchers']
+        seed = options['seed']
+        usernames = [f"seed-{seed}-{i}" for i in range(options['companies'])]
+        taken = sorted(User.objects.filter(username__in=usernames).values_list('username', flat=True))
+        if taken:
+            raise CommandError(f"Users already exist: {', '.join(taken)}. Use another --seed.")
+
+        for i in range(options['companies']):
+            started = time.monotonic()
+            rng = random.Random(f"{seed}-{i}")
+            company = seed_company(rng, f"{seed}-{i}", profile, options['end_date'], options['password'], log=self.stdout.write)
+            self.stdout.write(self.style.SUCCESS(
+                f"{company.name} (id {company.pk}, login {company.owner.username}) seeded in {time.monotonic() - started:.1f}s."))
@@ -0,0 +1,228 @@
+"""
+Request metrics in the Prometheus text format.
+
+MetricsMiddleware records, for every request, the duration, the number and
+total time of SQL queries, the time spent rendering templates and the
+response size into histograms labelled with the URL name ('view') and the
+company id ('company'). Streaming responses are recorded once their content
+has been sent, so CSV exports include the queries they run while streaming.
+SQL run lazily from a template counts towards both SQL and template time.
+
+Histograms have fixed buckets and at most MAX_SERIES label pairs per
+process (further companies are recorded as company="other"), so memory
+stays bounded however long a worker lives.
+
+With several worker processes (gunicorn), point settings.METRICS_MULTIPROC_DIR
+or the PROMETHEUS_MULTIPROC_DIR environment variable at a directory shared
+by the workers and emptied when the server starts. Each process then writes
+its histograms to <pid>.json there at most every FLUSH_SECONDS, and the
+/metrics endpoint adds up the files of every worker, past and present.
+"""
+import atexit
+import contextlib
+import contextvars
+import json
+import math
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+HISTOGRAMS = {
+    'riska_request_duration_seconds': ("Time to produce and send the response.", SECONDS_BUCKETS),
+    'riska_request_sql_queries': ("SQL queries run by the request.", (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)),
+    'riska_request_sql_seconds': ("Time spent in SQL queries.", SECONDS_BUCKETS),
+    'riska_request_template_seconds': ("Time spent rendering templates.", SECONDS_BUCKETS),
+    'riska_response_size_bytes': ("Response body size.", (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)),
+}
+MAX_SERIES = 2000
+FLUSH_SECONDS = 1.0
+
+current = contextvars.ContextVar('metrics_sample', default=None)
+
+
+class Sample:
+    """What one request used; also the execute wrapper that counts its queries."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.sql_seconds = self.template_seconds = 0.0
+        self.size = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.sql_seconds += time.perf_counter() - started
+
+    @contextlib.contextmanager
+    def capture(self):
+        """Count the queries run on any connection while active."""
+        with contextlib.ExitStack() as stack:
+            for conn in connections.all():
+                stack.enter_context(conn.execute_wrapper(self))
+            yield self
+
+    def values(self):
+        return {
+            'riska_request_duration_seconds': time.perf_counter() - self.started,
+            'riska_request_sql_queries': self.queries,
+            'riska_request_sql_seconds': self.sql_seconds,
+            'riska_request_template_seconds': self.template_seconds,
+            'riska_response_size_bytes': self.size,
+        }
+
+
+class Registry:
+    """
+    Histograms of one process: {(metric, view, company): [count per bucket
+    (+Inf last), sum]}. Thread-safe.
+    """
+
+    def __init__(self, max_series=MAX_SERIES):
+        self.max_series = max_series
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.series, self.labels = {}, set()
+
+    def observe(self, view, company, values):
+        with self.lock:
+            if (view, company) not in self.labels:
+                if len(self.labels) >= self.max_series:
+                    company = 'other'
+                self.labels.add((view, company))
+            for metric, value in values.items():
+                buckets = HISTOGRAMS[metric][1]
+                row = self.series.get((metric, view, company))
+                if row is None:
+                    row = self.series[(metric, view, company)] = [0] * (len(buckets) + 2)
+                row[next((i for i, bound in enumerate(buckets) if value <= bound), len(buckets))] += 1
+                row[-1] += value
+
+    def snapshot(self):
+        with self.lock:
+            return [[metric, view, company, list(row)] for (metric, view, company), row in self.series.items()]
+
+registry = Registry()
+
+
+# --- MULTIPROCESS ---
+_flushed = {'at': 0.0}
+
+def multiproc_dir():
+    return getattr(settings, 'METRICS_MULTIPROC_DIR', None) or os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+
+def flush(force=False):
+    """Write this process's histograms to <dir>/<pid>.json (atomically), at most every FLUSH_SECONDS."""
+    directory = multiproc_dir()
+    now = time.monotonic()
+    if not directory or (not force and now - _flushed['at'] < FLUSH_SECONDS):
+        return
+    _flushed['at'] = now
+    path = os.path.join(directory, f"{os.getpid()}.json")
+    tmp = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(registry.snapshot(), f)
+    os.replace(tmp, path)
+
+atexit.register(flush, force=True)
+
+def collect():
+    """{(metric, view, company): [bucket counts..., sum]} of this process, or of every process sharing the directory."""
+    directory = multiproc_dir()
+    if not directory:
+        snapshots = [registry.snapshot()]
+    else:
+        flush(force=True)
+        snapshots = []
+        for name in sorted(os.listdir(directory)):
+            if name.endswith('.json'):
+                try:
+                    with open(os.path.join(directory, name)) as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError):  # a worker gone mid-write
+                    continue
+    merged = {}
+    for snapshot in snapshots:
+        for metric, view, company, row in snapshot:
+            if metric not in HISTOGRAMS or len(row) != len(HISTOGRAMS[metric][1]) + 2:
+                continue
+            total = merged.setdefault((metric, view, company), [0] * len(row))
+            for i, value in enumerate(row):
+                total[i] += value
+    return merged
+
+
+# --- RECORDING ---
+def record(sample, view, company):
+    registry.observe(view, company, sample.values())
+    flush()
+
+def stream(content, sample, view, company):
+    """Pass a streaming response's chunks through, recording the request once they have all been sent."""
+    try:
+        with sample.capture():
+            for chunk in content:
+                sample.size += len(chunk)
+                yield chunk
+    finally:
+        record(sample, view, company)
+
+_templates = {'timed': False}
+
+def time_templates():
+    """Add the time spent in Django template rendering to the current request's sample. Idempotent."""
+    if _templates['timed']:
+        return
+    from django.template.backends.django import Template
+    render = Template.render
+
+    def timed_render(self, context=None, request=None):
+        sample = current.get()
+        if sample is None:
+            return render(self, context, request)
+        started = time.perf_counter()
+        try:
+            return render(self, context, request)
+        finally:
+            sample.template_seconds += time.perf_counter() - started
+    Template.render = timed_render
+    _templates['timed'] = True
+
+
+# --- EXPOSITION ---
+def label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def number(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+def exposition(series=None):
+    """The histograms in the Prometheus text format."""
+    series = collect() if series is None else series
+    lines = []
+    for metric, (help_text, buckets) in HISTOGRAMS.items():
+        lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} histogram"]
+        for (name, view, company), row in sorted(series.items(), key=lambda item: [str(part) for part in item[0]]):
+            if name != metric:
+                continue
+            labels = f'view="{label(view)}",company="{label(company)}"'
+            cumulative = 0
+            for bound, count in zip(buckets + (math.inf,), row):
+                cumulative += count
+                lines.append(f'{metric}_bucket{{{labels},le="{number(bound)}"}} {cumulative}')
+            lines.append(f'{metric}_sum{{{labels}}} {number(row[-1])}')
+            lines.append(f'{metric}_count{{{labels}}} {cumulative}')
+    return '\n'.join(lines) + '\n'
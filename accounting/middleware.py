@@ -0,0 +1,69 @@
+"""
+Tenant resolution and request metrics.
+
+CompanyMiddleware attaches the user's Company to every request as
+request.company. It is resolved once per request, with a single query on
+the owner's unique index, so views and templates share one instance. The
+row is not cached across requests: its ledger_version feeds the report
+cache keys and ETags and has to be current.
+
+Anonymous users get None. Companies are created at registration, or at
+login for accounts that have none (see signals.ensure_company); a session
+that was already logged in before its user had a company gets one created
+on its first request, as get_company always did.
+
+MetricsMiddleware feeds the request histograms of the metrics module.
+"""
+from . import metrics
+from .models import Company
+
+def resolve_company(request):
+    user = request.user
+    if not user.is_authenticated:
+        return None
+    company = Company.objects.filter(owner_id=user.pk).first()
+    if company is None:
+        company, _ = Company.objects.get_or_create(owner=user, defaults={'name': f"{user.username}'s Company"})
+    return company
+
+
+class CompanyMiddleware:
+    """Sets request.company; must come after AuthenticationMiddleware."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.company = resolve_company(request)
+        return self.get_response(request)
+
+
+class MetricsMiddleware:
+    """
+    Records duration, SQL, template time and response size per URL name and
+    company (see metrics). Goes first in MIDDLEWARE so the other middleware
+    is measured too.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        metrics.time_templates()
+
+    def __call__(self, request):
+        sample = metrics.Sample()
+        token = metrics.current.set(sample)
+        try:
+            with sample.capture():
+                response = self.get_response(request)
+        finally:
+            metrics.current.reset(token)
+
+        match = request.resolver_match
+        view = match.view_name if match else 'unresolved'
+        company = getattr(getattr(request, 'company', None), 'pk', None) or ''
+        if response.streaming:
+            response.streaming_content = metrics.stream(response.streaming_content, sample, view, company)
+        else:
+            sample.size = len(response.content)
+            metrics.record(sample, view, company)
+        return response
@@ -0,0 +1,47 @@
+# Generated by Django 5.2.6 on 2026-10-18 01:03
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Sum
+from django.db.models.functions import TruncMonth
+
+
+def populate_period_balances(apps, schema_editor):
+    AccountPeriodBalance = apps.get_model('accounting', 'AccountPeriodBalance')
+    JournalVoucherLine = apps.get_model('accounting', 'JournalVoucherLine')
+    rows = (JournalVoucherLine.objects.filter(journal_voucher__status='Posted')
+            .annotate(period=TruncMonth('journal_voucher__jv_date'))
+            .values('company_id', 'account_id', 'period')
+            .annotate(debit=Sum('debit_amount'), credit=Sum('credit_amount'))
+            .order_by())
+    AccountPeriodBalance.objects.bulk_create([
+        AccountPeriodBalance(company_id=r['company_id'], account_id=r['account_id'], period=r['period'],
+                             debit_total=r['debit'] or 0, credit_total=r['credit'] or 0)
+        for r in rows.iterator()
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounting', '0005_alter_expense_purchase_order'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AccountPeriodBalance',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.DateField(help_text='First day of the month')),
+                ('debit_total', models.DecimalField(decimal_places=2, default=0.0, max_digits=19)),
+                ('credit_total', models.DecimalField(decimal_places=2, default=0.0, max_digits=19)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='period_balances', to='accounting.account')),
+                ('company', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='accounting.company')),
+            ],
+            options={
+                'ordering': ['period'],
+                'unique_together': {('account', 'period')},
+            },
+        ),
+        migrations.RunPython(populate_period_balances, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,73 @@
+# Generated by Django 5.2.6 on 2026-10-18 01:13
+
+from django.db import migrations, models, transaction
+from django.db.models import Max, OuterRef, Subquery
+
+BATCH_SIZE = 10000
+
+
+def backfill_posting_fields(apps, schema_editor):
+    """
+    Copy jv_date/status from the voucher onto its lines in primary key
+    batches, committing after each one, so no single statement holds row
+    locks on the whole ledger.
+    """
+    JournalVoucher = apps.get_model('accounting', 'JournalVoucher')
+    JournalVoucherLine = apps.get_model('accounting', 'JournalVoucherLine')
+    voucher = JournalVoucher.objects.filter(pk=OuterRef('journal_voucher_id'))
+    last_id = JournalVoucherLine.objects.aggregate(m=Max('id'))['m'] or 0
+    for start in range(0, last_id + 1, BATCH_SIZE):
+        with transaction.atomic(using=schema_editor.connection.alias):
+            JournalVoucherLine.objects.filter(id__gte=start, id__lt=start + BATCH_SIZE).update(
+                posting_date=Subquery(voucher.values('jv_date')[:1]),
+                status=Subquery(voucher.values('status')[:1]),
+            )
+
+
+class AddIndexConcurrently(migrations.AddIndex):
+    """CREATE INDEX CONCURRENTLY on PostgreSQL so the ledger stays writable; a plain AddIndex elsewhere."""
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor != 'postgresql':
+            return super().database_forwards(app_label, schema_editor, from_state, to_state)
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            schema_editor.add_index(model, self.index, concurrently=True)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor != 'postgresql':
+            return super().database_backwards(app_label, schema_editor, from_state, to_state)
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            schema_editor.remove_index(model, self.index, concurrently=True)
+
+
+class Migration(migrations.Migration):
+    # Batches commit one by one and CONCURRENTLY cannot run in a transaction
+    atomic = False
+
+    dependencies = [
+        ('accounting', '0006_accountperiodbalance'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='journalvoucherline',
+            name='posting_date',
+            field=models.DateField(null=True),
+        ),
+        migrations.AddField(
+            model_name='journalvoucherline',
+            name='status',
+            field=models.CharField(choices=[('Draft', 'Draft'), ('Posted', 'Posted')], default='Draft', max_length=20),
+        ),
+        migrations.RunPython(backfill_posting_fields, migrations.RunPython.noop, atomic=False),
+        AddIndexConcurrently(
+            model_name='journalvoucherline',
+            index=models.Index(fields=['company', 'account', 'posting_date'], name='jvline_company_account_date'),
+        ),
+        AddIndexConcurrently(
+            model_name='journalvoucherline',
+            index=models.Index(fields=['company', 'status', 'posting_date'], name='jvline_company_status_date'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.6 on 2026-10-18 01:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounting', '0007_journalvoucherline_posting_date_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='company',
+            name='ledger_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
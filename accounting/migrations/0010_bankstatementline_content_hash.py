@@ -0,0 +1,54 @@
+# Generated by Django 5.2.6 on 2026-10-18 01:40
+
+import hashlib
+
+from django.db import migrations, models
+
+BATCH_SIZE = 2000
+
+
+def line_hash(date, amount, description, occurrence):
+    # Frozen copy of accounting.importers.statement_line_hash
+    key = f"{date.isoformat()}|{amount:.2f}|{' '.join(description.split()).lower()}|{occurrence}"
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def backfill_content_hash(apps, schema_editor):
+    """
+    Hash the existing statement lines. Rows that are already duplicated (from
+    earlier re-uploads) get increasing occurrence numbers, so they stay
+    distinct and the unique constraint can be added.
+    """
+    BankStatementLine = apps.get_model('accounting', 'BankStatementLine')
+    seen = {}
+    batch = []
+    for line in BankStatementLine.objects.order_by('bank_account_id', 'id').only('id', 'bank_account_id', 'date', 'amount', 'description').iterator(chunk_size=BATCH_SIZE):
+        key = (line.bank_account_id, line.date, line.amount, ' '.join(line.description.split()).lower())
+        seen[key] = seen.get(key, 0) + 1
+        line.content_hash = line_hash(line.date, line.amount, line.description, seen[key])
+        batch.append(line)
+        if len(batch) >= BATCH_SIZE:
+            BankStatementLine.objects.bulk_update(batch, ['content_hash'])
+            batch = []
+    BankStatementLine.objects.bulk_update(batch, ['content_hash'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounting', '0009_exportjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bankstatementline',
+            name='content_hash',
+            field=models.CharField(default='', editable=False, max_length=64),
+            preserve_default=False,
+        ),
+        migrations.RunPython(backfill_content_hash, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='bankstatementline',
+            constraint=models.UniqueConstraint(fields=('bank_account', 'content_hash'), name='bankline_unique_content'),
+        ),
+    ]
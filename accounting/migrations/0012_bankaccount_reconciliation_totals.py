@@ -0,0 +1,39 @@
+# Generated by Django 5.2.6 on 2026-10-18 02:05
+
+from django.db import migrations, models
+from django.db.models import F, Sum
+
+
+def backfill_totals(apps, schema_editor):
+    """Frozen copy of reconciliation.recompute_totals, one bank account at a time."""
+    BankAccount = apps.get_model('accounting', 'BankAccount')
+    BankStatementLine = apps.get_model('accounting', 'BankStatementLine')
+    JournalVoucherLine = apps.get_model('accounting', 'JournalVoucherLine')
+    for bank_account in BankAccount.objects.all():
+        statement = BankStatementLine.objects.filter(bank_account=bank_account).aggregate(t=Sum('amount'))['t'] or 0
+        matched = (BankStatementLine.objects.filter(bank_account=bank_account, matched_journal_line__isnull=False)
+                   .aggregate(t=Sum(F('matched_journal_line__debit_amount') - F('matched_journal_line__credit_amount')))['t'] or 0)
+        grouped = (JournalVoucherLine.objects.filter(reconciliation_group__bank_account=bank_account)
+                   .aggregate(t=Sum(F('debit_amount') - F('credit_amount')))['t'] or 0)
+        BankAccount.objects.filter(pk=bank_account.pk).update(statement_balance=statement, cleared_balance=matched + grouped)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounting', '0011_reconciliationgroup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bankaccount',
+            name='statement_balance',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=19),
+        ),
+        migrations.AddField(
+            model_name='bankaccount',
+            name='cleared_balance',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=19),
+        ),
+        migrations.RunPython(backfill_totals, migrations.RunPython.noop),
+    ]
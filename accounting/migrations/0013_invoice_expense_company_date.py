@@ -0,0 +1,21 @@
+# Generated by Django 5.2.6 on 2026-10-18 01:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounting', '0012_bankaccount_reconciliation_totals'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='expense',
+            index=models.Index(fields=['company', 'expense_date'], name='expense_company_date'),
+        ),
+        migrations.AddIndex(
+            model_name='invoice',
+            index=models.Index(fields=['company', 'invoice_date'], name='invoice_company_date'),
+        ),
+    ]
@@ -20,11 +20,21 @@ class Company(models.Model):
     verification_code = models.CharField(max_length=6, blank=True, null=True)
     is_verified = models.BooleanField(default=False)
 
+    # Bumped whenever posted ledger data changes; part of every report cache key
+    ledger_version = models.PositiveIntegerField(default=0)
+
     created_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        # ledger_version only moves through F() updates (posting.bump_ledger_version). A full-row
+        # save would write back the value loaded with the instance and undo bumps made meanwhile.
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [f.name for f in self._meta.concrete_fields if not f.primary_key and f.name != 'ledger_version']
+        super().save(*args, **kwargs)
+
 # --- CORE FINANCIAL MODELS ---
 class Account(models.Model):
     ACCOUNT_TYPES = [
@@ -225,7 +235,9 @@ class Invoice(models.Model):
     total_amount = models.DecimalField(max_digits=19, decimal_places=2, default=0.00)
     created_at = models.DateTimeField(auto_now_add=True)
     def __str__(self): return f"{self.invoice_number} - {self.customer.name}"
-    class Meta: ordering = ['-invoice_date', '-invoice_number']
+    class Meta:
+        ordering = ['-invoice_date', '-invoice_number']
+        indexes = [models.Index(fields=['company', 'invoice_date'], name='invoice_company_date')]
 
 class InvoiceLine(models.Model):
     company = models.ForeignKey(Company, on_delete=models.CASCADE)
@@ -252,8 +264,28 @@ class JournalVoucher(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     posted_at = models.DateTimeField(null=True, blank=True)
     def __str__(self): return f"{self.jv_number} - {self.description}"
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._line_fields = (instance.__dict__.get('jv_date'), instance.__dict__.get('status'))
+        return instance
+    def save(self, *args, **kwargs):
+        # The lines keep copies of jv_date and status (JournalVoucherLine.posting_date/status)
+        changed = not self._state.adding and getattr(self, '_line_fields', None) != (self.jv_date, self.status)
+        super().save(*args, **kwargs)
+        if changed:
+            self.lines.update(posting_date=self.jv_date, status=self.status)
+        self._line_fields = (self.jv_date, self.status)
     class Meta: ordering = ['-jv_date', '-jv_number']
 
+class JournalVoucherLineManager(models.Manager):
+    def bulk_create(self, objs, *args, **kwargs):
+        # bulk_create skips save(), so the voucher's date/status are copied here
+        objs = list(objs)
+        for obj in objs:
+            obj.copy_voucher_fields()
+        return super().bulk_create(objs, *args, **kwargs)
+
 class JournalVoucherLine(models.Model):
     company = models.ForeignKey(Company, on_delete=models.CASCADE)
     journal_voucher = models.ForeignKey(JournalVoucher, related_name='lines', on_delete=models.CASCADE)
@@ -261,7 +293,39 @@ class JournalVoucherLine(models.Model):
     debit_amount = models.DecimalField(max_digits=19, decimal_places=2, default=0.00)
     credit_amount = models.DecimalField(max_digits=19, decimal_places=2, default=0.00)
     line_description = models.CharField(max_length=255, blank=True)
+    # Copies of the voucher's jv_date and status so ledger queries need no join.
+    # Nullable only so the column can be added to a large table without a rewrite.
+    posting_date = models.DateField(null=True)
+    status = models.CharField(max_length=20, choices=JournalVoucher.JV_STATUSES, default='Draft')
+    reconciliation_group = models.ForeignKey('ReconciliationGroup', on_delete=models.SET_NULL, null=True, blank=True, related_name='journal_lines')
+    objects = JournalVoucherLineManager()
     def __str__(self): return f"Line for JV {self.journal_voucher.jv_number}"
+    def copy_voucher_fields(self):
+        self.posting_date, self.status = self.journal_voucher.jv_date, self.journal_voucher.status
+    def save(self, *args, **kwargs):
+        self.copy_voucher_fields()
+        super().save(*args, **kwargs)
+    class Meta:
+        indexes = [
+            models.Index(fields=['company', 'account', 'posting_date'], name='jvline_company_account_date'),
+            models.Index(fields=['company', 'status', 'posting_date'], name='jvline_company_status_date'),
+        ]
+
+class AccountPeriodBalance(models.Model):
+    """
+    Posted debit/credit totals for one account in one calendar month.
+    Maintained by accounting.ledger whenever a voucher is posted, so reports
+    can read whole months from here instead of rescanning every line.
+    """
+    company = models.ForeignKey(Company, on_delete=models.CASCADE)
+    account = models.ForeignKey(Account, related_name='period_balances', on_delete=models.CASCADE)
+    period = models.DateField(help_text="First day of the month")
+    debit_total = models.DecimalField(max_digits=19, decimal_places=2, default=0.00)
+    credit_total = models.DecimalField(max_digits=19, decimal_places=2, default=0.00)
+    def __str__(self): return f"{self.account.account_number} {self.period:%Y-%m}"
+    class Meta:
+        unique_together = ('account', 'period')
+        ordering = ['period']
 
 # --- BANKING ---
 class BankAccount(models.Model):
@@ -270,7 +334,13 @@ class BankAccount(models.Model):
     account_number = models.CharField(max_length=50)
     gl_account = models.OneToOneField(Account, on_delete=models.PROTECT, limit_choices_to={'account_type': 'Asset'})
     currency = models.CharField(max_length=10, default='USD')
+    # Running totals kept by accounting.reconciliation: every imported statement line,
+    # and the GL side of every reconciled line (1:1 or grouped)
+    statement_balance = models.DecimalField(max_digits=19, decimal_places=2, default=0)
+    cleared_balance = models.DecimalField(max_digits=19, decimal_places=2, default=0)
     def __str__(self): return f"{self.name} ({self.account_number})"
+    @property
+    def unreconciled_amount(self): return self.statement_balance - self.cleared_balance
 
 class BankStatementLine(models.Model):
     company = models.ForeignKey(Company, on_delete=models.CASCADE)
@@ -279,7 +349,22 @@ class BankStatementLine(models.Model):
     description = models.CharField(max_length=255)
     amount = models.DecimalField(max_digits=19, decimal_places=2)
     matched_journal_line = models.OneToOneField(JournalVoucherLine, on_delete=models.SET_NULL, null=True, blank=True, related_name='reconciliation_match')
+    # Many-to-many matches (one deposit settling several payments); a line is in a group or matched 1:1, never both
+    reconciliation_group = models.ForeignKey('ReconciliationGroup', on_delete=models.SET_NULL, null=True, blank=True, related_name='statement_lines')
+    # sha256 of date, amount, description and occurrence number; see importers.statement_line_hash
+    content_hash = models.CharField(max_length=64, editable=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['bank_account', 'content_hash'], name='bankline_unique_content')]
+
+class ReconciliationGroup(models.Model):
+    """Statement lines and journal lines reconciled together; the two sides total the same amount."""
+    company = models.ForeignKey(Company, on_delete=models.CASCADE)
+    bank_account = models.ForeignKey(BankAccount, on_delete=models.CASCADE, related_name='reconciliation_groups')
+    amount = models.DecimalField(max_digits=19, decimal_places=2)
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    def __str__(self): return f"Group {self.pk} ({self.amount})"
 
 # --- EXPENSES ---
 class Expense(models.Model):
@@ -301,7 +386,9 @@ class Expense(models.Model):
     status = models.CharField(max_length=20, choices=EXPENSE_STATUSES, default='Draft')
     created_at = models.DateTimeField(auto_now_add=True)
     def __str__(self): return f"Exp #{self.id} - {self.vendor.name}"
-    class Meta: ordering = ['-expense_date']
+    class Meta:
+        ordering = ['-expense_date']
+        indexes = [models.Index(fields=['company', 'expense_date'], name='expense_company_date')]
 
 class ExpenseLine(models.Model):
     company = models.ForeignKey(Company, on_delete=models.CASCADE)
@@ -397,4 +484,36 @@ class CompanySettings(models.Model):
     @classmethod
     def load(cls):
         obj, created = cls.objects.get_or_create(pk=1)
-        return obj
\ No newline at end of file
+        return obj
+# --- EXPORTS ---
+class ExportJob(models.Model):
+    """
+    A large export produced in the background by `manage.py run_export_jobs`
+    and written to the media storage under exports/.
+    """
+    KINDS = [
+        ('vouchers', 'Journal Vouchers'),
+        ('account_activity', 'General Ledger Detail'),
+        ('trial_balance', 'Trial Balance'),
+    ]
+    STATUSES = [('Pending', 'Pending'), ('Running', 'Running'), ('Done', 'Done'), ('Failed', 'Failed')]
+    company = models.ForeignKey(Company, on_delete=models.CASCADE)
+    requested_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    kind = models.CharField(max_length=30, choices=KINDS)
+    params = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=20, choices=STATUSES, default='Pending')
+    rows_written = models.PositiveIntegerField(default=0)
+    total_rows = models.PositiveIntegerField(null=True, blank=True)
+    file = models.FileField(upload_to='exports/', blank=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    def __str__(self): return f"{self.get_kind_display()} export #{self.pk} ({self.status})"
+    @property
+    def percent(self):
+        if self.status == 'Done': return 100
+        return min(99, int(self.rows_written * 100 / self.total_rows)) if self.total_rows else 0
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [models.Index(fields=['status', 'created_at'], name='exportjob_status_created')]
@@ -0,0 +1,122 @@
+"""
+Posting service.
+
+Every flow that puts a voucher into the general ledger goes through here.
+Balance changes are applied as database-side increments
+(current_balance = current_balance + delta), grouped per account and sent
+as a single UPDATE per voucher. Nothing is read into Python and written
+back, so concurrent workers cannot overwrite each other's postings.
+
+Callers are expected to be inside their own transaction.atomic block; the
+functions here open a savepoint so they are also safe to call on their own.
+"""
+import decimal
+
+from django.db import transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from . import ledger
+from .models import Account, Company, JournalVoucher, JournalVoucherLine
+
+ZERO = decimal.Decimal(0)
+
+
+def balance_deltas(voucher):
+    """
+    {account_id: change to current_balance} for a voucher's lines, signed by
+    each account's normal balance. One grouped query.
+    """
+    rows = (JournalVoucherLine.objects.filter(journal_voucher=voucher)
+            .values('account_id', 'account__normal_balance')
+            .annotate(debit=Sum('debit_amount'), credit=Sum('credit_amount'))
+            .order_by())
+    deltas = {}
+    for r in rows:
+        net = (r['debit'] or ZERO) - (r['credit'] or ZERO)
+        deltas[r['account_id']] = net if r['account__normal_balance'] == 'Debit' else -net
+    return deltas
+
+def apply_balance_deltas(deltas):
+    """
+    Add each delta to Account.current_balance with one UPDATE ... CASE
+    statement for all touched accounts. Nothing is read back into Python.
+    """
+    deltas = {(account_id,): delta for account_id, delta in deltas.items() if delta}
+    ledger.increment_by_case(Account.objects.filter(pk__in=[k[0] for k in deltas]), ['id'], {'current_balance': deltas})
+
+@transaction.atomic
+def apply_posting(voucher):
+    """
+    Apply a voucher that is already saved as 'Posted' (and whose lines exist)
+    to account balances and the monthly period balances.
+    """
+    apply_balance_deltas(balance_deltas(voucher))
+    ledger.record_posting(voucher)
+    bump_ledger_version(voucher.company_id)
+
+def bump_ledger_version(company_id):
+    """
+    Invalidate the company's cached reports. Runs after the account and
+    period rows are locked, so every posting takes its locks in the same order.
+    """
+    Company.objects.filter(pk=company_id).update(ledger_version=F('ledger_version') + 1)
+
+@transaction.atomic
+def post_draft(voucher):
+    """
+    Move a Draft voucher to Posted and apply it. The status flip is a
+    conditional UPDATE, so if two requests post the same draft at once only
+    one of them applies the lines. Returns True if this call posted it.
+    """
+    now = timezone.now()
+    if not JournalVoucher.objects.filter(pk=voucher.pk, status='Draft').update(status='Posted', posted_at=now):
+        return False
+    voucher.status, voucher.posted_at = 'Posted', now
+    JournalVoucherLine.objects.filter(journal_voucher=voucher).update(status='Posted')
+    apply_posting(voucher)
+    return True
+
+
+# --- RECALCULATION ---
+# Account types whose normal balance is Debit; everything else is Credit
+DEBIT_NORMAL_TYPES = ['Bank', 'Accounts Receivable', 'Other Current Assets', 'Fixed Assets', 'Other Assets', 'Cost of Goods Sold', 'Expenses', 'Other Expense']
+
+def recalculate_balances(company, dry_run=False):
+    """
+    Reset normal_balance and current_balance of every account of the company
+    from the posted journal lines: one grouped aggregation and one
+    bulk_update, however many accounts there are.
+
+    The accounts are locked before the lines are summed so a voucher posted
+    meanwhile cannot be lost. With dry_run=True nothing is locked or written.
+    Returns [(account, stored_balance, ledger_balance)] for every account
+    whose stored balance drifted from the ledger.
+    """
+    with transaction.atomic():
+        accounts = Account.objects.filter(company=company).order_by('id')
+        if not dry_run:
+            accounts = accounts.select_for_update()
+        accounts = list(accounts)
+
+        totals = {
+            r['account_id']: ((r['debit'] or ZERO), (r['credit'] or ZERO))
+            for r in JournalVoucherLine.objects.filter(company=company, status='Posted')
+                     .values('account_id').annotate(debit=Sum('debit_amount'), credit=Sum('credit_amount')).order_by()
+        }
+
+        drift, changed = [], []
+        for acc in accounts:
+            normal = 'Debit' if acc.account_type in DEBIT_NORMAL_TYPES else 'Credit'
+            d, c = totals.get(acc.id, (ZERO, ZERO))
+            balance = (d - c) if normal == 'Debit' else (c - d)
+            if balance != acc.current_balance:
+                drift.append((acc, acc.current_balance, balance))
+            if balance != acc.current_balance or normal != acc.normal_balance:
+                acc.current_balance, acc.normal_balance = balance, normal
+                changed.append(acc)
+
+        if not dry_run and changed:
+            Account.objects.bulk_update(changed, ['current_balance', 'normal_balance'], batch_size=500)
+            bump_ledger_version(company.pk)
+    return drift
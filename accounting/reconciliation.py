@@ -0,0 +1,387 @@
+"""
+Bank reconciliation matching.
+
+auto_match pairs unmatched statement lines of a bank account with posted,
+unreconciled journal lines on its GL account. Both sides are read with one
+query each; GL lines are bucketed by amount and each bucket is kept sorted
+by date, so a statement line finds its nearest candidate with a binary
+search instead of a scan of every open GL line. Matches are written with a
+single bulk_update.
+
+Lines that still have no partner can be reconciled in groups
+(ReconciliationGroup): one statement line against several GL lines or the
+reverse, proposed by a bounded subset-sum search, or any N:M selection made
+by hand through create_group.
+
+Every function that reconciles or un-reconciles lines also moves
+BankAccount.cleared_balance by the amount involved (and statement imports
+move statement_balance), so the workspace totals are read from one row
+instead of being summed over the account's history.
+"""
+import bisect
+import collections
+import datetime
+import decimal
+
+from django.db import transaction
+from django.db.models import Count, F, Q, Sum
+
+from . import ledger, report_cache
+from .models import BankAccount, BankStatementLine, JournalVoucherLine, ReconciliationGroup
+
+DEFAULT_WINDOW_DAYS = 3
+PREVIEW_ROWS = 1000  # proposals listed on the preview page; all of them are saved
+MAX_GROUP_LINES = 6
+SEARCH_BUDGET = 20000  # subset-sum nodes tried per target line before giving up
+PAGE_SIZE = 100
+ZERO = decimal.Decimal(0)
+
+Match = collections.namedtuple('Match', 'statement_line_id journal_line_id date description amount gl_date jv_number')
+GroupProposal = collections.namedtuple('GroupProposal', 'statement_line_ids journal_line_ids date amount')
+
+
+def open_statement_lines(bank_account):
+    return BankStatementLine.objects.filter(bank_account=bank_account, matched_journal_line__isnull=True, reconciliation_group__isnull=True)
+
+def open_journal_lines(bank_account):
+    """Posted lines on the bank's GL account that no statement line is matched to yet."""
+    return JournalVoucherLine.objects.filter(
+        company_id=bank_account.company_id, account_id=bank_account.gl_account_id,
+        status='Posted', reconciliation_match__isnull=True, reconciliation_group__isnull=True,
+    )
+
+def skip_to_open(skip, j):
+    """
+    The nearest open position from j in a skip array, where consumed
+    positions point at their neighbour and open ones at themselves. Path
+    compression keeps repeated lookups close to O(1).
+    """
+    root = j
+    while skip[root] != root:
+        root = skip[root]
+    while skip[j] != root:
+        skip[j], j = root, skip[j]
+    return root
+
+def propose_matches(bank_account, window_days=DEFAULT_WINDOW_DAYS):
+    """
+    One-to-one matches on exact amount (deposits against debits, payments
+    against credits) with posting dates at most window_days apart.
+
+    Statement lines are taken in (date, id) order and each gets the open GL
+    line of the same amount whose date is nearest, ties going to the earlier
+    date and then the lower id, so the same data always gives the same
+    matches. Matched GL lines are not removed from their bucket but skipped
+    through two skip arrays per bucket (forward, and backward shifted by one
+    so position 0 means "none"), so the whole run is O((n + m) log m) for n
+    statement lines and m GL lines.
+    """
+    buckets = collections.defaultdict(list)
+    gl_lines = (open_journal_lines(bank_account).filter(posting_date__isnull=False)
+                .values_list('posting_date', 'id', 'debit_amount', 'credit_amount', 'journal_voucher__jv_number')
+                .order_by('posting_date', 'id'))
+    for gl_date, gl_id, debit, credit, jv_number in gl_lines.iterator(2000):
+        buckets[debit - credit].append((gl_date, gl_id, jv_number))
+    skips = {amount: (list(range(len(b) + 1)), list(range(len(b) + 1))) for amount, b in buckets.items()}
+
+    matches = []
+    statement_lines = open_statement_lines(bank_account).values_list('id', 'date', 'description', 'amount').order_by('date', 'id')
+    for line_id, date, description, amount in statement_lines.iterator(2000):
+        bucket = buckets.get(amount)
+        if not bucket:
+            continue
+        forward, backward = skips[amount]
+        i = bisect.bisect_left(bucket, (date,))
+        # the nearest candidates are the first open line on or after the date and the first open line of the latest earlier date
+        candidates = [j for j in (skip_to_open(forward, i),) if j < len(bucket)]
+        before = skip_to_open(backward, i)
+        if before:
+            candidates.append(skip_to_open(forward, bisect.bisect_left(bucket, (bucket[before - 1][0],))))
+        if not candidates:
+            continue
+        days, (gl_date, gl_id, jv_number), j = min((abs((bucket[j][0] - date).days), bucket[j], j) for j in candidates)
+        if days > window_days:
+            continue
+        forward[j], backward[j + 1] = j + 1, j
+        matches.append(Match(line_id, gl_id, date, description, amount, gl_date, jv_number))
+    return matches
+
+def auto_match(bank_account, window_days=DEFAULT_WINDOW_DAYS, preview=False):
+    """
+    Propose matches and, unless preview is set, save them all with one
+    bulk_update. The open statement lines are locked first, so two runs for
+    the same account cannot match a line twice. Returns the list of Matches.
+    """
+    with transaction.atomic():
+        if not preview:
+            list(open_statement_lines(bank_account).select_for_update().values_list('id', flat=True))
+        matches = propose_matches(bank_account, window_days)
+        if not preview:
+            BankStatementLine.objects.bulk_update(
+                [BankStatementLine(id=m.statement_line_id, matched_journal_line_id=m.journal_line_id) for m in matches],
+                ['matched_journal_line'], batch_size=500,
+            )
+            adjust_totals(bank_account, cleared=sum((m.amount for m in matches), ZERO))
+    return matches
+
+def match_pair(bank_account, statement_line_id, journal_line_id):
+    """Match one open statement line to one open GL line of the same amount; ValueError otherwise."""
+    with transaction.atomic():
+        statement_line = open_statement_lines(bank_account).select_for_update().filter(pk=statement_line_id).first()
+        journal_line = open_journal_lines(bank_account).select_for_update().filter(pk=journal_line_id).first()
+        if statement_line is None or journal_line is None:
+            raise ValueError("One of these lines is already reconciled.")
+        gl_amount = journal_line.debit_amount - journal_line.credit_amount
+        if statement_line.amount != gl_amount:
+            raise ValueError(f"Mismatch: Bank {statement_line.amount} vs GL {gl_amount}")
+        statement_line.matched_journal_line = journal_line
+        statement_line.save(update_fields=['matched_journal_line'])
+        adjust_totals(bank_account, cleared=gl_amount)
+    return statement_line
+
+def unmatch_pair(bank_account, statement_line_id):
+    """Undo a 1:1 match. Returns False if the line was not matched."""
+    with transaction.atomic():
+        statement_line = (BankStatementLine.objects.select_for_update()
+                          .filter(bank_account=bank_account, pk=statement_line_id, matched_journal_line__isnull=False).first())
+        if statement_line is None:
+            return False
+        statement_line.matched_journal_line = None
+        statement_line.save(update_fields=['matched_journal_line'])
+        adjust_totals(bank_account, cleared=-statement_line.amount)
+    return True
+
+
+# --- GROUP MATCHING ---
+def find_subset(target, amounts, max_size=MAX_GROUP_LINES, budget=SEARCH_BUDGET):
+    """
+    Indexes of two or more amounts summing exactly to target, or None.
+    amounts are positive integers (cents) sorted largest first, so the
+    depth-first search can prune: an amount larger than what is left is
+    skipped, and a branch stops when even the largest remaining amounts
+    (or all of them) cannot make up the rest. Equal amounts are tried once
+    per level. At most `budget` nodes are visited.
+    """
+    suffix = [0] * (len(amounts) + 1)
+    for i in range(len(amounts) - 1, -1, -1):
+        suffix[i] = suffix[i + 1] + amounts[i]
+    nodes = 0
+
+    def search(start, remaining, chosen):
+        nonlocal nodes
+        previous = None
+        for i in range(start, len(amounts)):
+            amount = amounts[i]
+            if amount > remaining or amount == previous:
+                continue
+            if suffix[i] < remaining or amount * (max_size - len(chosen)) < remaining:
+                return None
+            nodes += 1
+            if nodes > budget:
+                return None
+            previous = amount
+            if amount == remaining:
+                if chosen:
+                    return chosen + [i]
+            elif len(chosen) + 1 < max_size:
+                found = search(i + 1, remaining - amount, chosen + [i])
+                if found:
+                    return found
+        return None
+
+    return search(0, target, []) if target > 0 else None
+
+def cents(amount):
+    return int(amount.scaleb(2))
+
+def group_targets(targets, pool, window_days, used):
+    """
+    (target id, [pool ids]) for targets (date, id, cents) that a set of pool
+    lines (sorted by (date, id)) of the same sign totals exactly. Pool lines
+    taken by one group are added to `used` and not offered again.
+    """
+    dates = [p[0] for p in pool]
+    for date, target_id, amount in targets:
+        lo = bisect.bisect_left(dates, date - datetime.timedelta(days=window_days))
+        hi = bisect.bisect_right(dates, date + datetime.timedelta(days=window_days))
+        candidates = sorted(
+            (abs(p[2]), p[0], p[1]) for p in pool[lo:hi]
+            if p[1] not in used and (p[2] > 0) == (amount > 0) and abs(p[2]) <= abs(amount)
+        )[::-1]
+        found = find_subset(abs(amount), [c[0] for c in candidates])
+        if found:
+            ids = [candidates[i][2] for i in found]
+            used.update(ids)
+            yield target_id, ids
+
+def propose_groups(bank_account, window_days=DEFAULT_WINDOW_DAYS, exclude_statement=(), exclude_journal=()):
+    """
+    One-to-many proposals for open lines: a statement line settled by
+    several GL lines (a deposit of many receipts), then a GL line paid by
+    several statement lines. exclude_* are ids already claimed, e.g. by
+    one-to-one matches proposed in the same run.
+    """
+    statement = [(d, i, cents(a)) for i, d, a in open_statement_lines(bank_account)
+                 .exclude(id__in=list(exclude_statement)).values_list('id', 'date', 'amount').order_by('date', 'id')]
+    journal = [(d, i, cents(dr - cr)) for i, d, dr, cr in open_journal_lines(bank_account).filter(posting_date__isnull=False)
+               .exclude(id__in=list(exclude_journal)).values_list('id', 'posting_date', 'debit_amount', 'credit_amount').order_by('posting_date', 'id')]
+    by_id = {('s', i): (d, c) for d, i, c in statement}
+    by_id.update({('j', i): (d, c) for d, i, c in journal})
+
+    proposals, used_statement, used_journal = [], set(), set()
+    for statement_id, journal_ids in group_targets(statement, journal, window_days, used_journal):
+        used_statement.add(statement_id)
+        date, amount = by_id[('s', statement_id)]
+        proposals.append(GroupProposal([statement_id], journal_ids, date, decimal.Decimal(amount).scaleb(-2)))
+    open_journal = [j for j in journal if j[1] not in used_journal]
+    for journal_id, statement_ids in group_targets(open_journal, statement, window_days, used_statement):
+        date, amount = by_id[('j', journal_id)]
+        proposals.append(GroupProposal(statement_ids, [journal_id], date, decimal.Decimal(amount).scaleb(-2)))
+    return proposals
+
+def save_groups(bank_account, proposals, user=None):
+    """Create one ReconciliationGroup per proposal and attach its lines: one bulk_create and two bulk_updates."""
+    groups = ReconciliationGroup.objects.bulk_create([
+        ReconciliationGroup(company_id=bank_account.company_id, bank_account=bank_account, amount=p.amount, created_by=user)
+        for p in proposals
+    ], batch_size=500)
+    BankStatementLine.objects.bulk_update([
+        BankStatementLine(id=line_id, reconciliation_group_id=g.id) for g, p in zip(groups, proposals) for line_id in p.statement_line_ids
+    ], ['reconciliation_group'], batch_size=500)
+    JournalVoucherLine.objects.bulk_update([
+        JournalVoucherLine(id=line_id, reconciliation_group_id=g.id) for g, p in zip(groups, proposals) for line_id in p.journal_line_ids
+    ], ['reconciliation_group'], batch_size=500)
+    adjust_totals(bank_account, cleared=sum((p.amount for p in proposals), ZERO))
+    return groups
+
+def auto_reconcile(bank_account, window_days=DEFAULT_WINDOW_DAYS, preview=False, user=None):
+    """
+    auto_match followed by group proposals over whatever is still open.
+    Returns (matches, group proposals); with preview=True nothing is saved.
+    """
+    with transaction.atomic():
+        if not preview:
+            list(open_statement_lines(bank_account).select_for_update().values_list('id', flat=True))
+        matches = auto_match(bank_account, window_days, preview)
+        proposals = propose_groups(bank_account, window_days,
+                                   [m.statement_line_id for m in matches], [m.journal_line_id for m in matches])
+        if not preview:
+            save_groups(bank_account, proposals, user)
+    return matches, proposals
+
+def create_group(bank_account, statement_line_ids, journal_line_ids, user=None):
+    """
+    Reconcile the chosen statement lines and GL lines as one group. Every
+    line must still be open and the two sides must total the same amount;
+    otherwise ValueError is raised and nothing changes.
+    """
+    with transaction.atomic():
+        statement = list(open_statement_lines(bank_account).filter(id__in=statement_line_ids).select_for_update())
+        journal = list(open_journal_lines(bank_account).filter(id__in=journal_line_ids).select_for_update())
+        if not statement or not journal:
+            raise ValueError("Select at least one bank line and one GL line.")
+        if len(statement) != len(set(statement_line_ids)) or len(journal) != len(set(journal_line_ids)):
+            raise ValueError("Some of the selected lines are already reconciled.")
+        bank_total = sum(l.amount for l in statement)
+        gl_total = sum(l.debit_amount - l.credit_amount for l in journal)
+        if bank_total != gl_total:
+            raise ValueError(f"Mismatch: Bank {bank_total} vs GL {gl_total}")
+        group = ReconciliationGroup.objects.create(company_id=bank_account.company_id, bank_account=bank_account,
+                                                   amount=bank_total, created_by=user)
+        BankStatementLine.objects.filter(id__in=[l.id for l in statement]).update(reconciliation_group=group)
+        JournalVoucherLine.objects.filter(id__in=[l.id for l in journal]).update(reconciliation_group=group)
+        adjust_totals(bank_account, cleared=gl_total)
+    return group
+
+def dissolve_group(group):
+    """Reopen every line of a group (their foreign keys are SET_NULL) and delete it."""
+    with transaction.atomic():
+        if ReconciliationGroup.objects.filter(pk=group.pk).delete()[0]:
+            adjust_totals(group.bank_account, cleared=-group.amount)
+
+
+# --- RUNNING TOTALS ---
+def adjust_totals(bank_account, statement=ZERO, cleared=ZERO):
+    """
+    Add to the bank account's statement_balance / cleared_balance with one
+    UPDATE; nothing is read back. Also invalidates the company's cached reports.
+    """
+    changes = {}
+    if statement:
+        changes['statement_balance'] = F('statement_balance') + statement
+    if cleared:
+        changes['cleared_balance'] = F('cleared_balance') + cleared
+    if changes:
+        BankAccount.objects.filter(pk=bank_account.pk).update(**changes)
+        report_cache.invalidate(bank_account.company_id)
+
+def recompute_totals(bank_account):
+    """(statement_balance, cleared_balance) summed from the lines, to check the running totals against."""
+    statement = BankStatementLine.objects.filter(bank_account=bank_account).aggregate(t=Sum('amount'))['t'] or ZERO
+    matched = (BankStatementLine.objects.filter(bank_account=bank_account, matched_journal_line__isnull=False)
+               .aggregate(t=Sum(F('matched_journal_line__debit_amount') - F('matched_journal_line__credit_amount')))['t'] or ZERO)
+    grouped = (JournalVoucherLine.objects.filter(reconciliation_group__bank_account=bank_account)
+               .aggregate(t=Sum(F('debit_amount') - F('credit_amount')))['t'] or ZERO)
+    return statement, matched + grouped
+
+
+# --- WORKSPACE PAGES ---
+def keyset_page(rows, date_field, after=None, page_size=None, descending=False):
+    """
+    One page of a values() queryset in (date, id) order after the (date, id)
+    cursor `after`. Returns (rows, next_cursor); next_cursor is None on the
+    last page.
+    """
+    page_size = page_size or PAGE_SIZE
+    op = 'lt' if descending else 'gt'
+    if after:
+        rows = rows.filter(Q(**{f'{date_field}__{op}': after[0]}) | Q(**{date_field: after[0], f'id__{op}': after[1]}))
+    order = [f'-{date_field}', '-id'] if descending else [date_field, 'id']
+    rows = list(rows.order_by(*order)[:page_size + 1])
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = f"{rows[-1][date_field].isoformat()}.{rows[-1]['id']}"
+    return rows, next_cursor
+
+def in_range(lines, date_field, start=None, end=None):
+    start, end = ledger.to_date(start), ledger.to_date(end)
+    if start:
+        lines = lines.filter(**{f'{date_field}__gte': start})
+    if end:
+        lines = lines.filter(**{f'{date_field}__lte': end})
+    return lines
+
+def statement_page(bank_account, after=None, start=None, end=None):
+    """Open statement lines, oldest first."""
+    lines = in_range(open_statement_lines(bank_account), 'date', start, end)
+    return keyset_page(lines.values('id', 'date', 'description', 'amount'), 'date', after)
+
+def journal_page(bank_account, after=None, start=None, end=None):
+    """Open posted GL lines, oldest first, with their voucher's number and description joined in."""
+    lines = in_range(open_journal_lines(bank_account), 'posting_date', start, end)
+    return keyset_page(lines.values(
+        'id', 'posting_date', 'debit_amount', 'credit_amount', 'line_description', 'journal_voucher_id',
+        jv_number=F('journal_voucher__jv_number'), description=F('journal_voucher__description'),
+    ), 'posting_date', after)
+
+def matched_page(bank_account, after=None, start=None, end=None):
+    """1:1 matched statement lines, newest first, with the matched voucher's number joined in."""
+    lines = in_range(BankStatementLine.objects.filter(bank_account=bank_account, matched_journal_line__isnull=False), 'date', start, end)
+    return keyset_page(lines.values(
+        'id', 'date', 'description', 'amount', jv_number=F('matched_journal_line__journal_voucher__jv_number'),
+    ), 'date', after, descending=True)
+
+PAGES = {'bank': statement_page, 'gl': journal_page, 'matched': matched_page}
+
+def recent_groups(bank_account, limit=50):
+    """The latest groups with their line counts: three queries however many groups the account has."""
+    groups = list(ReconciliationGroup.objects.filter(bank_account=bank_account).order_by('-created_at', '-id')[:limit])
+    ids = [g.id for g in groups]
+    bank_counts = dict(BankStatementLine.objects.filter(reconciliation_group__in=ids).values_list('reconciliation_group')
+                       .annotate(n=Count('id')).order_by())
+    gl_counts = dict(JournalVoucherLine.objects.filter(reconciliation_group__in=ids).values_list('reconciliation_group')
+                     .annotate(n=Count('id')).order_by())
+    for g in groups:
+        g.bank_count, g.gl_count = bank_counts.get(g.id, 0), gl_counts.get(g.id, 0)
+    return groups
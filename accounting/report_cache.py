@@ -0,0 +1,62 @@
+"""
+Report cache.
+
+Dashboard, statement, trial balance and budget variance results are cached
+under (company, report, params, company.ledger_version). Anything that can
+change a report bumps the version: posting does it in apply_posting, saves
+and deletes of report source rows do it through the receivers in signals.py,
+and bulk writes that send no signals (reconciliation, balance recalculation,
+the journal lines written by importers.insert_lines for voucher imports and
+seeding) call invalidate() themselves. Entries for an older version are never read
+again and simply expire, so nothing is ever deleted by key.
+
+Results go to the cache alias named by settings.REPORT_CACHE_ALIAS
+('reports' by default) when the project configures one, so several workers
+can share them through Redis or memcached. Without it they are kept in a
+bounded in-process LocMemCache, which evicts the least recently used
+entries once MAX_ENTRIES is reached.
+
+The same version gives report and export views their ETags (etag()), so
+a client revalidating an unchanged report gets a 304 before anything is
+computed.
+"""
+import hashlib
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+
+from . import posting
+
+TIMEOUT = 60 * 60
+MAX_ENTRIES = 1000
+
+_local = LocMemCache('accounting-reports', {'TIMEOUT': TIMEOUT, 'OPTIONS': {'MAX_ENTRIES': MAX_ENTRIES, 'CULL_FREQUENCY': 10}})
+
+def get_cache():
+    alias = getattr(settings, 'REPORT_CACHE_ALIAS', 'reports')
+    return caches[alias] if alias in settings.CACHES else _local
+
+def report_key(company, report, params=()):
+    """Model instances stand for their pk and dates for their ISO string, so '2024-01-31' and date(2024, 1, 31) share a key."""
+    raw = '|'.join(str(getattr(p, 'pk', p)) for p in params)
+    digest = hashlib.sha1(raw.encode()).hexdigest()[:20]
+    return f"report:{company.pk}:{company.ledger_version}:{report}:{digest}"
+
+def etag(company, *params):
+    """Opaque ETag for a response built from the company's ledger at its current version."""
+    return hashlib.sha1(report_key(company, 'etag', params).encode()).hexdigest()
+
+def cached_report(company, report, compute, *params):
+    """compute(company, *params), computed once per ledger version."""
+    return get_cache().get_or_set(report_key(company, report, params), lambda: compute(company, *params), TIMEOUT)
+
+def invalidate(company_id):
+    """
+    Bump the company's ledger version once the current transaction commits
+    (immediately in autocommit). Bumping after the commit keeps the company
+    row out of the transaction's locks, and a report computed in between
+    reads the new rows, so nothing stale is cached under the new version.
+    """
+    transaction.on_commit(lambda: posting.bump_ledger_version(company_id))
@@ -0,0 +1,232 @@
+"""
+Synthetic tenant data, for reproducing production volumes locally.
+
+seed_company() fills one new company with a chart of accounts, customers,
+vendors, projects, products and stock, invoices, expenses, purchase orders,
+fixed assets, a budget, a bank account with statement lines and a journal of
+balanced vouchers. Every value is drawn from a random.Random the caller
+seeds, so the same seed, profile and end date always give the same data.
+
+The journal is written the way the voucher importer writes it: vouchers with
+bulk_create, their lines as DB-ready tuples with one executemany per batch
+(importers.insert_lines), so millions of lines load in minutes. Period
+balances and account balances are rebuilt once at the end.
+
+Values that are unique across the whole database (account numbers, names,
+SKUs and document numbers) carry the company id.
+"""
+import datetime
+import decimal
+
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.utils import timezone
+
+from . import importers, ledger, posting
+from .models import (
+    Account, BankAccount, BankStatementLine, Budget, BudgetItem, Category, Company, Customer, Expense, ExpenseLine,
+    FixedAsset, Invoice, InvoiceLine, JournalVoucher, Product, Project, PurchaseOrder, PurchaseOrderLine, StockItem,
+    Vendor, Warehouse,
+)
+
+BATCH_LINES = 20000
+CENT = decimal.Decimal('0.01')
+ZERO = decimal.Decimal(0)
+
+PROFILES = {
+    'small': {'days': 365, 'customers': 25, 'vendors': 25, 'projects': 5, 'products': 40, 'invoices': 300, 'expenses': 300,
+              'purchase_orders': 60, 'assets': 15, 'vouchers': 2000, 'statement_lines': 500},
+    'medium': {'days': 730, 'customers': 250, 'vendors': 200, 'projects': 40, 'products': 400, 'invoices': 5000, 'expenses': 5000,
+               'purchase_orders': 1000, 'assets': 100, 'vouchers': 100000, 'statement_lines': 20000},
+    'huge': {'days': 1095, 'customers': 2000, 'vendors': 1500, 'projects': 200, 'products': 3000, 'invoices': 50000, 'expenses': 50000,
+             'purchase_orders': 10000, 'assets': 500, 'vouchers': 1100000, 'statement_lines': 200000},
+}
+
+# (number, name, account_type); normal balances follow posting.DEBIT_NORMAL_TYPES
+CHART_OF_ACCOUNTS = [
+    ('1000', 'Operating Bank', 'Bank'), ('1010', 'Petty Cash', 'Bank'), ('1100', 'Accounts Receivable', 'Accounts Receivable'),
+    ('1200', 'Inventory', 'Other Current Assets'), ('1300', 'Prepaid Expenses', 'Other Current Assets'),
+    ('1500', 'Equipment', 'Fixed Assets'), ('1510', 'Accumulated Depreciation', 'Fixed Assets'),
+    ('2000', 'Accounts Payable', 'Accounts Payable'), ('2100', 'Company Card', 'Credit Card'),
+    ('2200', 'Sales Tax Payable', 'Other Current Liabilities'), ('2300', 'Payroll Liabilities', 'Other Current Liabilities'),
+    ('2700', 'Bank Loan', 'Long Term Liabilities'), ('3000', "Owner's Equity", 'Equity'), ('3100', 'Retained Earnings', 'Equity'),
+    ('4000', 'Product Sales', 'Income'), ('4100', 'Service Revenue', 'Income'), ('4900', 'Interest Income', 'Other Income'),
+    ('5000', 'Cost of Goods Sold', 'Cost of Goods Sold'), ('6000', 'Rent', 'Expenses'), ('6100', 'Salaries', 'Expenses'),
+    ('6200', 'Utilities', 'Expenses'), ('6300', 'Office Supplies', 'Expenses'), ('6400', 'Marketing', 'Expenses'),
+    ('6500', 'Travel', 'Expenses'), ('6600', 'Professional Fees', 'Expenses'), ('6700', 'Insurance', 'Expenses'),
+    ('6800', 'Depreciation Expense', 'Expenses'), ('7000', 'Interest Expense', 'Other Expense'),
+]
+OPERATING_EXPENSES = ['6000', '6200', '6300', '6400', '6500', '6600', '6700']
+
+# Voucher shapes: (description, weight, debit accounts, credit accounts, amount range in whole units)
+ENTRY_KINDS = [
+    ('Sale', 30, ['1100'], ['4000', '4100', '2200'], (50, 5000)),
+    ('Customer receipt', 25, ['1000'], ['1100'], (50, 5000)),
+    ('Vendor bill', 20, OPERATING_EXPENSES, ['2000'], (20, 3000)),
+    ('Vendor payment', 12, ['2000'], ['1000'], (20, 3000)),
+    ('Card spend', 6, OPERATING_EXPENSES, ['2100'], (5, 500)),
+    ('Payroll', 4, ['6100'], ['2300', '1000'], (2000, 40000)),
+    ('Cost of sales', 3, ['5000'], ['1200'], (20, 2000)),
+]
+DRAFT_RATE = 0.02
+
+
+def split(rng, cents, parts):
+    """`cents` split into `parts` positive integers that add up to it."""
+    parts = max(1, min(parts, cents))
+    cuts = sorted(rng.sample(range(1, cents), parts - 1)) if parts > 1 else []
+    return [b - a for a, b in zip([0] + cuts, cuts + [cents])]
+
+def money(cents):
+    return (decimal.Decimal(cents) * CENT).quantize(CENT)
+
+def seed_company(rng, index, profile, end_date, password, log=lambda message: None):
+    """Create and fill one company; returns it. `profile` is a PROFILES entry."""
+    size = PROFILES[profile] if isinstance(profile, str) else profile
+    start_date = end_date - datetime.timedelta(days=size['days'] - 1)
+    day = lambda i, count: start_date + datetime.timedelta(days=i * size['days'] // max(count, 1))
+
+    with transaction.atomic():
+        user = User.objects.create_user(f"seed-{index}", password=password)
+        company = Company.objects.create(name=f"Seed Company {index}", owner=user)
+        tag = f"S{company.pk}"
+        accounts = {number: acc for number, acc in zip((n for n, _, _ in CHART_OF_ACCOUNTS), Account.objects.bulk_create([
+            Account(company=company, account_number=f"{number}-{tag}", account_name=name, account_type=acc_type,
+                    normal_balance='Debit' if acc_type in posting.DEBIT_NORMAL_TYPES else 'Credit')
+            for number, name, acc_type in CHART_OF_ACCOUNTS
+        ]))}
+        customers = Customer.objects.bulk_create([
+            Customer(company=company, name=f"Customer {tag}-{i}", email=f"billing{i}@customer{i}.example") for i in range(size['customers'])])
+        vendors = Vendor.objects.bulk_create([Vendor(company=company, name=f"Vendor {tag}-{i}") for i in range(size['vendors'])])
+        projects = Project.objects.bulk_create([
+            Project(company=company, name=f"Project {i}", code=f"{tag}-P{i}", customer=rng.choice(customers),
+                    status=rng.choice(['In Progress', 'In Progress', 'Completed', 'Not Started'])) for i in range(size['projects'])])
+        log(f"{company.name}: chart of accounts, {len(customers)} customers, {len(vendors)} vendors")
+
+        category = Category.objects.create(company=company, name=f"General {tag}")
+        warehouse = Warehouse.objects.create(company=company, name='Main Warehouse')
+        products = Product.objects.bulk_create([
+            Product(company=company, sku=f"{tag}-SKU-{i}", name=f"Product {i}", category=category, preferred_vendor=rng.choice(vendors),
+                    unit_cost=money(rng.randint(100, 20000)), unit_price=money(rng.randint(200, 40000)), reorder_level=rng.randint(0, 20),
+                    inventory_asset_account=accounts['1200'], expense_account=accounts['5000'], revenue_account=accounts['4000'])
+            for i in range(size['products'])])
+        StockItem.objects.bulk_create([StockItem(company=company, product=p, warehouse=warehouse, quantity=rng.randint(0, 500)) for p in products])
+
+        invoices, invoice_lines = [], []
+        for i in range(size['invoices']):
+            d = day(i, size['invoices'])
+            lines = [(rng.choice(products), rng.randint(1, 20)) for _ in range(rng.randint(1, 4))]
+            inv = Invoice(company=company, customer=rng.choice(customers), ar_account=accounts['1100'], invoice_number=f"INV-{tag}-{i}",
+                          project=rng.choice(projects) if projects and rng.random() < 0.2 else None, invoice_date=d,
+                          due_date=d + datetime.timedelta(days=30), payment_terms='Net 30',
+                          status=rng.choices(['Paid', 'Sent', 'Draft', 'Void'], [55, 35, 5, 5])[0],
+                          total_amount=sum(p.unit_price * q for p, q in lines))
+            invoices.append(inv)
+            invoice_lines.append(lines)
+        Invoice.objects.bulk_create(invoices, batch_size=1000)
+        InvoiceLine.objects.bulk_create([
+            InvoiceLine(company=company, invoice=inv, product=p, revenue_account=accounts['4000'], description=p.name, quantity=q,
+                        unit_price=p.unit_price, line_total=p.unit_price * q)
+            for inv, lines in zip(invoices, invoice_lines) for p, q in lines], batch_size=2000)
+
+        expenses, expense_lines = [], []
+        for i in range(size['expenses']):
+            amounts = [rng.randint(500, 300000) for _ in range(rng.randint(1, 3))]
+            expenses.append(Expense(company=company, vendor=rng.choice(vendors), expense_date=day(i, size['expenses']),
+                                    payment_account=accounts[rng.choice(['1000', '2100'])], reference_number=f"BILL-{i}",
+                                    project=rng.choice(projects) if projects and rng.random() < 0.2 else None,
+                                    status=rng.choices(['Approved', 'Draft', 'Declined'], [90, 7, 3])[0],
+                                    total_amount=money(sum(amounts))))
+            expense_lines.append(amounts)
+        Expense.objects.bulk_create(expenses, batch_size=1000)
+        ExpenseLine.objects.bulk_create([
+            ExpenseLine(company=company, expense=e, expense_account=accounts[rng.choice(OPERATING_EXPENSES)], amount=money(a))
+            for e, amounts in zip(expenses, expense_lines) for a in amounts], batch_size=2000)
+
+        orders, order_lines = [], []
+        for i in range(size['purchase_orders']):
+            lines = [(rng.randint(1, 50), rng.randint(100, 50000)) for _ in range(rng.randint(1, 3))]
+            vendor = rng.choice(vendors)
+            orders.append(PurchaseOrder(company=company, po_number=f"PO-{tag}-{i}", po_date=day(i, size['purchase_orders']), vendor=vendor,
+                                        vendor_name=vendor.name, status=rng.choice(['Issued', 'Received', 'Closed', 'Draft']),
+                                        total_amount=money(sum(q * c for q, c in lines))))
+            order_lines.append(lines)
+        PurchaseOrder.objects.bulk_create(orders, batch_size=1000)
+        PurchaseOrderLine.objects.bulk_create([
+            PurchaseOrderLine(company=company, purchase_order=po, account=accounts['1200'], item_description='Stock replenishment',
+                              quantity=q, unit_price=money(c), line_total=money(q * c))
+            for po, lines in zip(orders, order_lines) for q, c in lines], batch_size=2000)
+
+        FixedAsset.objects.bulk_create([
+            FixedAsset(company=company, asset_number=f"FA-{tag}-{i}", name=f"Asset {i}", category=rng.choice(['Computers', 'Vehicles', 'Furniture']),
+                       location='Head Office', vendor=rng.choice(vendors), acquisition_date=day(i, size['assets']),
+                       purchase_cost=money(rng.randint(50000, 5000000)), useful_life_years=rng.choice([3, 5, 7]),
+                       asset_account=accounts['1500'], depreciation_expense_account=accounts['6800'],
+                       accumulated_depreciation_account=accounts['1510'])
+            for i in range(size['assets'])])
+
+        budget = Budget.objects.create(company=company, name=f"Plan {end_date.year}", year=end_date.year)
+        BudgetItem.objects.bulk_create([
+            BudgetItem(company=company, budget=budget, account=acc, monthly_amount=money(rng.randint(100000, 5000000)))
+            for acc in accounts.values() if acc.account_type in ('Income', 'Expenses', 'Cost of Goods Sold')])
+        log(f"{company.name}: {len(products)} products, {len(invoices)} invoices, {len(expenses)} expenses, {len(orders)} purchase orders")
+
+        bank_account = BankAccount.objects.create(company=company, name='Operating', account_number=f"{tag}-0001", gl_account=accounts['1000'])
+        bank_lines = seed_journal(rng, company, accounts, size, day, log)
+        BankStatementLine.objects.bulk_create([
+            BankStatementLine(company=company, bank_account=bank_account, date=d + datetime.timedelta(days=rng.randint(0, 2)),
+                              description=f"{description} {n}", amount=amount, content_hash=f"seed-{n}")
+            for n, (d, description, amount) in enumerate(bank_lines)], batch_size=2000)
+        bank_account.statement_balance = sum((amount for _, _, amount in bank_lines), ZERO)
+        bank_account.save(update_fields=['statement_balance'])
+
+        ledger.rebuild_period_balances(company)
+        posting.recalculate_balances(company)
+        posting.bump_ledger_version(company.pk)
+    return company
+
+def seed_journal(rng, company, accounts, size, day, log):
+    """
+    Write size['vouchers'] balanced vouchers in date order. Returns a sample
+    of the posted bank lines, [(date, description, amount)], about
+    size['statement_lines'] long, for the bank statement.
+    """
+    ops = connection.ops
+    weights = [kind[1] for kind in ENTRY_KINDS]
+    statement_rate = size['statement_lines'] / max(size['vouchers'], 1)
+    bank_id, posted_at = accounts['1000'].pk, timezone.now()
+    bank_lines, pending, pending_lines, written, batches = [], [], 0, 0, 0
+
+    def flush():
+        nonlocal pending, pending_lines, written, batches
+        vouchers = JournalVoucher.objects.bulk_create([v for v, _ in pending])
+        importers.insert_lines([
+            (company.pk, v.pk, account_id, ops.adapt_decimalfield_value(d, 19, 2), ops.adapt_decimalfield_value(c, 19, 2), '',
+             ops.adapt_datefield_value(v.jv_date), v.status)
+            for v, (_, lines) in zip(vouchers, pending) for account_id, d, c in lines])
+        written += pending_lines
+        batches += 1
+        pending, pending_lines = [], 0
+
+    count = size['vouchers']
+    for i in range(count):
+        description, _, debit_pool, credit_pool, (low, high) = rng.choices(ENTRY_KINDS, weights)[0]
+        cents = rng.randint(low * 100, high * 100)
+        lines = [(accounts[rng.choice(debit_pool)].pk, money(c), ZERO) for c in split(rng, cents, rng.randint(1, 4))]
+        lines += [(accounts[rng.choice(credit_pool)].pk, ZERO, money(c)) for c in split(rng, cents, rng.randint(1, 3))]
+        status = 'Draft' if rng.random() < DRAFT_RATE else 'Posted'
+        d = day(i, count)
+        voucher = JournalVoucher(company=company, jv_number=f"JV-S{company.pk}-{i:07d}", jv_date=d, description=description,
+                                 status=status, posted_at=posted_at if status == 'Posted' else None)
+        pending.append((voucher, lines))
+        pending_lines += len(lines)
+        if status == 'Posted' and rng.random() < statement_rate:
+            bank_lines += [(d, description, debit - credit) for account_id, debit, credit in lines if account_id == bank_id]
+        if pending_lines >= BATCH_LINES:
+            flush()
+            if batches % 25 == 0:
+                log(f"{company.name}: {i + 1} vouchers, {written} journal lines")
+    if pending:
+        flush()
+    log(f"{company.name}: {count} vouchers, {written} journal lines")
+    return bank_lines
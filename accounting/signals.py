@@ -0,0 +1,30 @@
+"""
+Signal receivers, connected in AccountingConfig.ready().
+
+Saving or deleting a row that reports are computed from invalidates the
+company's cached reports. Line models are covered by their parent document,
+which is always saved alongside them.
+
+Logging in makes sure the user has a company (superusers made with
+createsuperuser have none), so CompanyMiddleware always finds one.
+"""
+from django.contrib.auth.signals import user_logged_in
+from django.db.models.signals import post_delete, post_save
+
+from . import report_cache
+from .models import Account, Budget, BudgetItem, Company, Expense, Invoice, JournalVoucher, PurchaseOrder
+
+REPORT_SOURCES = [Account, Budget, BudgetItem, Expense, Invoice, JournalVoucher, PurchaseOrder]
+
+def invalidate_reports(sender, instance, **kwargs):
+    report_cache.invalidate(instance.company_id)
+
+def ensure_company(sender, request, user, **kwargs):
+    if not Company.objects.filter(owner=user).exists():
+        Company.objects.create(name=f"{user.username}'s Company", owner=user)
+
+def connect():
+    user_logged_in.connect(ensure_company, dispatch_uid='accounting_ensure_company')
+    for model in REPORT_SOURCES:
+        post_save.connect(invalidate_reports, sender=model, dispatch_uid=f'invalidate_reports_save_{model.__name__}')
+        post_delete.connect(invalidate_reports, sender=model, dispatch_uid=f'invalidate_reports_delete_{model.__name__}')
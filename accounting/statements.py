@@ -0,0 +1,280 @@
+"""
+Financial statement engine.
+
+Every statement starts from the same single grouped query (see
+ledger.account_totals) that returns debit/credit sums for all of a company's
+accounts at once. Accounts are then classified in memory by account_type and
+normal_balance, so the number of queries per report does not depend on the
+size of the chart of accounts.
+"""
+import datetime
+import decimal
+
+from django.db.models import Max, Min, Q, Sum
+from django.db.models.functions import TruncMonth
+from django.utils import timezone
+
+from . import ledger
+from .models import Account, Expense, ExpenseLine, Invoice, JournalVoucherLine, PurchaseOrder
+
+ZERO = decimal.Decimal(0)
+
+# --- ACCOUNT CLASSIFICATION ---
+# Includes the legacy type names used by older charts of accounts.
+ASSET_TYPES = ['Asset', 'Assets', 'Current Asset', 'Fixed Assets', 'Bank', 'Cash', 'Accounts Receivable', 'Inventory', 'Other Current Assets', 'Other Assets', 'Security Deposit']
+LIABILITY_TYPES = ['Liability', 'Liabilities', 'Current Liability', 'Long Term Liabilities', 'Credit Card', 'Accounts Payable', 'Other Current Liabilities', 'Payroll Liabilities', 'Taxes Payable']
+EQUITY_TYPES = ['Equity', 'Owner\'s Equity', 'Shareholder\'s Equity', 'Retained Earnings', 'Capital', 'Opening Balance Equity']
+
+INCOME_TYPES = ['Revenue', 'Income']
+COGS_TYPES = ['Cost of Goods Sold']
+EXPENSE_TYPES = ['Expense', 'Expenses']
+OTHER_INCOME_TYPES = ['Other Income']
+OTHER_EXPENSE_TYPES = ['Other Expense']
+
+# Everything that rolls into net income (current year earnings on the balance sheet)
+REVENUE_TYPES = ['Revenue', 'Income', 'Other Income', 'Sales']
+COST_TYPES = ['Expense', 'Expenses', 'Cost of Goods Sold', 'Other Expense', 'Depreciation']
+
+# The dashboard KPIs keep their original, narrower definitions: only accounts
+# typed 'Asset' count as total assets, and net income leaves out 'Sales',
+# 'Other Expense' and 'Depreciation'.
+DASHBOARD_ASSET_TYPES = ['Asset']
+DASHBOARD_REVENUE_TYPES = ['Revenue', 'Income', 'Other Income']
+DASHBOARD_COST_TYPES = ['Expense', 'Expenses', 'Cost of Goods Sold']
+
+
+def account_balances(company, start=None, end=None, accounts=None):
+    """
+    Accounts (in account_number order) with the posted totals for start..end
+    attached as debit_total, credit_total and calculated_balance (signed by
+    the account's normal balance). Two queries: the accounts and the totals.
+    """
+    totals = ledger.account_totals(company, start, end)
+    if accounts is None:
+        accounts = Account.objects.filter(company=company).order_by('account_number')
+    result = []
+    for acc in accounts:
+        acc.debit_total, acc.credit_total = totals.get(acc.id, (ZERO, ZERO))
+        acc.calculated_balance = ledger.net_balance(acc, acc.debit_total, acc.credit_total)
+        result.append(acc)
+    return result
+
+def section(balances, account_types, normal_balance=None):
+    """
+    Pick the non-zero accounts of the given types out of account_balances().
+    The amount is signed by normal_balance when given (income statement
+    sections), otherwise by each account's own normal balance.
+    Returns ([(account, amount), ...], total).
+    """
+    rows, total = [], ZERO
+    for acc in balances:
+        if acc.account_type not in account_types:
+            continue
+        side = normal_balance or acc.normal_balance
+        amount = (acc.debit_total - acc.credit_total) if side == 'Debit' else (acc.credit_total - acc.debit_total)
+        if amount != 0:
+            rows.append((acc, amount))
+            total += amount
+    return rows, total
+
+
+# --- STATEMENTS ---
+def income_statement(company, start_date, end_date):
+    balances = account_balances(company, start_date, end_date)
+
+    def get_section_data(account_types, normal_balance):
+        rows, total = section(balances, account_types, normal_balance)
+        return [{'name': acc.account_name, 'amount': amount} for acc, amount in rows], total
+
+    inc_list, inc_total = get_section_data(INCOME_TYPES, 'Credit')
+    cogs_list, cogs_total = get_section_data(COGS_TYPES, 'Debit')
+    gross_profit = inc_total - cogs_total
+    exp_list, exp_total = get_section_data(EXPENSE_TYPES, 'Debit')
+    net_operating_income = gross_profit - exp_total
+    other_inc_list, other_inc_total = get_section_data(OTHER_INCOME_TYPES, 'Credit')
+    other_exp_list, other_exp_total = get_section_data(OTHER_EXPENSE_TYPES, 'Debit')
+    net_other_income = other_inc_total - other_exp_total
+
+    return {
+        'inc_list': inc_list, 'inc_total': inc_total,
+        'cogs_list': cogs_list, 'cogs_total': cogs_total,
+        'gross_profit': gross_profit,
+        'exp_list': exp_list, 'exp_total': exp_total,
+        'net_operating_income': net_operating_income,
+        'other_inc_list': other_inc_list, 'other_inc_total': other_inc_total,
+        'other_exp_list': other_exp_list, 'other_exp_total': other_exp_total,
+        'net_other_income': net_other_income,
+        'net_income': net_operating_income + net_other_income,
+    }
+
+def balance_sheet(company, as_of):
+    balances = account_balances(company, None, as_of)
+
+    def get_historical_balances(account_types):
+        rows, total = section(balances, account_types)
+        return [acc for acc, _ in rows], total
+
+    assets, total_assets = get_historical_balances(ASSET_TYPES)
+    liabilities, total_liabilities = get_historical_balances(LIABILITY_TYPES)
+    equity, total_equity = get_historical_balances(EQUITY_TYPES)
+
+    # Net income to date keeps Assets = Liabilities + Equity + Net Income
+    _, rev_total = section(balances, REVENUE_TYPES, 'Credit')
+    _, exp_total = section(balances, COST_TYPES, 'Debit')
+    current_net_income = rev_total - exp_total
+
+    return {
+        'assets': assets,
+        'liabilities': liabilities,
+        'equity': equity,
+        'total_assets': total_assets,
+        'total_liabilities': total_liabilities,
+        'total_equity': total_equity,
+        'total_equity_and_income': total_equity + current_net_income,
+        'current_net_income': current_net_income,
+    }
+
+def trial_balance(company, as_of=None):
+    """
+    Every account's cumulative balance up to as_of, split into the debit or
+    credit column by the sign of debits minus credits.
+    """
+    report_lines = []
+    total_debits, total_credits = ZERO, ZERO
+    for acc in account_balances(company, None, as_of):
+        net = acc.debit_total - acc.credit_total
+        debit, credit = (net, ZERO) if net >= 0 else (ZERO, -net)
+        report_lines.append({'number': acc.account_number, 'name': acc.account_name, 'debit': debit, 'credit': credit})
+        total_debits += debit
+        total_credits += credit
+    return {'report_lines': report_lines, 'total_debits': total_debits, 'total_credits': total_credits}
+
+def posted_date_range(company):
+    """(first, last) posting date of the company's posted lines, or (None, None)."""
+    r = JournalVoucherLine.objects.filter(company=company, status='Posted').aggregate(first=Min('posting_date'), last=Max('posting_date'))
+    return r['first'], r['last']
+
+def budget_variance(company, budget):
+    """Annual budget vs posted actuals for each budget line of the budget's year."""
+    totals = ledger.account_totals(company, f"{budget.year}-01-01", f"{budget.year}-12-31")
+    data, tbi, tai, tbe, tae = [], ZERO, ZERO, ZERO, ZERO
+    for item in budget.items.select_related('account'):
+        ann_bud = item.monthly_amount * 12
+        d, c = totals.get(item.account_id, (ZERO, ZERO))
+        if item.account.normal_balance == 'Credit':  # Income
+            act = c - d
+            var = act - ann_bud
+            tbi += ann_bud; tai += act
+        else:
+            act = d - c
+            var = ann_bud - act
+            tbe += ann_bud; tae += act
+        data.append({'account': item.account, 'budget': ann_bud, 'actual': act, 'variance': var, 'percent': (act / ann_bud * 100) if ann_bud else 0})
+    return {'report_data': data, 'total_budget_income': tbi, 'total_actual_income': tai, 'total_budget_expense': tbe, 'total_actual_expense': tae}
+
+def account_activity(company, accounts, start_date, end_date):
+    """
+    Per-account detail for the custom report: starting balance (everything
+    posted before start_date), the posted lines of the period with a running
+    balance, and the ending balance. Accounts with no lines and a zero
+    current balance are skipped.
+    """
+    start = ledger.to_date(start_date)
+    opening = account_balances(company, None, start - datetime.timedelta(days=1), accounts=accounts)
+
+    # All of the period's lines for the selected accounts in one query
+    lines_by_account = {}
+    lines = (JournalVoucherLine.objects
+             .filter(company=company, account__in=[acc.id for acc in opening],
+                     posting_date__range=[start, ledger.to_date(end_date)],
+                     status='Posted')
+             .select_related('journal_voucher')
+             .order_by('posting_date', 'id'))
+    for line in lines:
+        lines_by_account.setdefault(line.account_id, []).append(line)
+
+    report_data = []
+    for acc in opening:
+        acc_lines = lines_by_account.get(acc.id, [])
+        if not acc_lines and acc.current_balance == 0:
+            continue  # Skip empty accounts to keep report clean
+
+        starting_bal = acc.calculated_balance
+        running_bal = starting_bal
+        processed_lines = []
+        for line in acc_lines:
+            running_bal += ledger.net_balance(acc, line.debit_amount, line.credit_amount)
+            processed_lines.append({
+                'date': line.journal_voucher.jv_date,
+                'ref': line.journal_voucher.jv_number,
+                'desc': line.line_description or line.journal_voucher.description,
+                'debit': line.debit_amount,
+                'credit': line.credit_amount,
+                'balance': running_bal,
+                'id': line.journal_voucher.id,
+            })
+
+        report_data.append({
+            'account': acc,
+            'starting_balance': starting_bal,
+            'lines': processed_lines,
+            'ending_balance': running_bal,
+        })
+    return report_data
+
+
+# --- DASHBOARD ---
+CHART_MONTHS = 6
+AR_CLOSED_STATUSES = ['Paid', 'Void', 'Refunded']
+OPEN_PO_STATUSES = ['Issued', 'Received']
+
+def chart_months(today, count=CHART_MONTHS):
+    """First days of the last `count` calendar months, oldest first, ending with today's month."""
+    months = [ledger.month_start(today)]
+    while len(months) < count:
+        months.insert(0, ledger.month_start(months[0] - datetime.timedelta(days=1)))
+    return months
+
+def monthly_totals(documents, date_field, months):
+    """
+    Sum of total_amount per calendar month for `months`: one GROUP BY month
+    query over a plain date range, so the (company, date) index is usable.
+    """
+    rows = (documents.filter(**{f'{date_field}__gte': months[0], f'{date_field}__lt': ledger.next_month(months[-1])})
+            .annotate(month=TruncMonth(date_field)).values('month').annotate(total=Sum('total_amount')).order_by())
+    totals = {r['month']: r['total'] for r in rows}
+    return [totals.get(m) or ZERO for m in months]
+
+def dashboard_metrics(company, today=None):
+    """
+    KPI totals, the income/expense chart for the last CHART_MONTHS calendar
+    months plus a forecast bar (average of the last three), and the top five
+    expense accounts. Six queries however large the ledger is.
+    """
+    today = today or timezone.localdate()
+    kpi = Account.objects.filter(company=company).aggregate(
+        assets=Sum('current_balance', filter=Q(account_type__in=DASHBOARD_ASSET_TYPES)),
+        revenue=Sum('current_balance', filter=Q(account_type__in=DASHBOARD_REVENUE_TYPES)),
+        costs=Sum('current_balance', filter=Q(account_type__in=DASHBOARD_COST_TYPES)),
+    )
+    total_ar = (Invoice.objects.filter(company=company).exclude(status__in=AR_CLOSED_STATUSES)
+                .aggregate(t=Sum('total_amount'))['t'] or ZERO)
+    total_ap = PurchaseOrder.objects.filter(company=company, status__in=OPEN_PO_STATUSES).aggregate(t=Sum('total_amount'))['t'] or ZERO
+
+    months = chart_months(today)
+    income = monthly_totals(Invoice.objects.filter(company=company).exclude(status='Void'), 'invoice_date', months)
+    expenses = monthly_totals(Expense.objects.filter(company=company), 'expense_date', months)
+    recent = min(3, len(months))
+    income_data = [float(v) for v in income] + [round(float(sum(income[-recent:])) / recent, 2)]
+    expense_data = [float(v) for v in expenses] + [round(float(sum(expenses[-recent:])) / recent, 2)]
+
+    breakdown = (ExpenseLine.objects.filter(company=company).values('expense_account__account_name')
+                 .annotate(total=Sum('amount')).order_by('-total')[:5])
+    return {
+        'total_assets': kpi['assets'] or ZERO, 'total_ar': total_ar, 'total_ap': total_ap,
+        'net_income': (kpi['revenue'] or ZERO) - (kpi['costs'] or ZERO),
+        'chart_labels': [m.strftime('%b') for m in months] + ['FORECAST'],
+        'income_data': income_data, 'expense_data': expense_data,
+        'category_labels': [r['expense_account__account_name'] for r in breakdown],
+        'category_data': [float(r['total']) for r in breakdown],
+    }
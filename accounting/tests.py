@@ -1,3 +1,1509 @@
-from django.test import TestCase
+import csv
+import datetime
+import gzip
+import decimal
+import io
+import itertools
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.db.models import Sum
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import benchmarks, exports, importers, ledger, loadtest, metrics, middleware, posting, reconciliation, report_cache, seeding, statements, urls
+from django.core.files.uploadedfile import SimpleUploadedFile
+
+from .models import (
+    Account, AccountPeriodBalance, BankAccount, BankStatementLine, Budget, BudgetItem, Company, Customer, Expense, ExpenseLine, ExportJob,
+    FixedAsset, Invoice, InvoiceLine, JournalVoucher, JournalVoucherLine, Product, Project, PurchaseOrder, PurchaseOrderLine,
+    ReconciliationGroup, StockItem, Vendor, Warehouse,
+)
+
+D = decimal.Decimal
+
+
+def make_company(username='owner'):
+    user = User.objects.create_user(username=username, password='pw')
+    return user, Company.objects.create(name=f"{username}'s Company", owner=user)
+
+def make_account(company, number, acc_type='Bank', normal='Debit'):
+    return Account.objects.create(company=company, account_number=number, account_name=f"Acct {number}",
+                                  account_type=acc_type, normal_balance=normal)
+
+def ticking_clock():
+    """Advance timezone.now() by a second per call so timestamp-based document numbers stay unique."""
+    start, tick = timezone.now(), itertools.count()
+    return mock.patch('django.utils.timezone.now', side_effect=lambda: start + datetime.timedelta(seconds=next(tick)))
+
+def make_voucher(company, jv_date, lines, status='Posted', number=None):
+    """lines: [(account, debit, credit), ...]"""
+    jv = JournalVoucher.objects.create(company=company, jv_number=number or f"JV-{JournalVoucher.objects.count() + 1}",
+                                       jv_date=jv_date, description='test', status=status)
+    for acc, d, c in lines:
+        JournalVoucherLine.objects.create(company=company, journal_voucher=jv, account=acc,
+                                          debit_amount=D(d), credit_amount=D(c))
+    return jv
+
+
+class PeriodBalanceTests(TestCase):
+    def setUp(self):
+        report_cache.get_cache().clear()
+        self.user, self.company = make_company()
+        self.bank = make_account(self.company, '1000')
+        self.income = make_account(self.company, '4000', 'Income', 'Credit')
+        dates = [datetime.date(2024, 1, 5), datetime.date(2024, 1, 31), datetime.date(2024, 2, 1),
+                 datetime.date(2024, 2, 15), datetime.date(2024, 3, 31), datetime.date(2024, 5, 2)]
+        for i, day in enumerate(dates, start=1):
+            jv = make_voucher(self.company, day, [(self.bank, 10 * i, 0), (self.income, 0, 10 * i)])
+            ledger.record_posting(jv)
+        # Drafts never reach the projection
+        make_voucher(self.company, datetime.date(2024, 2, 10), [(self.bank, 999, 0), (self.income, 0, 999)], status='Draft')
+
+    def raw_totals(self, start, end):
+        lines = JournalVoucherLine.objects.filter(company=self.company, journal_voucher__status='Posted')
+        if start: lines = lines.filter(journal_voucher__jv_date__gte=start)
+        if end: lines = lines.filter(journal_voucher__jv_date__lte=end)
+        out = {}
+        for l in lines:
+            d, c = out.get(l.account_id, (D(0), D(0)))
+            out[l.account_id] = (d + l.debit_amount, c + l.credit_amount)
+        return out
+
+    def test_record_posting_builds_monthly_rows(self):
+        rows = AccountPeriodBalance.objects.filter(account=self.bank).values_list('period', 'debit_total')
+        self.assertEqual(list(rows), [
+            (datetime.date(2024, 1, 1), D(30)), (datetime.date(2024, 2, 1), D(70)),
+            (datetime.date(2024, 3, 1), D(50)), (datetime.date(2024, 5, 1), D(60)),
+        ])
+
+    def test_account_totals_match_raw_lines(self):
+        ranges = [
+            (None, None), (None, '2024-01-31'), (None, '2024-02-14'), ('2024-01-06', '2024-03-31'),
+            ('2024-02-01', '2024-02-29'), ('2024-02-02', '2024-02-20'), ('2024-01-31', '2024-05-01'),
+            ('2024-03-01', None), ('2023-12-15', '2024-06-10'),
+        ]
+        for start, end in ranges:
+            with self.subTest(start=start, end=end):
+                expected = {k: v for k, v in self.raw_totals(start, end).items()}
+                got = {k: v for k, v in ledger.account_totals(self.company, start, end).items() if v != (0, 0)}
+                self.assertEqual(got, expected)
+
+    def test_totals_query_count_is_constant(self):
+        for start, end in [('2024-01-10', '2024-03-20'), (None, None), ('2024-02-02', '2024-02-20'), ('2024-02-01', None)]:
+            with self.subTest(start=start, end=end), self.assertNumQueries(1):
+                ledger.account_totals(self.company, start, end)
+
+    def test_check_and_rebuild(self):
+        self.assertEqual(ledger.check_period_balances(self.company), [])
+        AccountPeriodBalance.objects.filter(account=self.bank).update(debit_total=0)
+        self.assertEqual(len(ledger.check_period_balances(self.company)), 4)
+        with self.assertRaises(CommandError):
+            call_command('rebuild_period_balances', '--check', stdout=open('/dev/null', 'w'))
+        call_command('rebuild_period_balances', stdout=open('/dev/null', 'w'))
+        self.assertEqual(ledger.check_period_balances(self.company), [])
+
+    def test_post_voucher_updates_projection(self):
+        draft = JournalVoucher.objects.get(status='Draft')
+        self.client.force_login(self.user)
+        self.client.post(reverse('post_voucher', args=[draft.id]))
+        row = AccountPeriodBalance.objects.get(account=self.bank, period=datetime.date(2024, 2, 1))
+        self.assertEqual(row.debit_total, D(70 + 999))
+        self.assertEqual(ledger.check_period_balances(self.company), [])
+
+    def test_reports_read_from_projection(self):
+        self.client.force_login(self.user)
+        resp = self.client.get(reverse('balance_sheet'), {'target_date': '2024-02-20'})
+        self.assertEqual(resp.context['total_assets'], D(100))
+        self.assertEqual(resp.context['current_net_income'], D(100))
+        resp = self.client.get(reverse('income_statement'), {'start_date': '2024-01-06', 'end_date': '2024-03-31'})
+        self.assertEqual(resp.context['inc_total'], D(20 + 30 + 40 + 50))
+        resp = self.client.post(reverse('trial_balance_report'), {'date_range_option': 'custom', 'start_date': '2024-01-01', 'end_date': '2024-03-31'})
+        self.assertEqual(resp.context['total_debits'], D(150))
+        self.assertEqual(resp.context['total_debits'], resp.context['total_credits'])
+        resp = self.client.post(reverse('custom_report'), {'start_date': '2024-02-01', 'end_date': '2024-12-31', 'accounts': [self.bank.id]})
+        self.assertEqual(resp.context['report_data'][0]['starting_balance'], D(30))
+        self.assertEqual(resp.context['report_data'][0]['ending_balance'], D(210))
+
+
+class StatementEngineTests(TestCase):
+    def setUp(self):
+        report_cache.get_cache().clear()
+        self.user, self.company = make_company()
+        self.client.force_login(self.user)
+        self.budget = Budget.objects.create(company=self.company, name='Plan', year=2024)
+        self.add_accounts(3)
+
+    def add_accounts(self, n):
+        start = Account.objects.count()
+        for i in range(start, start + n):
+            bank = make_account(self.company, f"1{i:04d}")
+            income = make_account(self.company, f"4{i:04d}", 'Income', 'Credit')
+            expense = make_account(self.company, f"6{i:04d}", 'Expenses', 'Debit')
+            ledger.record_posting(make_voucher(self.company, datetime.date(2024, 3, 10), [(bank, 100, 0), (income, 0, 100)]))
+            ledger.record_posting(make_voucher(self.company, datetime.date(2024, 4, 12), [(expense, 40, 0), (bank, 0, 40)]))
+            BudgetItem.objects.create(company=self.company, budget=self.budget, account=income, monthly_amount=10)
+            BudgetItem.objects.create(company=self.company, budget=self.budget, account=expense, monthly_amount=5)
+        posting.bump_ledger_version(self.company.pk)
+
+    def count_queries(self):
+        requests = [
+            ('get', reverse('income_statement'), {'start_date': '2024-01-01', 'end_date': '2024-12-31'}),
+            ('get', reverse('balance_sheet'), {'target_date': '2024-04-20'}),
+            ('post', reverse('trial_balance_report'), {'date_range_option': 'custom', 'start_date': '2024-01-01', 'end_date': '2024-04-20'}),
+            ('post', reverse('custom_report'), {'start_date': '2024-04-01', 'end_date': '2024-12-31'}),
+            ('get', reverse('budget_variance', args=[self.budget.id]), {}),
+        ]
+        counts = {}
+        for method, url, data in requests:
+            with CaptureQueriesContext(connection) as ctx:
+                self.assertEqual(getattr(self.client, method)(url, data).status_code, 200)
+            counts[url] = len(ctx.captured_queries)
+        return counts
+
+    def test_query_count_does_not_depend_on_number_of_accounts(self):
+        small = self.count_queries()
+        self.add_accounts(40)
+        self.assertEqual(self.count_queries(), small)
+
+    def test_statement_figures(self):
+        inc = statements.income_statement(self.company, '2024-01-01', '2024-12-31')
+        self.assertEqual((inc['inc_total'], inc['exp_total'], inc['net_income']), (D(300), D(120), D(180)))
+        bs = statements.balance_sheet(self.company, datetime.date(2024, 3, 31))
+        self.assertEqual((bs['total_assets'], bs['current_net_income']), (D(300), D(300)))
+        var = statements.budget_variance(self.company, self.budget)
+        self.assertEqual((var['total_actual_income'], var['total_budget_expense']), (D(300), D(180)))
+
+
+class ConcurrentPostingTests(TransactionTestCase):
+    """Many workers posting at once must not lose any balance updates."""
+    THREADS = 8
+    VOUCHERS = 120
+
+    def setUp(self):
+        self.user, self.company = make_company()
+        self.bank = make_account(self.company, '1000')
+        self.income = make_account(self.company, '4000', 'Income', 'Credit')
+        self.expense = make_account(self.company, '6000', 'Expenses', 'Debit')
+        self.drafts = []
+        for i in range(self.VOUCHERS):
+            lines = [(self.bank, 3, 0), (self.income, 0, 2), (self.income, 0, 1)] if i % 2 else [(self.expense, 1, 0), (self.bank, 0, 1)]
+            self.drafts.append(make_voucher(self.company, datetime.date(2024, 1 + i % 12, 1), lines, status='Draft'))
+
+    def post_all(self, vouchers):
+        try:
+            for v in vouchers:
+                while True:
+                    try:
+                        with transaction.atomic():
+                            posting.post_draft(JournalVoucher.objects.get(pk=v.pk))
+                        break
+                    except OperationalError:  # SQLite only allows one writer; wait and retry
+                        time.sleep(0.001)
+        finally:
+            connection.close()
+
+    def run_threads(self, chunks):
+        threads = [threading.Thread(target=self.post_all, args=(chunk,)) for chunk in chunks]
+        for t in threads: t.start()
+        for t in threads: t.join()
+
+    def assert_ledger_intact(self):
+        posted = self.VOUCHERS // 2
+        self.bank.refresh_from_db(); self.income.refresh_from_db(); self.expense.refresh_from_db()
+        self.assertEqual(self.bank.current_balance, D(3 * posted - posted))
+        self.assertEqual(self.income.current_balance, D(3 * posted))
+        self.assertEqual(self.expense.current_balance, D(posted))
+        self.assertEqual(ledger.check_period_balances(self.company), [])
+
+    def test_concurrent_posting_loses_no_updates(self):
+        self.run_threads([self.drafts[i::self.THREADS] for i in range(self.THREADS)])
+        self.assertFalse(JournalVoucher.objects.filter(status='Draft').exists())
+        self.assert_ledger_intact()
+
+    def test_same_voucher_posted_twice_applies_once(self):
+        self.run_threads([self.drafts] * 4)
+        self.assert_ledger_intact()
+
+    def test_one_update_per_account(self):
+        v = make_voucher(self.company, datetime.date(2024, 6, 1), [(self.bank, 5, 0), (self.bank, 5, 0), (self.income, 0, 10)], status='Draft')
+        with CaptureQueriesContext(connection) as ctx:
+            posting.post_draft(v)
+        balance_updates = [q for q in ctx.captured_queries if 'UPDATE "accounting_account"' in q['sql']]
+        self.assertEqual(len(balance_updates), 1)
+        self.bank.refresh_from_db(); self.income.refresh_from_db()
+        self.assertEqual((self.bank.current_balance, self.income.current_balance), (D(10), D(10)))
+
+
+class DocumentFlowQueryTests(TestCase):
+    """Document flows insert their lines in bulk: query count must not grow with the line count."""
+
+    def setUp(self):
+        clock = ticking_clock()
+        clock.start()
+        self.addCleanup(clock.stop)
+        self.user, self.company = make_company()
+        self.client.force_login(self.user)
+        self.bank = make_account(self.company, '1000')
+        self.equity = make_account(self.company, '3000', 'Equity', 'Credit')
+        self.income = make_account(self.company, '4000', 'Income', 'Credit')
+        self.expenses = [make_account(self.company, f"6{i:03d}", 'Expenses', 'Debit') for i in range(60)]
+        self.vendor = Vendor.objects.create(company=self.company, name='Vendor')
+        self.customer = Customer.objects.create(company=self.company, name='Customer')
+        self.products = [
+            Product.objects.create(company=self.company, sku=f"SKU{i}", name=f"P{i}", unit_price=5,
+                                   inventory_asset_account=self.bank, revenue_account=self.income)
+            for i in range(60)
+        ]
+
+    def queries(self, method, url, data):
+        with CaptureQueriesContext(connection) as ctx:
+            resp = getattr(self.client, method)(url, data)
+        self.assertEqual(resp.status_code, 302, getattr(resp, 'content', b'')[:500])
+        return len(ctx.captured_queries)
+
+    def voucher_data(self, n):
+        accts = [str(a.id) for a in self.expenses[:n]] + [str(self.equity.id)]
+        return {'jv_date': '2024-05-01', 'description': 'Bulk', 'account': accts,
+                'debit': ['1'] * n + [''], 'credit': [''] * n + [str(n)], 'line_description': ['x'] * (n + 1)}
+
+    def test_create_and_edit_voucher(self):
+        small = self.queries('post', reverse('create_voucher'), self.voucher_data(2))
+        large = self.queries('post', reverse('create_voucher'), self.voucher_data(50))
+        self.assertEqual(small, large)
+        v = JournalVoucher.objects.latest('id')
+        self.assertEqual(v.lines.count(), 51)
+        small = self.queries('post', reverse('edit_voucher', args=[v.id]), self.voucher_data(3))
+        large = self.queries('post', reverse('edit_voucher', args=[v.id]), self.voucher_data(40))
+        self.assertEqual(small, large)
+        self.assertEqual(v.lines.filter(company=self.company).count(), 41)
+
+    def expense_data(self, n):
+        return {'vendor': self.vendor.id, 'expense_date': '2024-05-02', 'payment_account': self.bank.id,
+                'reference_number': 'R1', 'account': [a.id for a in self.expenses[:n]],
+                'amount': ['2.50'] * n, 'line_description': ['x'] * n}
+
+    def test_create_expense(self):
+        small = self.queries('post', reverse('create_expense'), self.expense_data(2))
+        large = self.queries('post', reverse('create_expense'), self.expense_data(50))
+        self.assertEqual(small, large)
+        exp = Expense.objects.latest('id')
+        self.assertEqual((exp.lines.count(), exp.total_amount), (50, D(125)))
+        self.bank.refresh_from_db()
+        self.assertEqual(self.bank.current_balance, D(-130))
+
+    def invoice_data(self, n):
+        return {'customer': self.customer.id, 'invoice_date': '2024-05-03', 'due_date': '2024-06-03',
+                'payment_terms': 'Net 30', 'product': [p.id for p in self.products[:n]],
+                'account': [''] * n, 'quantity': ['2'] * n, 'unit_price': ['5'] * n}
+
+    def test_create_invoice_and_receive_payment(self):
+        self.queries('post', reverse('create_invoice'), self.invoice_data(1))  # first stock row exists afterwards
+        small = self.queries('post', reverse('create_invoice'), self.invoice_data(2))
+        self.assertEqual(self.queries('post', reverse('create_invoice'), self.invoice_data(50)), small)
+        inv = Invoice.objects.get(total_amount=500)
+        self.assertEqual(inv.lines.count(), 50)
+        self.assertEqual(StockItem.objects.get(product=self.products[0]).quantity, D(-6))
+        self.assertEqual(StockItem.objects.get(product=self.products[49]).quantity, D(-2))
+
+        small_inv = Invoice.objects.get(total_amount=20)
+        small = self.queries('post', reverse('receive_payment', args=[small_inv.id]), {'deposit_account': self.bank.id, 'payment_date': '2024-05-10'})
+        large = self.queries('post', reverse('receive_payment', args=[inv.id]), {'deposit_account': self.bank.id, 'payment_date': '2024-05-10'})
+        self.assertEqual(small, large)
+        self.income.refresh_from_db()
+        self.assertEqual(self.income.current_balance, D(520))
+
+    def test_upload_voucher(self):
+        def upload(n):
+            rows = ['account,debit,credit,description'] + [f"{a.account_number},1,,x" for a in self.expenses[:n]]
+            rows.append(f"{self.equity.account_number},,{n},offset")
+            return {'csv_file': SimpleUploadedFile('jv.csv', '\n'.join(rows).encode())}
+        self.assertEqual(self.queries('post', reverse('upload_voucher'), upload(2)),
+                         self.queries('post', reverse('upload_voucher'), upload(50)))
+        self.assertEqual(JournalVoucher.objects.latest('id').lines.count(), 51)
+
+
+class RecalculateBalancesTests(TestCase):
+    def setUp(self):
+        self.user, self.company = make_company()
+        self.accounts = [make_account(self.company, str(1000 + i)) for i in range(30)]
+        self.income = make_account(self.company, '4000', 'Income', 'Debit')  # wrong normal balance on purpose
+        for i, acc in enumerate(self.accounts, start=1):
+            make_voucher(self.company, datetime.date(2024, 1, 1), [(acc, i, 0), (self.income, 0, i)])
+        make_voucher(self.company, datetime.date(2024, 1, 2), [(self.accounts[0], 99, 0), (self.income, 0, 99)], status='Draft')
+        self.other_user, self.other = make_company('other')
+        self.other_bank = make_account(self.other, '9000')
+        make_voucher(self.other, datetime.date(2024, 1, 1), [(self.other_bank, 7, 0)])
+
+    def test_recalculate_is_set_based(self):
+        with CaptureQueriesContext(connection) as ctx:
+            drift = posting.recalculate_balances(self.company)
+        self.assertLessEqual(len(ctx.captured_queries), 6)
+        self.assertEqual(len(drift), 31)
+        self.assertEqual(Account.objects.get(pk=self.accounts[4].pk).current_balance, D(5))
+        income = Account.objects.get(pk=self.income.pk)
+        self.assertEqual((income.normal_balance, income.current_balance), ('Credit', D(465)))
+        self.assertEqual(posting.recalculate_balances(self.company), [])
+
+    def test_command_dry_run_reports_drift_without_writing(self):
+        out = io.StringIO()
+        call_command('recalculate_balances', '--dry-run', '--workers', '1', stdout=out)
+        self.assertIn('32 account balance(s) drifted', out.getvalue())
+        self.assertEqual(Account.objects.get(pk=self.other_bank.pk).current_balance, 0)
+
+        call_command('recalculate_balances', '--company', str(self.other.pk), '--workers', '1', stdout=io.StringIO())
+        self.assertEqual(Account.objects.get(pk=self.other_bank.pk).current_balance, D(7))
+        self.assertEqual(Account.objects.get(pk=self.accounts[0].pk).current_balance, 0)
+
+    def test_view(self):
+        self.client.force_login(self.user)
+        self.client.get(reverse('recalculate_balances'))
+        self.assertEqual(Account.objects.get(pk=self.accounts[29].pk).current_balance, D(30))
+
+
+class LinePostingFieldsTests(TestCase):
+    def setUp(self):
+        self.user, self.company = make_company()
+        self.bank = make_account(self.company, '1000')
+        self.income = make_account(self.company, '4000', 'Income', 'Credit')
+        self.client.force_login(self.user)
+
+    def voucher_lines(self, jv):
+        return set(JournalVoucherLine.objects.filter(journal_voucher=jv).values_list('posting_date', 'status'))
+
+    def test_lines_follow_voucher_through_edit_and_post(self):
+        jv = make_voucher(self.company, datetime.date(2024, 1, 5), [(self.bank, 10, 0), (self.income, 0, 10)], status='Draft')
+        self.assertEqual(self.voucher_lines(jv), {(datetime.date(2024, 1, 5), 'Draft')})
+
+        self.client.post(reverse('edit_voucher', args=[jv.id]), {
+            'jv_date': '2024-02-10', 'description': 'edited', 'account': [self.bank.id, self.income.id],
+            'debit': ['25', ''], 'credit': ['', '25'], 'line_description': ['', ''],
+        })
+        self.assertEqual(self.voucher_lines(jv), {(datetime.date(2024, 2, 10), 'Draft')})
+
+        self.client.post(reverse('post_voucher', args=[jv.id]))
+        self.assertEqual(self.voucher_lines(jv), {(datetime.date(2024, 2, 10), 'Posted')})
+        self.assertEqual(ledger.account_totals(self.company, '2024-02-01', '2024-02-29')[self.bank.id], (D(25), 0))
+
+    def test_voucher_save_updates_existing_lines(self):
+        jv = make_voucher(self.company, datetime.date(2024, 1, 5), [(self.bank, 10, 0), (self.income, 0, 10)], status='Draft')
+        jv = JournalVoucher.objects.get(pk=jv.pk)
+        jv.jv_date, jv.status = datetime.date(2024, 3, 1), 'Posted'
+        jv.save()
+        self.assertEqual(self.voucher_lines(jv), {(datetime.date(2024, 3, 1), 'Posted')})
+        jv.description = 'only the description'
+        with CaptureQueriesContext(connection) as ctx:
+            jv.save()
+        self.assertEqual(len(ctx.captured_queries), 1)
+
+    def test_totals_do_not_join_vouchers(self):
+        with CaptureQueriesContext(connection) as ctx:
+            ledger.account_totals(self.company, '2024-01-15', '2024-03-10')
+        self.assertNotIn('accounting_journalvoucher"', ctx.captured_queries[0]['sql'])
+
+    def test_backfill_migration(self):
+        import importlib
+        from django.apps import apps
+        migration = importlib.import_module('accounting.migrations.0007_journalvoucherline_posting_date_status')
+        jv = make_voucher(self.company, datetime.date(2024, 3, 1), [(self.bank, 5, 0), (self.income, 0, 5)])
+        JournalVoucherLine.objects.update(posting_date=None, status='Draft')
+        with mock.patch.object(migration, 'BATCH_SIZE', 1):
+            migration.backfill_posting_fields(apps, connection.schema_editor())
+        self.assertEqual(self.voucher_lines(jv), {(datetime.date(2024, 3, 1), 'Posted')})
+
+
+class AccountLedgerTests(TestCase):
+    def setUp(self):
+        self.user, self.company = make_company()
+        self.bank = make_account(self.company, '1000')
+        self.income = make_account(self.company, '4000', 'Income', 'Credit')
+        self.client.force_login(self.user)
+        # 3 months of activity, several lines per day so (date, id) ties matter
+        day = datetime.date(2024, 1, 1)
+        for i in range(1, 61):
+            jv = make_voucher(self.company, day + datetime.timedelta(days=i // 2), [(self.bank, i, 0), (self.income, 0, i)])
+            ledger.record_posting(jv)
+
+    def expected(self, account, start=None):
+        lines = JournalVoucherLine.objects.filter(account=account, status='Posted').order_by('posting_date', 'id')
+        bal, result = D(0), []
+        for line in lines:
+            bal += ledger.net_balance(account, line.debit_amount, line.credit_amount)
+            if start is None or line.posting_date >= start:
+                result.append((line.id, bal))
+        return result
+
+    def walk(self, account, **filters):
+        rows, cursor = [], None
+        while True:
+            page, _, cursor = ledger.ledger_page(account, after=ledger.parse_cursor(cursor), page_size=7, **filters)
+            rows += [(r['id'], r['balance']) for r in page]
+            if not cursor:
+                return rows
+
+    def test_pages_match_full_scan(self):
+        self.assertEqual(self.walk(self.bank), self.expected(self.bank))
+        self.assertEqual(self.walk(self.income), self.expected(self.income))
+        start = datetime.date(2024, 1, 17)
+        self.assertEqual(self.walk(self.income, start=start), self.expected(self.income, start))
+
+    def test_page_query_count_is_constant(self):
+        for cursor in (None, '2024-01-05.1', '2024-01-30.99'):
+            with CaptureQueriesContext(connection) as ctx:
+                ledger.ledger_page(self.bank, after=ledger.parse_cursor(cursor), start='2024-01-10', page_size=10)
+            self.assertEqual(len(ctx.captured_queries), 2)
+
+    def test_views(self):
+        response = self.client.get(reverse('account_ledger', args=[self.bank.id]))
+        self.assertEqual(len(response.context['transaction_lines']), 60)
+        data = self.client.get(reverse('account_ledger_json', args=[self.bank.id]), {'start_date': '2024-01-20'}).json()
+        self.assertEqual(data['opening_balance'], f"{sum(range(1, 38))}.00")
+        self.assertEqual(data['lines'][0]['jv_number'], JournalVoucherLine.objects.get(pk=data['lines'][0]['id']).journal_voucher.jv_number)
+        self.assertEqual(self.client.get(reverse('account_ledger', args=[self.bank.id]), {'search': 'JV-5'}).status_code, 200)
+
+
+class TrialBalanceTests(TestCase):
+    def setUp(self):
+        report_cache.get_cache().clear()
+        self.user, self.company = make_company()
+        self.bank = make_account(self.company, '1000')
+        self.income = make_account(self.company, '4000', 'Income', 'Credit')
+        self.other_user, self.other = make_company('other')
+        other_bank = make_account(self.other, '9000')
+        make_voucher(self.other, datetime.date(2024, 1, 1), [(other_bank, 500, 0)])
+        for day in (5, 20):
+            make_voucher(self.company, datetime.date(2024, 1, day), [(self.bank, day, 0), (self.income, 0, day)])
+        self.client.force_login(self.user)
+
+    def run_report(self, **data):
+        return self.client.post(reverse('trial_balance_report'), data or {'date_range_option': 'all'})
+
+    def test_company_scoped_and_cached_per_ledger_version(self):
+        resp = self.run_report()
+        self.assertEqual(resp.context['end_date'], '2024-01-20')
+        self.assertEqual([line['number'] for line in resp.context['report_lines']], ['1000', '4000'])
+        self.assertEqual(resp.context['total_debits'], D(25))
+
+        with CaptureQueriesContext(connection) as ctx:
+            self.run_report()
+        self.assertFalse(any('accounting_account' in q['sql'] for q in ctx.captured_queries))
+
+        jv = make_voucher(self.company, datetime.date(2024, 1, 20), [(self.bank, 5, 0), (self.income, 0, 5)], status='Draft')
+        self.client.post(reverse('post_voucher', args=[jv.id]))
+        self.assertEqual(self.run_report().context['total_debits'], D(30))
+
+    def test_csv_download_streams_report(self):
+        self.assertEqual(self.client.get(reverse('download_trial_balance')).status_code, 200)
+        resp = self.client.get(reverse('download_trial_balance'), {'start_date': '2024-01-01', 'end_date': '2024-01-10'})
+        self.assertTrue(resp.streaming)
+        rows = list(csv.reader(b''.join(resp.streaming_content).decode().splitlines()))
+        self.assertEqual(rows[0], ['Account Number', 'Account Name', 'Debit', 'Credit'])
+        self.assertEqual(rows[1:], [['1000', 'Acct 1000', '5.00', '0.00'], ['4000', 'Acct 4000', '0.00', '5.00'], ['', 'Total', '5.00', '5.00']])
+
+    def test_requires_login(self):
+        self.client.logout()
+        self.assertEqual(self.run_report().status_code, 302)
+        self.assertEqual(self.client.get(reverse('download_trial_balance')).status_code, 302)
+
+
+class VoucherExportTests(TestCase):
+    def setUp(self):
+        self.user, self.company = make_company()
+        self.bank = make_account(self.company, '1000')
+        self.income = make_account(self.company, '4000', 'Income', 'Credit')
+        self.client.force_login(self.user)
+        for i in range(1, 31):
+            make_voucher(self.company, datetime.date(2024, 1, 1) + datetime.timedelta(days=i),
+                         [(self.bank, i, 0), (self.income, 0, i)], status='Draft' if i % 10 == 0 else 'Posted')
+        other_user, other = make_company('other')
+        make_voucher(other, datetime.date(2024, 1, 5), [(make_account(other, '9000'), 1, 0)])
+
+    def download(self, url, **params):
+        with CaptureQueriesContext(connection) as ctx:
+            resp = self.client.get(url, params)
+            body = b''.join(resp.streaming_content)
+        if params.get('gzip'):
+            body = gzip.decompress(body)
+        return list(csv.reader(body.decode().splitlines())), len(ctx.captured_queries)
+
+    def test_all_vouchers_stream_from_one_query(self):
+        rows, queries = self.download(reverse('download_all_vouchers'))
+        self.assertEqual(len(rows), 61)
+        self.assertEqual(rows[1], ['JV-1', '2024-01-02', 'test', 'Posted', '1000', '1.00', '0.00', ''])
+        make_voucher(self.company, datetime.date(2024, 3, 1), [(self.bank, 1, 0), (self.income, 0, 1)] * 20)
+        self.assertEqual(self.download(reverse('download_all_vouchers'))[1], queries)
+
+    def test_filters_and_gzip(self):
+        rows, _ = self.download(reverse('download_all_vouchers'), start_date='2024-01-05', end_date='2024-01-14',
+                                status='Posted', gzip='1')
+        self.assertEqual(len(rows), 1 + 2 * 9)
+        self.assertTrue(all(r[3] == 'Posted' and '2024-01-05' <= r[1] <= '2024-01-14' for r in rows[1:]))
+
+    def test_single_voucher(self):
+        jv = JournalVoucher.objects.get(jv_number='JV-3')
+        rows, _ = self.download(reverse('download_single_voucher', args=[jv.id]))
+        self.assertEqual(rows[4:], [['1000', 'Acct 1000', '3.00', '0.00', ''], ['4000', 'Acct 4000', '0.00', '3.00', '']])
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class ExportJobTests(TestCase):
+    def setUp(self):
+        self.user, self.company = make_company()
+        self.bank = make_account(self.company, '1000')
+        self.income = make_account(self.company, '4000', 'Income', 'Credit')
+        for i in range(1, 13):
+            ledger.record_posting(make_voucher(self.company, datetime.date(2024, i, 1), [(self.bank, i, 0), (self.income, 0, i)]))
+        self.client.force_login(self.user)
+
+    def queue(self, **data):
+        self.client.post(reverse('export_list'), data)
+        return ExportJob.objects.latest('id')
+
+    def test_worker_produces_each_kind(self):
+        vouchers = self.queue(kind='vouchers', start_date='2024-03-01', end_date='2024-05-31')
+        gl = self.queue(kind='account_activity', start_date='2024-06-01', end_date='2024-12-31', account_types='Bank')
+        tb = self.queue(kind='trial_balance', end_date='2024-12-31')
+        self.assertEqual(self.client.get(reverse('export_status', args=[gl.id])).json()['status'], 'Pending')
+
+        call_command('run_export_jobs', '--once', stdout=io.StringIO())
+
+        for job, rows in ((vouchers, 6), (gl, 1 + 7), (tb, 3)):
+            job.refresh_from_db()
+            self.assertEqual((job.status, job.rows_written), ('Done', rows), job.error)
+            self.assertEqual(self.client.get(reverse('export_status', args=[job.id])).json()['percent'], 100)
+        body = b''.join(self.client.get(reverse('download_export', args=[gl.id])).streaming_content).decode()
+        self.assertIn('Opening Balance', body)
+        self.assertIn('78.00', body.splitlines()[-1])
+
+    def test_failed_job_and_range_download(self):
+        job = self.queue(kind='vouchers')
+        ExportJob.objects.filter(pk=job.pk).update(params={'start_date': 'not-a-date'})
+        self.assertEqual(exports.run_job(exports.claim_next_job()).status, 'Failed')
+        self.assertIsNone(exports.claim_next_job())
+
+        job = self.queue(kind='vouchers')
+        exports.run_job(exports.claim_next_job())
+        url = reverse('download_export', args=[job.id])
+        full = b''.join(self.client.get(url).streaming_content)
+        resp = self.client.get(url, headers={'Range': 'bytes=10-19'})
+        self.assertEqual((resp.status_code, resp['Content-Range']), (206, f'bytes 10-19/{len(full)}'))
+        self.assertEqual(b''.join(resp.streaming_content), full[10:20])
+        self.assertEqual(b''.join(self.client.get(url, headers={'Range': 'bytes=-5'}).streaming_content), full[-5:])
+        self.assertEqual(self.client.get(url, headers={'Range': f'bytes={len(full)}-'}).status_code, 416)
+
+        other_user, _ = make_company('other')
+        self.client.force_login(other_user)
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+
+class VoucherImportTests(TestCase):
+    def setUp(self):
+        self.user, self.company = make_company()
+        self.bank = make_account(self.company, '1000')
+        self.equity = make_account(self.company, '3000', 'Equity', 'Credit')
+        self.client.force_login(self.user)
+
+    def upload(self, text):
+        return importers.import_vouchers(self.company, SimpleUploadedFile('jv.csv', text.encode()))
+
+    def test_multi_voucher_file(self):
+        rows = ['Voucher,Date,Description,Account,Debit,Credit,Line Description']
+        for i in range(300):
+            rows += [f"OB-{i},2024-01-{i % 28 + 1:02d},Opening {i},1000,{i + 1},,cash",
+                     f"OB-{i},2024-01-{i % 28 + 1:02d},Opening {i},3000,,{i + 1},"]
+        with mock.patch.object(importers, 'BATCH_SIZE', 100), CaptureQueriesContext(connection) as ctx:
+            result = self.upload('\n'.join(rows))
+        self.assertEqual((result['vouchers'], result['lines'], result['errors']), (300, 600, []))
+        self.assertLess(len(ctx.captured_queries), 30)
+        jv = JournalVoucher.objects.get(jv_number='OB-29')
+        self.assertEqual((jv.jv_date, jv.status, jv.description), (datetime.date(2024, 1, 2), 'Draft', 'Opening 29'))
+        self.assertEqual(set(jv.lines.values_list('posting_date', 'status')), {(datetime.date(2024, 1, 2), 'Draft')})
+
+    def test_imported_line_matches_orm_line(self):
+        self.upload('Voucher,Date,Account,Debit,Credit,Line Description\nA,2024-02-03,1000,12.50,,memo\nA,2024-02-03,3000,,12.50,')
+        imported = JournalVoucherLine.objects.get(journal_voucher__jv_number='A', account=self.bank)
+        jv = JournalVoucher.objects.create(company=self.company, jv_number='B', jv_date=datetime.date(2024, 2, 3), status='Draft')
+        created = JournalVoucherLine.objects.create(company=self.company, journal_voucher=jv, account=self.bank,
+                                                    debit_amount=D('12.50'), credit_amount=D(0), line_description='memo')
+        created.refresh_from_db()
+        fields = [f.attname for f in JournalVoucherLine._meta.concrete_fields if f.attname not in ('id', 'journal_voucher_id')]
+        self.assertIn('posting_date', fields)
+        self.assertEqual({f: getattr(imported, f) for f in fields}, {f: getattr(created, f) for f in fields})
+
+    def test_taken_number_does_not_reveal_other_companies(self):
+        _, other = make_company('other')
+        JournalVoucher.objects.create(company=other, jv_number='X', jv_date=datetime.date(2024, 1, 1))
+        result = self.upload('Voucher,Date,Account,Debit,Credit\nX,2024-01-01,1000,5,\nX,2024-01-01,3000,,5')
+        self.assertEqual(result['errors'], [(2, "Voucher number 'X' cannot be used; choose another")])
+
+    def test_errors_are_reported_per_row_and_nothing_is_saved(self):
+        result = self.upload('\n'.join([
+            'Voucher,Date,Account,Debit,Credit',
+            'A,2024-01-01,1000,10,',
+            'A,2024-01-01,3000,,10',
+            'B,2024-01-02,9999,5,',      # unknown account
+            'B,2024-01-02,3000,,abc',    # bad amount
+            'C,not-a-date,1000,1,',
+            'C,not-a-date,3000,,1',
+            'D,2024-01-03,1000,7,',      # unbalanced
+            'D,2024-01-03,3000,,6',
+            'A,2024-01-04,1000,1,',      # voucher A split across the file
+        ]))
+        self.assertEqual([row for row, _ in result['errors']], [4, 5, 6, 8, 10])
+        self.assertEqual(result['vouchers'], 0)
+        self.assertFalse(JournalVoucher.objects.exists())
+
+    def test_legacy_layout_and_view_report(self):
+        self.assertEqual(self.upload('AccountNumber,Debit,Credit,Description\n1000,5,,x\n3000,,5,y')['vouchers'], 1)
+        self.assertEqual(JournalVoucher.objects.get().jv_date, timezone.now().date())
+        resp = self.client.post(reverse('upload_voucher'), {'csv_file': SimpleUploadedFile(
+            'jv.csv', b'Voucher,Date,Account,Debit,Credit\nX,2024-01-01,1000,5,\nX,2024-01-01,3000,,4')})
+        self.assertEqual(resp.context['row_errors'], [(2, "Voucher 'X' does not balance (debits 5, credits 4)")])
+
+
+class BankStatementImportTests(TestCase):
+    def setUp(self):
+        self.user, self.company = make_company()
+        self.bank = BankAccount.objects.create(company=self.company, name='Checking', account_number='123',
+                                               gl_account=make_account(self.company, '1000'))
+        self.client.force_login(self.user)
+
+    def upload(self, text):
+        return importers.import_statement_lines(self.bank, importers.parse_csv_statement(io.BytesIO(text.encode())))
+
+    def statement(self, days, fmt='%m/%d/%Y'):
+        rows = ['Date,Description,Amount']
+        for day in days:
+            d = datetime.date(2024, 3, day)
+            rows += [f"{d.strftime(fmt)},Coffee,(4.50)", f"{d.strftime(fmt)},Coffee,(4.50)", f"{d.strftime(fmt)},Deposit {day},\"$1,000.00\""]
+        return '\n'.join(rows)
+
+    def test_counts_and_balance_only_cover_rows_that_landed(self):
+        bulk_create = BankStatementLine.objects.bulk_create
+
+        def drop_first(objs, *args, **kwargs):  # as ignore_conflicts does for a line another upload wrote first
+            return bulk_create(objs[1:], *args, **kwargs)
+        with mock.patch.object(BankStatementLine.objects, 'bulk_create', side_effect=drop_first):
+            result = self.upload('Date,Description,Amount\n03/01/2024,Rent,-500.00\n03/02/2024,Deposit,200.00')
+        self.assertEqual((result['inserted'], result['skipped'], result['amount']), (1, 1, D(200)))
+        self.bank.refresh_from_db()
+        self.assertEqual(self.bank.statement_balance, D(200))
+
+    def test_caller_file_stays_open(self):
+        f = io.BytesIO(b'Date,Description,Amount\n03/01/2024,Rent,-500.00')
+        self.assertEqual(len(list(importers.parse_csv_statement(f))), 1)
+        self.assertFalse(f.closed)
+
+    def test_overlapping_statements_are_deduplicated(self):
+        self.assertEqual(self.upload(self.statement(range(1, 16)))['inserted'], 45)
+        result = self.upload(self.statement(range(10, 31)))
+        self.assertEqual((result['inserted'], result['skipped']), (45, 18))
+        self.assertEqual(BankStatementLine.objects.filter(bank_account=self.bank).count(), 90)
+        self.assertEqual(BankStatementLine.objects.filter(date=datetime.date(2024, 3, 12), amount=D('-4.50')).count(), 2)
+        self.assertEqual(BankStatementLine.objects.get(description='Deposit 3').amount, D('1000.00'))
+
+    def test_date_format_detected_once_per_file(self):
+        result = self.upload(self.statement([13, 25], fmt='%d/%m/%Y') + '\n2024-03-01,Bad date,1\n03/04/2024,Bad amount,abc')
+        self.assertEqual((result['inserted'], [row for row, _ in result['errors']]), (6, [8, 9]))
+        self.assertTrue(BankStatementLine.objects.filter(date=datetime.date(2024, 3, 25)).exists())
+
+    def test_chunked_insert_query_count(self):
+        with mock.patch.object(importers, 'STATEMENT_CHUNK_SIZE', 10), CaptureQueriesContext(connection) as ctx:
+            self.upload(self.statement(range(1, 31)))
+        # Per chunk of 10: existing hashes, insert, re-read of what landed; plus the lock and the transaction
+        self.assertLessEqual(len(ctx.captured_queries), 3 * 9 + 4)
+
+    def test_view_reports_counts(self):
+        upload = lambda: self.client.post(reverse('upload_bank_statement', args=[self.bank.id]), {
+            'csv_file': SimpleUploadedFile('s.csv', self.statement([1, 2]).encode())}, follow=True)
+        upload()
+        self.assertIn('Imported 0 lines, skipped 6', [str(m) for m in upload().context['messages']][-1])
+
+    def test_backfill_keeps_existing_duplicates_distinct(self):
+        import importlib
+        from django.apps import apps
+        migration = importlib.import_module('accounting.migrations.0010_bankstatementline_content_hash')
+        for i in range(3):
+            BankStatementLine.objects.create(company=self.company, bank_account=self.bank, date=datetime.date(2024, 1, 1),
+                                             description='Fee', amount=D(-1), content_hash=f"old-{i}")
+        migration.backfill_content_hash(apps, None)
+        hashes = list(BankStatementLine.objects.order_by('id').values_list('content_hash', flat=True))
+        self.assertEqual(hashes, [importers.statement_line_hash(datetime.date(2024, 1, 1), D(-1), 'Fee', n) for n in (1, 2, 3)])
+        self.assertEqual(self.upload('Date,Description,Amount\n01/01/2024,Fee,-1.00')['skipped'], 1)
+
+
+class StatementFormatTests(TestCase):
+    OFX_SGML = (
+        "OFXHEADER:100\nDATA:OFXSGML\nVERSION:102\nENCODING:USASCII\nCHARSET:1252\n\n"
+        "<OFX><BANKMSGSRSV1><STMTTRNRS><STMTRS><BANKTRANLIST>"
+        "<STMTTRN><TRNTYPE>DEBIT<DTPOSTED>20240305120000[-5:EST]<TRNAMT>-4.50<FITID>1<NAME>Caf\xe9 Roma<MEMO>Card 1234</STMTTRN>\n"
+        "<STMTTRN><TRNTYPE>CREDIT<DTPOSTED>20240306<TRNAMT>1000,00<FITID>2<NAME>Payroll &amp; Co</STMTTRN>\n"
+        "<STMTTRN><TRNTYPE>DEBIT<DTPOSTED>2024XX06<TRNAMT>-1<FITID>3<NAME>Broken</STMTTRN>"
+        "</BANKTRANLIST></STMTRS></STMTTRNRS></BANKMSGSRSV1></OFX>"
+    )
+    CAMT = (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<Document xmlns="urn:iso:std:iso:20022:tech:xsd:camt.053.001.02"><BkToCstmrStmt><Stmt>'
+        '<Ntry><Amt Ccy="EUR">12.50</Amt><CdtDbtInd>DBIT</CdtDbtInd><BookgDt><Dt>2024-03-05</Dt></BookgDt>'
+        '<NtryDtls><TxDtls><RltdPties><Cdtr><Nm>Utility AG</Nm></Cdtr></RltdPties>'
+        '<RmtInf><Ustrd>Invoice 42</Ustrd></RmtInf></TxDtls></NtryDtls></Ntry>'
+        '<Ntry><Amt Ccy="EUR">300.00</Amt><CdtDbtInd>CRDT</CdtDbtInd><BookgDt><DtTm>2024-03-06T10:00:00</DtTm></BookgDt>'
+        '<AddtlNtryInf>Transfer in</AddtlNtryInf></Ntry>'
+        '</Stmt></BkToCstmrStmt></Document>'
+    )
+
+    def setUp(self):
+        self.user, self.company = make_company()
+        self.bank = BankAccount.objects.create(company=self.company, name='Checking', account_number='123',
+                                               gl_account=make_account(self.company, '1000'))
+
+    def parse(self, filename, data):
+        fileobj = io.BytesIO(data if isinstance(data, bytes) else data.encode())
+        return list(importers.statement_parser(filename, fileobj)(fileobj))
+
+    def test_ofx_sgml_in_small_blocks(self):
+        with mock.patch.object(importers, 'READ_SIZE', 7):
+            rows = self.parse('march.qfx', self.OFX_SGML.encode('cp1252'))
+        self.assertEqual([(r.date, r.description, r.amount) for r in rows[:2]], [
+            (datetime.date(2024, 3, 5), 'Caf\xe9 Roma - Card 1234', D('-4.50')),
+            (datetime.date(2024, 3, 6), 'Payroll & Co', D('1000.00')),
+        ])
+        self.assertEqual((rows[2].row_number, rows[2].error), (3, "Unrecognised date '2024XX06'"))
+
+    def test_ofx_xml_sniffed_from_xml_extension(self):
+        data = ('<?xml version="1.0"?><?OFX OFXHEADER="200" VERSION="211"?><OFX><BANKTRANLIST>'
+                '<STMTTRN><DTPOSTED>20240101</DTPOSTED><TRNAMT>-9.99</TRNAMT><NAME>Streaming</NAME></STMTTRN>'
+                '</BANKTRANLIST></OFX>')
+        self.assertEqual([(r.date, r.description, r.amount) for r in self.parse('export.xml', data)],
+                         [(datetime.date(2024, 1, 1), 'Streaming', D('-9.99'))])
+
+    def test_qif_day_first_dates(self):
+        data = "!Type:Bank\nD13/03'24\nT-4.50\nPCoffee\n^\nD25/03'24\nT1,000.00\nPSalary\nMMarch\n^\nD01/04'24\nPNo amount\n^\n"
+        rows = self.parse('bank.QIF', data)
+        self.assertEqual([(r.date, r.description, r.amount) for r in rows[:2]], [
+            (datetime.date(2024, 3, 13), 'Coffee', D('-4.50')),
+            (datetime.date(2024, 3, 25), 'Salary - March', D('1000.00')),
+        ])
+        self.assertEqual((rows[2].row_number, rows[2].error), (3, 'Missing amount'))
+
+    def test_camt053_entries(self):
+        with mock.patch.object(importers, 'READ_SIZE', 50):
+            rows = self.parse('stmt.xml', self.CAMT)
+        self.assertEqual([(r.date, r.description, r.amount) for r in rows], [
+            (datetime.date(2024, 3, 5), 'Utility AG - Invoice 42', D('-12.50')),
+            (datetime.date(2024, 3, 6), 'Transfer in', D('300.00')),
+        ])
+
+    def test_camt053_with_doctype_is_refused(self):
+        data = '<?xml version="1.0"?><!DOCTYPE d [<!ENTITY a "aaaa">]>' + self.CAMT.split('?>', 1)[1]
+        self.assertEqual([r.error for r in self.parse('stmt.xml', data)], ['Statement files with a DOCTYPE are not accepted'])
+
+    def test_view_accepts_formats_and_rejects_others(self):
+        self.client.force_login(self.user)
+        url = reverse('upload_bank_statement', args=[self.bank.id])
+        self.client.post(url, {'csv_file': SimpleUploadedFile('stmt.xml', self.CAMT.encode())})
+        response = self.client.post(url, {'csv_file': SimpleUploadedFile('stmt.xml', self.CAMT.encode())}, follow=True)
+        self.assertIn('Imported 0 lines, skipped 2', [str(m) for m in response.context['messages']][-1])
+        response = self.client.post(url, {'csv_file': SimpleUploadedFile('stmt.pdf', b'%PDF')}, follow=True)
+        self.assertIn('Unsupported file type', [str(m) for m in response.context['messages']][-1])
+        self.assertEqual(BankStatementLine.objects.filter(bank_account=self.bank).count(), 2)
+
+
+class BankLinesMixin:
+    def setUp(self):
+        self.user, self.company = make_company()
+        self.gl = make_account(self.company, '1000')
+        self.income = make_account(self.company, '4000', 'Income', 'Credit')
+        self.bank = BankAccount.objects.create(company=self.company, name='Checking', account_number='123', gl_account=self.gl)
+
+    def gl_line(self, day, amount, status='Posted'):
+        amount = D(amount)
+        lines = [(self.gl, amount, 0), (self.income, 0, amount)] if amount > 0 else [(self.gl, 0, -amount), (self.income, -amount, 0)]
+        jv = make_voucher(self.company, datetime.date(2024, 3, day), lines, status=status)
+        return jv.lines.get(account=self.gl)
+
+    def bank_line(self, day, amount, description='line'):
+        reconciliation.adjust_totals(self.bank, statement=D(amount))  # as an import would
+        return BankStatementLine.objects.create(company=self.company, bank_account=self.bank, date=datetime.date(2024, 3, day),
+                                                description=description, amount=D(amount), content_hash=f"{day}-{amount}-{description}")
+
+
+class AutoMatchTests(BankLinesMixin, TestCase):
+    def test_nearest_date_and_deterministic_ties(self):
+        far, near = self.gl_line(1, '50.00'), self.gl_line(9, '50.00')
+        tie_early, tie_late = self.gl_line(18, '-20.00'), self.gl_line(22, '-20.00')
+        same_day = [self.gl_line(15, '7.00'), self.gl_line(15, '7.00')]
+        self.gl_line(10, '99.00', status='Draft')
+        b1, b2, b3, b4 = self.bank_line(10, '50.00'), self.bank_line(20, '-20.00'), self.bank_line(15, '7.00'), self.bank_line(10, '99.00')
+        self.bank_line(28, '50.00')  # only candidate left is 27 days away
+        matches = {m.statement_line_id: m.journal_line_id for m in reconciliation.auto_match(self.bank, preview=True)}
+        self.assertEqual(matches, {b1.id: near.id, b2.id: tie_early.id, b3.id: same_day[0].id})
+        self.assertNotIn(b4.id, matches)  # its only candidate is a draft
+        self.assertTrue({far.id, tie_late.id}.isdisjoint(matches.values()))
+        self.assertFalse(BankStatementLine.objects.filter(matched_journal_line__isnull=False).exists())
+
+    def test_matched_lines_are_skipped_on_both_sides(self):
+        gl = [self.gl_line(day, '12.00') for day in range(1, 6)]
+        bank = [self.bank_line(3, '12.00', f"line {k}") for k in range(5)]
+        matches = {m.statement_line_id: m.journal_line_id for m in reconciliation.auto_match(self.bank, preview=True)}
+        # day 3, then the earlier of 2 and 4, then 4 (nearer than 1), then the earlier of 1 and 5, then 5
+        self.assertEqual([matches[b.id] for b in bank], [gl[2].id, gl[1].id, gl[3].id, gl[0].id, gl[4].id])
+
+    def test_apply_writes_matches_in_bulk(self):
+        for day in range(1, 21):
+            self.gl_line(day, f"{day}.00")
+            self.bank_line(day + 1, f"{day}.00")
+        with CaptureQueriesContext(connection) as ctx:
+            matches = reconciliation.auto_match(self.bank)
+        self.assertEqual(len(matches), 20)
+        self.assertLessEqual(len(ctx.captured_queries), 7)
+        self.assertEqual(reconciliation.auto_match(self.bank), [])
+        self.assertEqual(BankStatementLine.objects.filter(matched_journal_line__isnull=True).count(), 0)
+
+    def test_preview_and_apply_views(self):
+        self.gl_line(5, '12.00')
+        self.bank_line(6, '12.00', 'Coffee beans')
+        self.client.force_login(self.user)
+        url = reverse('auto_match_bank', args=[self.bank.id])
+        response = self.client.get(url, {'window_days': '0'})
+        self.assertEqual(response.context['match_count'], 0)
+        self.assertContains(self.client.get(url), 'Coffee beans')
+        self.client.post(url, {'window_days': '3'})
+        self.assertTrue(BankStatementLine.objects.get(description='Coffee beans').matched_journal_line_id)
+
+
+class ReconciliationGroupTests(BankLinesMixin, TestCase):
+    def test_find_subset_prunes_and_respects_budget(self):
+        self.assertEqual(reconciliation.find_subset(100, [70, 50, 30, 20]), [0, 2])
+        self.assertIsNone(reconciliation.find_subset(50, [50, 10]))  # a single line is a 1:1 match, not a group
+        self.assertIsNone(reconciliation.find_subset(1000, [90] * 200, max_size=6))
+        amounts = list(range(1000, 500, -2)) + [7, 5]
+        self.assertIsNone(reconciliation.find_subset(1018, amounts, budget=10))
+        self.assertEqual(sum(amounts[i] for i in reconciliation.find_subset(1018, amounts)), 1018)
+        self.assertIsNone(reconciliation.find_subset(100001, list(range(100000, 0, -2))))  # odd target, even amounts: budget-bound
+
+    def test_deposit_settles_several_receipts_and_card_payment_many_lines(self):
+        receipts = [self.gl_line(2, '120.00'), self.gl_line(3, '80.50'), self.gl_line(4, '99.50')]
+        self.gl_line(20, '80.50')  # outside the window
+        deposit = self.bank_line(5, '300.00', 'Deposit')
+        card_payment = self.gl_line(12, '-45.00')
+        charges = [self.bank_line(10, '-20.00', 'a'), self.bank_line(11, '-15.00', 'b'), self.bank_line(12, '-10.00', 'c')]
+        matches, groups = reconciliation.auto_reconcile(self.bank, preview=True)
+        self.assertEqual([(sorted(g.statement_line_ids), sorted(g.journal_line_ids), g.amount) for g in groups], [
+            ([deposit.id], sorted(r.id for r in receipts), D('300.00')),
+            (sorted(c.id for c in charges), [card_payment.id], D('-45.00')),
+        ])
+        self.assertFalse(ReconciliationGroup.objects.exists())
+
+        reconciliation.auto_reconcile(self.bank, user=self.user)
+        group = ReconciliationGroup.objects.get(amount=D('300.00'))
+        self.assertEqual(set(group.journal_lines.values_list('id', flat=True)), {r.id for r in receipts})
+        self.assertEqual(reconciliation.open_statement_lines(self.bank).count(), 0)
+
+    def test_manual_group_view(self):
+        lines = [self.gl_line(1, '10.00'), self.gl_line(2, '15.00')]
+        bank = [self.bank_line(3, '5.00'), self.bank_line(3, '20.00')]
+        self.client.force_login(self.user)
+        url = reverse('match_group', args=[self.bank.id])
+        data = {'statement_ids': [bank[0].id], 'journal_line_ids': [l.id for l in lines]}
+        response = self.client.post(url, data, follow=True)
+        self.assertIn('Mismatch', [str(m) for m in response.context['messages']][-1])
+        data['statement_ids'].append(bank[1].id)
+        self.client.post(url, data)
+        group = ReconciliationGroup.objects.get()
+        self.assertEqual((group.amount, group.statement_lines.count(), group.created_by), (D('25.00'), 2, self.user))
+        response = self.client.get(reverse('match_transaction', args=[bank[0].id, lines[0].id]), follow=True)
+        self.assertIn('already reconciled', [str(m) for m in response.context['messages']][-1])
+        self.assertEqual(self.client.get(reverse('unmatch_group', args=[group.id])).status_code, 405)
+        self.assertTrue(ReconciliationGroup.objects.filter(pk=group.pk).exists())
+        self.client.post(reverse('unmatch_group', args=[group.id]))
+        self.assertEqual(reconciliation.open_journal_lines(self.bank).count(), 2)
+
+
+class ReconcileWorkspaceTests(BankLinesMixin, TestCase):
+    def assertTotals(self, statement, cleared):
+        self.bank.refresh_from_db()
+        self.assertEqual((self.bank.statement_balance, self.bank.cleared_balance), (D(statement), D(cleared)))
+        self.assertEqual(reconciliation.recompute_totals(self.bank), (D(statement), D(cleared)))
+
+    def test_totals_follow_imports_matches_and_groups(self):
+        receipts = [self.gl_line(1, '40.00'), self.gl_line(2, '60.00')]
+        fee = self.gl_line(3, '-5.00')
+        importers.import_statement_lines(self.bank, importers.parse_csv_statement(io.BytesIO(
+            b"Date,Description,Amount\n03/02/2024,Deposit,100.00\n03/03/2024,Fee,-5.00\n03/04/2024,Unknown,7.00")))
+        self.assertTotals('102.00', '0')
+        deposit, fee_line = BankStatementLine.objects.get(description='Deposit'), BankStatementLine.objects.get(description='Fee')
+        reconciliation.match_pair(self.bank, fee_line.id, fee.id)
+        self.assertTotals('102.00', '-5.00')
+        with self.assertRaises(ValueError):
+            reconciliation.match_pair(self.bank, fee_line.id, fee.id)
+        group = reconciliation.create_group(self.bank, [deposit.id], [r.id for r in receipts])
+        self.assertTotals('102.00', '95.00')
+        self.assertEqual(self.bank.unreconciled_amount, D('7.00'))
+        reconciliation.dissolve_group(group)
+        reconciliation.unmatch_pair(self.bank, fee_line.id)
+        self.assertTotals('102.00', '0')
+        reconciliation.auto_reconcile(self.bank)
+        self.assertTotals('102.00', '95.00')
+
+    def test_json_pages_are_keyset_paginated_and_posted_only(self):
+        for day in range(1, 6):
+            self.bank_line(day, f"{day}.00")
+            self.gl_line(day, f"{day}.00")
+        self.gl_line(6, '9.00', status='Draft')
+        self.client.force_login(self.user)
+
+        def walk(side, **params):
+            seen, after, queries = [], '', []
+            while True:
+                with CaptureQueriesContext(connection) as ctx:
+                    data = self.client.get(reverse('reconcile_lines_json', args=[self.bank.id, side]), {'after': after, **params}).json()
+                queries.append(len(ctx.captured_queries))
+                seen += [l['amount'] for l in data['lines']]
+                if not data['next_cursor']:
+                    return seen, queries
+                after = data['next_cursor']
+
+        with mock.patch.object(reconciliation, 'PAGE_SIZE', 2):
+            gl, queries = walk('gl')
+            self.assertEqual(gl, ['1.00', '2.00', '3.00', '4.00', '5.00'])
+            self.assertEqual(len(set(queries)), 1)
+            self.assertEqual(walk('bank', start_date='2024-03-02', end_date='2024-03-04')[0], ['2.00', '3.00', '4.00'])
+            reconciliation.auto_match(self.bank)
+            self.assertEqual(walk('matched')[0], ['5.00', '4.00', '3.00', '2.00', '1.00'])
+        data = self.client.get(reverse('reconcile_lines_json', args=[self.bank.id, 'bank'])).json()
+        self.assertEqual((data['lines'], data['totals']['difference']), ([], '0.00'))
+        self.assertEqual(self.client.get(reverse('reconcile_lines_json', args=[self.bank.id, 'other'])).status_code, 404)
+
+
+class DashboardTests(TestCase):
+    def setUp(self):
+        report_cache.get_cache().clear()
+        self.user, self.company = make_company()
+        self.bank = make_account(self.company, '1000')
+        self.income = make_account(self.company, '4000', 'Income', 'Credit')
+        self.rent = make_account(self.company, '6000', 'Expenses')
+        self.customer = Customer.objects.create(company=self.company, name='Customer')
+        self.vendor = Vendor.objects.create(company=self.company, name='Vendor')
+        self.client.force_login(self.user)
+
+    def add_documents(self, n, day):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.create_documents(n, day)
+
+    def create_documents(self, n, day):
+        for i in range(n):
+            Invoice.objects.create(company=self.company, customer=self.customer, invoice_number=f"INV-{Invoice.objects.count() + 1}", invoice_date=day,
+                                   due_date=day, total_amount=D('100.00'), status='Sent' if i % 2 else 'Void', ar_account=self.bank)
+            expense = Expense.objects.create(company=self.company, vendor=self.vendor, expense_date=day, payment_account=self.bank,
+                                             total_amount=D('40.00'))
+            ExpenseLine.objects.create(company=self.company, expense=expense, expense_account=self.rent, amount=D('40.00'))
+
+    def test_calendar_months_across_year_end(self):
+        months = statements.chart_months(datetime.date(2024, 2, 29))
+        self.assertEqual([m.isoformat() for m in months], ['2023-09-01', '2023-10-01', '2023-11-01', '2023-12-01', '2024-01-01', '2024-02-01'])
+
+    def test_metrics_bucket_by_calendar_month(self):
+        self.add_documents(2, datetime.date(2024, 1, 31))
+        self.add_documents(4, datetime.date(2024, 3, 1))
+        self.add_documents(2, datetime.date(2023, 8, 31))  # before the chart range
+        Account.objects.filter(pk=make_account(self.company, '1500', 'Asset').pk).update(current_balance=D('500'))
+        Account.objects.filter(pk=self.income.pk).update(current_balance=D('300'))
+        Account.objects.filter(pk=self.rent.pk).update(current_balance=D('120'))
+        m = statements.dashboard_metrics(self.company, today=datetime.date(2024, 3, 15))
+        self.assertEqual(m['chart_labels'], ['Oct', 'Nov', 'Dec', 'Jan', 'Feb', 'Mar', 'FORECAST'])
+        self.assertEqual(m['income_data'], [0.0, 0.0, 0.0, 100.0, 0.0, 200.0, 100.0])
+        self.assertEqual(m['expense_data'], [0.0, 0.0, 0.0, 80.0, 0.0, 160.0, 80.0])
+        self.assertEqual((m['total_assets'], m['total_ar'], m['net_income']), (D('500'), D('400.00'), D('180')))
+        self.assertEqual((m['category_labels'], m['category_data']), (['Acct 6000'], [320.0]))
+
+    def test_kpis_keep_their_account_types(self):
+        balances = {'Asset': 500, 'Bank': 70, 'Fixed Assets': 900, 'Income': 300, 'Other Income': 20, 'Sales': 1000,
+                    'Expenses': 120, 'Cost of Goods Sold': 30, 'Other Expense': 15, 'Depreciation': 45}
+        for i, (acc_type, balance) in enumerate(balances.items()):
+            Account.objects.filter(pk=make_account(self.company, f"9{i:03d}", acc_type).pk).update(current_balance=D(balance))
+        m = statements.dashboard_metrics(self.company, today=datetime.date(2024, 3, 15))
+        # Only 'Asset' counts as assets; 'Sales', 'Other Expense' and 'Depreciation' stay out of net income
+        self.assertEqual((m['total_assets'], m['net_income']), (D(500), D(300 + 20 - 120 - 30)))
+
+    def test_query_count_does_not_grow_with_data(self):
+        self.add_documents(1, timezone.localdate())
+        with CaptureQueriesContext(connection) as small:
+            self.client.get(reverse('dashboard'))
+        for months_ago in range(8):
+            self.add_documents(3, timezone.localdate() - datetime.timedelta(days=31 * months_ago))
+        with CaptureQueriesContext(connection) as large:
+            self.assertEqual(self.client.get(reverse('dashboard')).status_code, 200)
+        self.assertEqual(len(small.captured_queries), len(large.captured_queries))
+        self.assertLessEqual(len(large.captured_queries), 12)
+
+
+class ReportCacheTests(TestCase):
+    def setUp(self):
+        report_cache.get_cache().clear()
+        self.user, self.company = make_company()
+        self.bank = make_account(self.company, '1000')
+        self.income = make_account(self.company, '4000', 'Income', 'Credit')
+        ledger.record_posting(make_voucher(self.company, datetime.date(2024, 1, 5), [(self.bank, 50, 0), (self.income, 0, 50)]))
+        posting.bump_ledger_version(self.company.pk)
+        self.client.force_login(self.user)
+
+    def version(self):
+        return Company.objects.get(pk=self.company.pk).ledger_version
+
+    def income_statement(self):
+        return self.client.get(reverse('income_statement'), {'start_date': '2024-01-01', 'end_date': '2024-12-31'})
+
+    def test_served_from_cache_until_an_edit(self):
+        self.assertEqual(self.income_statement().context['inc_total'], D(50))
+        with CaptureQueriesContext(connection) as ctx:
+            self.income_statement()
+        self.assertFalse(any('accounting_journalvoucherline' in q['sql'] for q in ctx.captured_queries))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('edit_account', args=[self.income.id]), {
+                'account_number': '4000', 'account_name': 'Sales', 'account_type': 'Income', 'normal_balance': 'Credit'})
+        self.assertEqual(self.income_statement().context['inc_list'][0]['name'], 'Sales')
+
+    def test_reconciliation_and_deletes_bump_version(self):
+        bank_account = BankAccount.objects.create(company=self.company, name='Main', account_number='1', gl_account=self.bank)
+        before = self.version()
+        with self.captureOnCommitCallbacks(execute=True):
+            reconciliation.adjust_totals(bank_account, cleared=D(10))
+        self.assertEqual(self.version(), before + 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            Budget.objects.create(company=self.company, name='Plan', year=2024).delete()
+        self.assertEqual(self.version(), before + 3)
+
+    def test_bulk_line_inserts_invalidate_trial_balance_and_dashboard(self):
+        trial_balance = lambda: report_cache.cached_report(Company.objects.get(pk=self.company.pk), 'trial_balance', statements.trial_balance, None)
+        self.assertEqual(trial_balance()['total_debits'], D(50))
+        self.client.get(reverse('dashboard'))
+
+        day = datetime.date(2024, 1, 6)
+        [jv] = JournalVoucher.objects.bulk_create([
+            JournalVoucher(company=self.company, jv_number='BULK-1', jv_date=day, description='bulk', status='Posted')])
+        with self.captureOnCommitCallbacks(execute=True):
+            importers.insert_lines([(self.company.pk, jv.pk, self.bank.pk, D(25), D(0), '', day, 'Posted'),
+                                    (self.company.pk, jv.pk, self.income.pk, D(0), D(25), '', day, 'Posted')])
+            ledger.record_posting(jv)
+        self.assertEqual(trial_balance()['total_debits'], D(75))
+        with mock.patch('accounting.statements.dashboard_metrics', wraps=statements.dashboard_metrics) as dashboard_metrics:
+            self.client.get(reverse('dashboard'))
+        dashboard_metrics.assert_called_once()
+
+    def test_company_saves_keep_a_concurrent_version_bump(self):
+        stale = Company.objects.get(pk=self.company.pk)
+        posting.bump_ledger_version(self.company.pk)
+        bumped = self.version()
+        with mock.patch('accounting.middleware.resolve_company', return_value=stale):
+            self.client.post(reverse('settings_view'), {'company_name': 'Renamed', 'address': '', 'email': '', 'phone': '', 'website': ''})
+        self.assertEqual((Company.objects.get(pk=self.company.pk).name, self.version()), ('Renamed', bumped))
+        stale.phone = '555'
+        stale.save()
+        self.assertEqual(self.version(), bumped)
+
+    def test_key_covers_company_version_and_params(self):
+        key = report_cache.report_key(self.company, 'balance_sheet', [datetime.date(2024, 1, 31)])
+        self.assertEqual(key, report_cache.report_key(self.company, 'balance_sheet', ['2024-01-31']))
+        self.assertNotEqual(key, report_cache.report_key(self.company, 'balance_sheet', ['2024-02-29']))
+        self.assertNotEqual(key, report_cache.report_key(self.company, 'income_statement', ['2024-01-31']))
+        self.company.ledger_version += 1
+        self.assertNotEqual(key, report_cache.report_key(self.company, 'balance_sheet', [datetime.date(2024, 1, 31)]))
+
+
+class ReportETagTests(TestCase):
+    def setUp(self):
+        self.user, self.company = make_company()
+        self.bank = make_account(self.company, '1000')
+        self.income = make_account(self.company, '4000', 'Income', 'Credit')
+        make_voucher(self.company, datetime.date(2024, 1, 5), [(self.bank, 50, 0), (self.income, 0, 50)])
+        self.client.force_login(self.user)
+
+    def test_unchanged_report_answers_304_without_computing(self):
+        url, params = reverse('balance_sheet'), {'target_date': '2024-01-31'}
+        etag = self.client.get(url, params)['ETag']
+        with CaptureQueriesContext(connection) as ctx:
+            resp = self.client.get(url, params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 304)
+        self.assertFalse(any('accounting_account' in q['sql'] or 'journalvoucherline' in q['sql'] for q in ctx.captured_queries))
+        self.assertNotEqual(self.client.get(url, {'target_date': '2024-02-29'})['ETag'], etag)
+
+        posting.bump_ledger_version(self.company.pk)
+        self.assertEqual(self.client.get(url, params, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_csv_exports_are_conditional(self):
+        for url in (reverse('download_all_vouchers'), reverse('download_trial_balance'), reverse('income_statement')):
+            resp = self.client.get(url)
+            self.assertIn('private', resp['Cache-Control'])
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=resp['ETag']).status_code, 304)
+
+    def test_voucher_import_changes_export_etag(self):
+        url = reverse('download_all_vouchers')
+        etag = self.client.get(url)['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('upload_voucher'), {'csv_file': SimpleUploadedFile(
+                'jv.csv', b'Voucher,Date,Account,Debit,Credit\nIMP-1,2024-01-07,1000,5,\nIMP-1,2024-01-07,4000,,5')})
+        resp = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp['ETag'], etag)
+        self.assertIn(b'IMP-1', b''.join(resp.streaming_content))
+
+
+class CompanyMiddlewareTests(TestCase):
+    def test_company_created_at_login_not_on_requests(self):
+        admin = User.objects.create_superuser('admin', password='pw')
+        self.client.force_login(admin)
+        company = Company.objects.get(owner=admin)
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(self.client.get(reverse('account_list')).context['request'].company, company)
+        self.assertFalse(any(q['sql'].startswith('INSERT') for q in ctx.captured_queries))
+
+    def test_logged_in_user_without_company_gets_one(self):
+        admin = User.objects.create_superuser('admin', password='pw')
+        self.client.force_login(admin)
+        Company.objects.filter(owner=admin).delete()  # a session from before the company was created at login
+        for name in ('dashboard', 'trial_balance_report', 'settings_view'):
+            self.assertEqual(self.client.get(reverse(name)).status_code, 200, name)
+        self.client.post(reverse('settings_view'), {'company_name': 'Admin Co', 'address': '', 'email': '', 'phone': '', 'website': ''})
+        self.assertEqual(Company.objects.get(owner=admin).name, 'Admin Co')
+
+    def test_resolved_with_one_query_per_request(self):
+        user, company = make_company()
+        make_company('other')
+        request = RequestFactory().get('/')
+        request.user = user
+        with self.assertNumQueries(1):
+            self.assertEqual(middleware.resolve_company(request), company)
+        posting.bump_ledger_version(company.pk)
+        self.assertEqual(middleware.resolve_company(request).ledger_version, company.ledger_version + 1)
+
+
+# --- ROUTE QUERY BUDGETS ---
+# Maximum queries for a GET of each route in accounting/urls.py, with the
+# tenant seeded at ROUTE_ROWS_SMALL and at ROUTE_ROWS_LARGE rows per model.
+# Both sizes must give the same count: a budget that is only met at the
+# small size means a per-row query crept in.
+ROUTE_QUERY_BUDGETS = {
+    'dashboard': 11, 'profile_view': 3, 'settings_view': 3, 'account_list': 4, 'add_account': 3,
+    'edit_account': 4, 'account_ledger': 5, 'account_ledger_json': 5, 'voucher_list': 4, 'create_voucher': 6,
+    'upload_voucher': 3, 'voucher_detail': 8, 'edit_voucher': 6, 'download_single_voucher': 5, 'download_all_vouchers': 4,
+    'export_list': 5, 'export_status': 4, 'report_index': 3, 'trial_balance_report': 3, 'download_trial_balance': 5,
+    'income_statement': 5, 'balance_sheet': 5, 'ar_aging': 3, 'ap_aging': 3, 'sales_by_customer': 3,
+    'custom_report': 5, 'po_list': 4, 'create_po': 5, 'po_detail': 9, 'change_po_status': 3,
+    'vendor_list': 4, 'add_vendor': 3, 'edit_vendor': 4, 'vendor_detail': 6, 'expense_list': 4,
+    'create_expense': 10, 'expense_detail': 9, 'change_expense_status': 3, 'predict_expense_account': 3, 'customer_list': 4,
+    'add_customer': 3, 'edit_customer': 4, 'customer_detail': 5, 'invoice_list': 4, 'create_invoice': 9,
+    'invoice_detail': 7, 'change_invoice_status': 3, 'receive_payment': 8, 'refund_invoice': 8, 'product_list': 4,
+    'add_product': 8, 'stock_levels': 6, 'delete_product': 3, 'asset_list': 4, 'add_asset': 6,
+    'asset_detail': 7, 'edit_asset': 7, 'dispose_asset': 8, 'depreciation_view': 4, 'project_list': 4,
+    'add_project': 4, 'project_detail': 9, 'change_project_status': 3, 'delete_project': 3, 'project_profitability_report': 5,
+    'budget_list': 4, 'add_budget': 3, 'edit_budget': 6, 'budget_variance': 6, 'latest_budget_variance': 4,
+    'delete_budget': 3, 'bank_account_list': 5, 'add_bank_account': 4, 'delete_bank_account': 3, 'upload_bank_statement': 4,
+    'reconcile_bank': 6, 'reconcile_lines_json': 5, 'auto_match_bank': 12, 'match_group': 4,
+    'unmatch_group': 3,
+}
+# Routes that change data on GET, read an export file from disk or are closed to tenants; each has its own tests.
+ROUTE_WRITES_ON_GET = {
+    'toggle_account_activity', 'recalculate_balances', 'toggle_vendor_activity', 'toggle_customer_activity',
+    'adjust_stock', 'post_voucher', 'post_depreciation', 'match_transaction', 'unmatch_transaction', 'download_export',
+    'metrics',
+}
+# Routes that only accept POST; a GET must be turned away with 405 within its budget.
+ROUTE_POST_ONLY = {'unmatch_group'}
+ROUTE_ROWS_SMALL, ROUTE_ROWS_LARGE = 10, 1000
+# Wall time of each route at ROUTE_ROWS_LARGE. Every run must stay under
+# ROUTE_MAX_SECONDS; with ACCOUNTING_LATENCY_BASELINE set to a JSON file, the
+# timings are written there on the first run and later runs fail on any
+# route slower than LATENCY_TOLERANCE times its recorded baseline.
+ROUTE_MAX_SECONDS = 5
+LATENCY_BASELINE = os.environ.get('ACCOUNTING_LATENCY_BASELINE')
+LATENCY_TOLERANCE, LATENCY_SLACK = 3, 0.05
+
+
+class RouteBudgetTests(TestCase):
+    def setUp(self):
+        report_cache.get_cache().clear()
+        self.user, self.company = make_company()
+        c = self.company
+        self.bank = make_account(c, '1000')
+        self.ar = make_account(c, '1100', 'Accounts Receivable')
+        self.inventory = make_account(c, '1200', 'Inventory')
+        self.asset_acc = make_account(c, '1500', 'Fixed Assets')
+        self.accum = make_account(c, '1590', 'Fixed Assets', 'Credit')
+        self.ap = make_account(c, '2000', 'Accounts Payable', 'Credit')
+        self.income = make_account(c, '4000', 'Income', 'Credit')
+        self.expense = make_account(c, '6000', 'Expenses')
+        self.bank_account = BankAccount.objects.create(company=c, name='Checking', account_number='1', gl_account=self.bank)
+        self.warehouse = Warehouse.objects.create(company=c, name='Main')
+        self.budget = Budget.objects.create(company=c, name='Plan', year=2024)
+        self.seeded = 0
+        self.client.force_login(self.user)
+
+    def seed(self, total):
+        """Bring every list the routes read up to `total` rows."""
+        c, start = self.company, self.seeded
+        day = lambda i: datetime.date(2024, 1, 1) + datetime.timedelta(days=i % 360)
+        idx = range(start, total)
+        accounts = Account.objects.bulk_create([
+            Account(company=c, account_number=f"7{i:05d}", account_name=f"Cost {i}", account_type='Expenses', normal_balance='Debit') for i in idx])
+        customers = Customer.objects.bulk_create([Customer(company=c, name=f"Customer {i}") for i in idx])
+        vendors = Vendor.objects.bulk_create([Vendor(company=c, name=f"Vendor {i}") for i in idx])
+        projects = Project.objects.bulk_create([Project(company=c, name=f"Project {i}", code=f"P-{i}", customer=customers[k]) for k, i in enumerate(idx)])
+        products = Product.objects.bulk_create([
+            Product(company=c, sku=f"SKU-{i}", name=f"Product {i}", preferred_vendor=vendors[k], inventory_asset_account=self.inventory,
+                    revenue_account=self.income, unit_cost=D(5), unit_price=D(9)) for k, i in enumerate(idx)])
+        StockItem.objects.bulk_create([StockItem(company=c, product=p, warehouse=self.warehouse, quantity=10) for p in products])
+        invoices = Invoice.objects.bulk_create([
+            Invoice(company=c, customer=customers[k], project=projects[k], ar_account=self.ar, invoice_number=f"INV-{i}", invoice_date=day(i),
+                    due_date=day(i + 30), total_amount=D(90), status='Sent') for k, i in enumerate(idx)])
+        InvoiceLine.objects.bulk_create([
+            InvoiceLine(company=c, invoice=inv, product=products[k], revenue_account=self.income, description='Goods', quantity=10,
+                        unit_price=D(9), line_total=D(90)) for k, inv in enumerate(invoices)])
+        expenses = Expense.objects.bulk_create([
+            Expense(company=c, vendor=vendors[k], project=projects[k], payment_account=self.bank, expense_date=day(i), total_amount=D(40))
+            for k, i in enumerate(idx)])
+        ExpenseLine.objects.bulk_create([ExpenseLine(company=c, expense=e, expense_account=accounts[k], amount=D(40)) for k, e in enumerate(expenses)])
+        orders = PurchaseOrder.objects.bulk_create([
+            PurchaseOrder(company=c, po_number=f"PO-{i}", po_date=day(i), vendor=vendors[k], total_amount=D(50)) for k, i in enumerate(idx)])
+        PurchaseOrderLine.objects.bulk_create([
+            PurchaseOrderLine(company=c, purchase_order=po, account=self.expense, item_description='Stock', quantity=5, unit_price=D(10),
+                              line_total=D(50)) for po in orders])
+        FixedAsset.objects.bulk_create([
+            FixedAsset(company=c, asset_number=f"FA-{i}", name=f"Asset {i}", category='Equipment', location='HQ', vendor=vendors[k],
+                       acquisition_date=day(i), purchase_cost=D(1200), useful_life_years=5, asset_account=self.asset_acc,
+                       depreciation_expense_account=self.expense, accumulated_depreciation_account=self.accum) for k, i in enumerate(idx)])
+        BudgetItem.objects.bulk_create([BudgetItem(company=c, budget=self.budget, account=a, monthly_amount=D(30)) for a in accounts])
+        vouchers = JournalVoucher.objects.bulk_create([
+            JournalVoucher(company=c, jv_number=f"JV-{i}", jv_date=day(i), description=f"Entry {i}", status='Posted') for i in idx])
+        JournalVoucherLine.objects.bulk_create([
+            line for k, jv in enumerate(vouchers) for line in (
+                JournalVoucherLine(company=c, journal_voucher=jv, account=self.bank, debit_amount=D(k + 1)),
+                JournalVoucherLine(company=c, journal_voucher=jv, account=accounts[k], credit_amount=D(k + 1)))])
+        BankStatementLine.objects.bulk_create([
+            BankStatementLine(company=c, bank_account=self.bank_account, date=day(i), description=f"Deposit {i}", amount=D(i + 1),
+                              content_hash=f"seed-{i}") for i in idx])
+        ledger.rebuild_period_balances(c)
+        posting.recalculate_balances(c)
+        self.seeded = total
+
+    def route_kwargs(self):
+        c = self.company
+        first = lambda model: model.objects.filter(company=c).order_by('id').values_list('id', flat=True).first()
+        return {
+            'account_id': self.bank.id, 'jv_id': first(JournalVoucher), 'job_id': self.job.id, 'po_id': first(PurchaseOrder),
+            'vendor_id': first(Vendor), 'expense_id': first(Expense), 'customer_id': first(Customer), 'invoice_id': first(Invoice),
+            'product_id': first(Product), 'asset_id': first(FixedAsset), 'project_id': first(Project), 'budget_id': self.budget.id,
+            'bank_id': self.bank_account.id, 'side': 'bank', 'new_status': 'Sent',
+            'group_id': 0,  # unmatch_group turns GETs away before looking the group up
+        }
+
+    def routes(self):
+        for pattern in urls.urlpatterns:
+            if pattern.name not in ROUTE_WRITES_ON_GET:
+                yield pattern.name, sorted(pattern.pattern.converters)
+
+    def measure(self):
+        kwargs = self.route_kwargs()
+        results = {}
+        for name, params in self.routes():
+            url = reverse(name, kwargs={p: kwargs[p] for p in params})
+            report_cache.get_cache().clear()
+            connection.queries_log.clear()  # keeps CaptureQueriesContext clear of the 9000-query log limit
+            with CaptureQueriesContext(connection) as ctx:
+                started = time.perf_counter()
+                resp = self.client.get(url)
+                if resp.streaming:
+                    b''.join(resp.streaming_content)
+                elapsed = time.perf_counter() - started
+            if name in ROUTE_POST_ONLY:
+                self.assertEqual(resp.status_code, 405, name)
+            else:
+                self.assertLess(resp.status_code, 400, name)
+            results[name] = (len(ctx.captured_queries), elapsed)
+        return results
+
+    def test_every_route_is_budgeted(self):
+        names = {p.name for p in urls.urlpatterns}
+        self.assertEqual(names - ROUTE_WRITES_ON_GET, set(ROUTE_QUERY_BUDGETS))
+
+    def test_query_counts_do_not_grow_with_rows(self):
+        self.job = ExportJob.objects.create(company=self.company, requested_by=self.user, kind='vouchers')
+        self.seed(ROUTE_ROWS_SMALL)
+        small = self.measure()
+        self.seed(ROUTE_ROWS_LARGE)
+        large = self.measure()
+        for name, (queries, seconds) in large.items():
+            with self.subTest(route=name):
+                self.assertEqual(queries, small[name][0], f"{name} issues a query per row")
+                self.assertLessEqual(queries, ROUTE_QUERY_BUDGETS[name])
+                self.assertLess(seconds, ROUTE_MAX_SECONDS)
+        self.check_latency_baseline({name: seconds for name, (queries, seconds) in large.items()})
+
+    def check_latency_baseline(self, timings):
+        if not LATENCY_BASELINE:
+            return
+        if not os.path.exists(LATENCY_BASELINE):
+            with open(LATENCY_BASELINE, 'w') as f:
+                json.dump({name: round(t, 4) for name, t in sorted(timings.items())}, f, indent=2)
+            return
+        with open(LATENCY_BASELINE) as f:
+            baseline = json.load(f)
+        slower = {name: (baseline[name], round(t, 4)) for name, t in timings.items()
+                  if name in baseline and t > baseline[name] * LATENCY_TOLERANCE + LATENCY_SLACK}
+        self.assertFalse(slower, f"routes slower than {LATENCY_TOLERANCE}x their baseline (baseline, now): {slower}")
+
+
+class SeedTenantTests(TestCase):
+    PROFILE = dict(seeding.PROFILES['small'], vouchers=400, invoices=30, expenses=30, statement_lines=50)
+
+    def seed(self, index, seed=3):
+        return seeding.seed_company(random.Random(seed), index, self.PROFILE, datetime.date(2024, 6, 30), 'pw')
+
+    def journal(self, company):
+        return list(JournalVoucherLine.objects.filter(company=company).order_by('journal_voucher__jv_date', 'id')
+                    .values_list('journal_voucher__jv_date', 'debit_amount', 'credit_amount', 'status'))
+
+    def test_same_seed_gives_same_balanced_ledger(self):
+        first, second = self.seed('a'), self.seed('b')
+        self.assertEqual(self.journal(first), self.journal(second))
+        self.assertNotEqual(self.journal(first), self.journal(self.seed('c', seed=4)))
+
+        totals = JournalVoucherLine.objects.filter(company=first).aggregate(d=Sum('debit_amount'), c=Sum('credit_amount'))
+        self.assertEqual(totals['d'], totals['c'])
+        self.assertEqual(JournalVoucher.objects.filter(company=first).count(), 400)
+        self.assertEqual(ledger.check_period_balances(first), [])
+        self.assertEqual(posting.recalculate_balances(first, dry_run=True), [])
+        self.assertTrue(BankStatementLine.objects.filter(company=first).exists())
+
+    def test_command_refuses_existing_seed(self):
+        out = io.StringIO()
+        call_command('seed_tenant', '--vouchers', '50', '--seed', '9', '--end-date', '2024-06-30', stdout=out)
+        self.assertIn('seeded in', out.getvalue())
+        with self.assertRaises(CommandError):
+            call_command('seed_tenant', '--vouchers', '50', '--seed', '9', stdout=io.StringIO())
+
+
+class BenchmarkReportsTests(TestCase):
+    def test_run_records_each_report_and_size(self):
+        run = benchmarks.run_benchmarks([40, 80], ['balance_sheet', 'vouchers_csv'], warmup=0, repetitions=2)
+        self.assertEqual(sorted(run['results']), ['balance_sheet@40', 'balance_sheet@80', 'vouchers_csv@40', 'vouchers_csv@80'])
+        row = run['results']['balance_sheet@80']
+        self.assertLessEqual(row['p50_ms'], row['p95_ms'])
+        self.assertEqual(row['queries'], run['results']['balance_sheet@40']['queries'])
+        self.assertIn('vm_steps_k', row)
+        self.assertEqual(JournalVoucher.objects.filter(description__in=[k[0] for k in seeding.ENTRY_KINDS]).count(), 120)
+
+        baseline = {'results': {'balance_sheet@40': {'p50_ms': row['p50_ms'] / 2, 'queries': 99}, 'dashboard@40': {'p50_ms': 1.0}}}
+        rows = {r[0]: r for r in benchmarks.compare(baseline, run)}
+        self.assertEqual(rows['balance_sheet@40'][2]['queries'], (99, row['queries']))
+        self.assertEqual(rows['balance_sheet@80'][2]['p50_ms'][0], None)
+        self.assertEqual(rows['dashboard@40'][2]['p95_ms'], (None, None))
+        self.assertEqual(set(rows['balance_sheet@40'][2]), {'p50_ms', 'p95_ms', 'queries', 'peak_kb', 'rows_scanned', 'vm_steps_k'})
+        self.assertEqual(list(rows)[:2], ['balance_sheet@40', 'balance_sheet@80'])
+
+
+class LoadTestTests(TransactionTestCase):
+    def setUp(self):
+        self.company = seeding.seed_company(random.Random(1), 'load', benchmarks.dataset_profile(40), datetime.date(2024, 6, 30), password=None)
+
+    def test_workers_post_every_operation_and_keep_the_ledger_intact(self):
+        with ticking_clock():
+            run = loadtest.run_load_test(self.company, workers=1, operations=12, seed=3)
+        total = run['results']['total']
+        self.assertEqual(set(run['results']), set(loadtest.OPERATIONS) | {'total'})
+        self.assertEqual((total['requests'], total['ok'], total['unique'], total['deadlock'], total['error']), (12, 12, 0, 0, 0))
+        self.assertEqual(run['integrity'], {'balance_drift': 0, 'period_mismatches': 0, 'unbalanced_vouchers': 0})
+        self.assertEqual(JournalVoucher.objects.filter(company=self.company, status='Draft', description__startswith='Load test').count(), 0)
+
+    def test_colliding_document_numbers_are_counted(self):
+        with mock.patch('django.utils.timezone.now', return_value=timezone.now()):
+            run = loadtest.run_load_test(self.company, workers=1, operations=3, mix={'create_invoice': 1})
+        row = run['results']['create_invoice']
+        self.assertEqual((row['ok'], row['unique']), (1, 2))
+        self.assertIn('invoice_number', run['failures']['unique'][0])
+
+    def test_mix_and_classification(self):
+        self.assertEqual(loadtest.parse_mix('create_invoice=3,post_voucher'), {'create_invoice': 3, 'post_voucher': 1})
+        with self.assertRaises(ValueError):
+            loadtest.parse_mix('delete_everything=1')
+        self.assertEqual(loadtest.classify(IntegrityError('UNIQUE constraint failed: accounting_invoice.invoice_number')), 'unique')
+        self.assertEqual(loadtest.classify(OperationalError('deadlock detected')), 'deadlock')
+        self.assertEqual(loadtest.classify(OperationalError('database is locked')), 'deadlock')
+        self.assertEqual(loadtest.classify(ValueError('bad')), 'error')
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        metrics.registry.clear()
+        self.user, self.company = make_company()
+        self.client.force_login(self.user)
+        self.bank = make_account(self.company, '1000')
+        self.equity = make_account(self.company, '3000', 'Equity', 'Credit')
+        make_voucher(self.company, datetime.date(2024, 1, 2), [(self.bank, 100, 0), (self.equity, 0, 100)])
+
+    def series(self, metric, view):
+        return metrics.collect()[(metric, view, self.company.pk)]
+
+    def test_records_request_per_view_and_company(self):
+        self.client.get(reverse('account_list'))
+        with CaptureQueriesContext(connection) as ctx:
+            resp = self.client.get(reverse('account_list'))
+        queries = self.series('riska_request_sql_queries', 'account_list')
+        self.assertEqual(sum(queries[:-1]), 2)
+        self.assertEqual(queries[-1], 2 * len(ctx.captured_queries))
+        self.assertEqual(self.series('riska_response_size_bytes', 'account_list')[-1], 2 * len(resp.content))
+        self.assertGreater(self.series('riska_request_template_seconds', 'account_list')[-1], 0)
+
+    def test_streaming_response_is_recorded_once_sent(self):
+        resp = self.client.get(reverse('download_all_vouchers'))
+        self.assertNotIn(('riska_request_duration_seconds', 'download_all_vouchers', self.company.pk), metrics.collect())
+        body = b''.join(resp.streaming_content)
+        resp.close()
+        self.assertEqual(self.series('riska_response_size_bytes', 'download_all_vouchers')[-1], len(body))
+        self.assertGreater(self.series('riska_request_sql_queries', 'download_all_vouchers')[-1], 0)
+
+    def test_endpoint_serves_prometheus_text(self):
+        self.client.get(reverse('account_list'))
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 404)
+        self.user.is_staff = True
+        self.user.save()
+        resp = self.client.get(reverse('metrics'))
+        self.assertEqual(resp['Content-Type'], metrics.CONTENT_TYPE)
+        text = resp.content.decode()
+        self.assertIn('# TYPE riska_request_duration_seconds histogram', text)
+        self.assertIn(f'riska_request_duration_seconds_bucket{{view="account_list",company="{self.company.pk}",le="+Inf"}} 1', text)
+        self.assertIn(f'riska_request_sql_queries_count{{view="account_list",company="{self.company.pk}"}} 1', text)
+        self.client.logout()
+        with self.settings(METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+            self.assertEqual(self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+            self.assertEqual(self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+
+    def test_workers_are_added_up_from_the_shared_directory(self):
+        with tempfile.TemporaryDirectory() as directory, self.settings(METRICS_MULTIPROC_DIR=directory):
+            self.client.get(reverse('account_list'))
+            other_worker = [[metric, 'account_list', self.company.pk, row] for (metric, _, _), row in metrics.collect().items()]
+            with open(os.path.join(directory, '999999.json'), 'w') as f:
+                json.dump(other_worker, f)
+            self.assertEqual(sum(self.series('riska_request_duration_seconds', 'account_list')[:-1]), 2)
+            self.assertEqual(sorted(os.listdir(directory)), sorted(['999999.json', f"{os.getpid()}.json"]))
+
+    def test_series_are_bounded(self):
+        registry = metrics.Registry(max_series=2)
+        sample = metrics.Sample()
+        for company in (1, 2, 3, 4):
+            registry.observe('dashboard', company, sample.values())
+        companies = {company for _, _, company, _ in registry.snapshot()}
+        self.assertEqual(companies, {1, 2, 'other'})
@@ -16,6 +16,7 @@ urlpatterns = [
     path('toggle_activity/<int:account_id>/', views.toggle_account_activity, name='toggle_account_activity'),
     path('recalculate-balances/', views.recalculate_balances, name='recalculate_balances'),
     path('account/<int:account_id>/ledger/', views.account_ledger, name='account_ledger'),
+    path('account/<int:account_id>/ledger/json/', views.account_ledger_json, name='account_ledger_json'),
 
     # --- Journal Voucher URLs ---
     path('vouchers/', views.voucher_list, name='voucher_list'),
@@ -26,6 +27,9 @@ urlpatterns = [
     path('vouchers/<int:jv_id>/post/', views.post_voucher, name='post_voucher'),
     path('vouchers/<int:jv_id>/download/', views.download_single_voucher, name='download_single_voucher'),
     path('vouchers/download_all/', views.download_all_vouchers, name='download_all_vouchers'),
+    path('exports/', views.export_list, name='export_list'),
+    path('exports/<int:job_id>/status/', views.export_status, name='export_status'),
+    path('exports/<int:job_id>/download/', views.download_export, name='download_export'),
     
     # --- Reporting URLs ---
     path('reports/', views.report_index, name='report_index'),
@@ -111,6 +115,13 @@ urlpatterns = [
     path('banking/delete/<int:bank_id>/', views.delete_bank_account, name='delete_bank_account'),
     path('banking/<int:bank_id>/upload/', views.upload_bank_statement, name='upload_bank_statement'),
     path('banking/<int:bank_id>/reconcile/', views.reconcile_bank, name='reconcile_bank'),
+    path('banking/<int:bank_id>/reconcile/<str:side>/json/', views.reconcile_lines_json, name='reconcile_lines_json'),
+    path('banking/<int:bank_id>/auto-match/', views.auto_match_bank, name='auto_match_bank'),
+    path('banking/<int:bank_id>/group/', views.match_group, name='match_group'),
     path('banking/match/<int:statement_id>/<int:jv_line_id>/', views.match_transaction, name='match_transaction'),
     path('banking/unmatch/<int:statement_id>/', views.unmatch_transaction, name='unmatch_transaction'),
+    path('banking/unmatch-group/<int:group_id>/', views.unmatch_group, name='unmatch_group'),
+
+    # --- Monitoring ---
+    path('metrics', views.prometheus_metrics, name='metrics'),
 ]
\ No newline at end of file
@@ -1,21 +1,22 @@
 import re
 import random
-import csv
 import decimal
-import calendar
-from datetime import datetime, timedelta
+from datetime import datetime
 
 from django.conf import settings
 from django.core.mail import send_mail
-from django.http import HttpResponse, JsonResponse
+from django.http import Http404, HttpResponse, HttpResponseForbidden, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render, redirect, get_object_or_404 # <--- This fixes the NameError
+from django.urls import reverse
 from django.utils import timezone
 from django.contrib import messages
 from django.contrib.auth import login
 from django.contrib.auth.decorators import login_required
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition, require_POST
 from django.contrib.auth.forms import UserCreationForm
 from django.db import transaction
-from django.db.models import Sum, Q, Count
+from django.db.models import Sum, Q, Count, F, OuterRef, Subquery
 
 # Import your forms and models
 from .forms import ClientRegistrationForm
@@ -26,24 +27,40 @@ from .models import (
     Account, JournalVoucher, JournalVoucherLine, 
     PurchaseOrder, PurchaseOrderLine, Vendor, 
     Expense, ExpenseLine, Customer, Invoice, InvoiceLine,
-    BankAccount, BankStatementLine,
+    BankAccount, BankStatementLine, ReconciliationGroup,
     Product, Warehouse, Category, StockItem, FixedAsset,
-    Budget, BudgetItem, Project, CompanySettings, Company
+    Budget, BudgetItem, Project, CompanySettings, Company, ExportJob
 )
+from . import exports, importers, ledger, metrics, posting, reconciliation, report_cache, statements
 
-# --- HELPER: GET USER'S COMPANY ---
-def get_company(request):
-    # 1. If user is not logged in, return None
-    if not request.user.is_authenticated:
+# --- HELPER: ETAGS FOR REPORTS AND EXPORTS ---
+def ledger_etag(request, *args, **kwargs):
+    """
+    ETag from the company's ledger version, the URL and query string, the
+    user and today's date (default report ranges depend on it). Needs
+    nothing beyond request.company, so a matching If-None-Match gets its
+    304 without the report being computed.
+    """
+    if request.company is None:
         return None
-    
-    # 2. Try to get their company
-    try:
-        return request.user.company_profile
-    except Company.DoesNotExist:
-        # 3. EMERGENCY FIX: If logged-in user has no company (like the Superuser),
-        # create one for them right now so the system works.
-        return Company.objects.create(name=f"{request.user.username}'s Company", owner=request.user)
+    return report_cache.etag(request.company, request.path, sorted(request.GET.lists()), request.user.pk, timezone.localdate())
+
+def ledger_conditional(view):
+    """ETag the view with ledger_etag; browsers keep the response privately and revalidate it on every use."""
+    return cache_control(private=True, no_cache=True)(condition(etag_func=ledger_etag)(view))
+
+# --- HELPER: RESOLVE FORM IDS IN ONE QUERY ---
+def company_in_bulk(model, company, ids):
+    """
+    Fetch every object referenced by a list of posted ids with one query,
+    scoped to the company. Blank entries are ignored; an id that does not
+    belong to the company raises DoesNotExist, like objects.get() would.
+    """
+    wanted = {int(i) for i in ids if i}
+    found = model.objects.filter(company=company).in_bulk(wanted)
+    if len(found) != len(wanted):
+        raise model.DoesNotExist(f"{model.__name__} not found: {sorted(wanted - set(found))}")
+    return found
 
 # --- AUTHENTICATION ---
 # In accounting/views.py
@@ -88,7 +105,7 @@ def verify_email(request):
         if entered_code == company.verification_code:
             # Success!
             company.is_verified = True
-            company.save()
+            company.save(update_fields=['is_verified'])
             
             # Log them in
             login(request, user)
@@ -115,7 +132,7 @@ def profile_view(request):
 @login_required
 def settings_view(request):
     # Only load the company belonging to this user
-    company = get_company(request)
+    company = request.company
     
     if request.method == 'POST':
         company.name = request.POST.get('company_name')
@@ -123,9 +140,12 @@ def settings_view(request):
         company.email = request.POST.get('email')
         company.phone = request.POST.get('phone')
         company.website = request.POST.get('website')
+        fields = ['name', 'address', 'email', 'phone', 'website']
         if 'logo' in request.FILES:
             company.logo = request.FILES['logo']
-        company.save()
+            fields.append('logo')
+        # Never write ledger_version back: a posting may have bumped it since this request loaded the company
+        company.save(update_fields=fields)
         messages.success(request, "Settings updated.")
         return redirect('settings_view')
     return render(request, 'accounting/settings.html', {'company': company})
@@ -133,67 +153,22 @@ def settings_view(request):
 # --- DASHBOARD ---
 @login_required
 def dashboard(request):
-    company = get_company(request)
-    
-    # Filter ALL queries by company
-    total_assets = Account.objects.filter(company=company, account_type='Asset').aggregate(Sum('current_balance'))['current_balance__sum'] or decimal.Decimal(0)
-    total_ar = Invoice.objects.filter(company=company).exclude(status__in=['Paid', 'Void', 'Refunded']).aggregate(Sum('total_amount'))['total_amount__sum'] or decimal.Decimal(0)
-    total_ap = PurchaseOrder.objects.filter(company=company, status__in=['Issued', 'Received']).aggregate(Sum('total_amount'))['total_amount__sum'] or decimal.Decimal(0)
+    company = request.company
     
-    total_revenue = Account.objects.filter(company=company, account_type__in=['Revenue', 'Income', 'Other Income']).aggregate(Sum('current_balance'))['current_balance__sum'] or decimal.Decimal(0)
-    total_expenses = Account.objects.filter(company=company, account_type__in=['Expense', 'Expenses', 'Cost of Goods Sold']).aggregate(Sum('current_balance'))['current_balance__sum'] or decimal.Decimal(0)
-    net_income = total_revenue - total_expenses
-
-    recent_invoices = Invoice.objects.filter(company=company).order_by('-created_at')[:5]
-    recent_expenses = Expense.objects.filter(company=company).order_by('-created_at')[:5]
-
-    # Chart Data
-    today = timezone.now().date()
-    chart_labels = []
-    income_data = []
-    expense_data = []
-
-    for i in range(5, -1, -1):
-        d = today - timedelta(days=i*30)
-        chart_labels.append(f"{calendar.month_name[d.month][:3]}")
-        
-        monthly_income = Invoice.objects.filter(company=company, invoice_date__year=d.year, invoice_date__month=d.month).exclude(status='Void').aggregate(Sum('total_amount'))['total_amount__sum'] or 0
-        monthly_expense = Expense.objects.filter(company=company, expense_date__year=d.year, expense_date__month=d.month).aggregate(Sum('total_amount'))['total_amount__sum'] or 0
-        
-        income_data.append(float(monthly_income))
-        expense_data.append(float(monthly_expense))
-
-    if len(income_data) >= 3:
-        avg_income = sum(income_data[-3:]) / 3
-        avg_expense = sum(expense_data[-3:]) / 3
-    else:
-        avg_income = sum(income_data) / (len(income_data) or 1)
-        avg_expense = sum(expense_data) / (len(expense_data) or 1)
-
-    chart_labels.append("FORECAST")
-    income_data.append(round(avg_income, 2))
-    expense_data.append(round(avg_expense, 2))
-
-    expense_breakdown = ExpenseLine.objects.filter(expense__company=company).values('expense_account__account_name').annotate(total=Sum('amount')).order_by('-total')[:5]
-    category_labels = [i['expense_account__account_name'] for i in expense_breakdown]
-    category_data = [float(i['total']) for i in expense_breakdown]
+    context = report_cache.cached_report(company, 'dashboard', statements.dashboard_metrics, timezone.localdate())
+    context['recent_invoices'] = Invoice.objects.filter(company=company).select_related('customer').order_by('-created_at')[:5]
+    context['recent_expenses'] = Expense.objects.filter(company=company).select_related('vendor').order_by('-created_at')[:5]
 
     ai_insights = []
-    if total_ar > total_assets:
-        ai_insights.append({'type': 'warning', 'msg': f"Cash Flow Warning: Unpaid invoices (${total_ar:,.2f}) exceed cash assets."})
-
-    context = {
-        'total_assets': total_assets, 'total_ar': total_ar, 'total_ap': total_ap, 'net_income': net_income,
-        'recent_invoices': recent_invoices, 'recent_expenses': recent_expenses,
-        'chart_labels': chart_labels, 'income_data': income_data, 'expense_data': expense_data,
-        'category_labels': category_labels, 'category_data': category_data, 'ai_insights': ai_insights,
-    }
+    if context['total_ar'] > context['total_assets']:
+        ai_insights.append({'type': 'warning', 'msg': f"Cash Flow Warning: Unpaid invoices (${context['total_ar']:,.2f}) exceed cash assets."})
+    context['ai_insights'] = ai_insights
     return render(request, 'accounting/dashboard.html', context)
 
 # --- ACCOUNTS ---
 @login_required
 def account_list(request):
-    company = get_company(request)
+    company = request.company
     query = request.GET.get('search', '')
     if query:
         accounts = Account.objects.filter(company=company).filter(Q(account_number__icontains=query) | Q(account_name__icontains=query))
@@ -203,7 +178,7 @@ def account_list(request):
 
 @login_required
 def add_account(request):
-    company = get_company(request)
+    company = request.company
     if request.method == 'POST':
         try:
             # NEW QBO LOGIC
@@ -229,7 +204,7 @@ def add_account(request):
 
 @login_required
 def edit_account(request, account_id):
-    company = get_company(request)
+    company = request.company
     # Security: Ensure user owns this account
     account = Account.objects.get(pk=account_id, company=company)
     
@@ -245,7 +220,7 @@ def edit_account(request, account_id):
 
 @login_required
 def toggle_account_activity(request, account_id):
-    company = get_company(request)
+    company = request.company
     acc = Account.objects.get(pk=account_id, company=company)
     acc.is_active = not acc.is_active
     acc.save()
@@ -253,42 +228,58 @@ def toggle_account_activity(request, account_id):
 
 @login_required
 def recalculate_balances(request):
-    company = get_company(request)
-    dtype = ['Bank', 'Accounts Receivable', 'Other Current Assets', 'Fixed Assets', 'Other Assets', 'Cost of Goods Sold', 'Expenses', 'Other Expense']
-    
-    for acc in Account.objects.filter(company=company):
-        acc.normal_balance = 'Debit' if acc.account_type in dtype else 'Credit'
-        lines = JournalVoucherLine.objects.filter(account=acc, journal_voucher__status='Posted')
-        d = lines.aggregate(Sum('debit_amount'))['debit_amount__sum'] or decimal.Decimal(0)
-        c = lines.aggregate(Sum('credit_amount'))['credit_amount__sum'] or decimal.Decimal(0)
-        acc.current_balance = (d - c) if acc.normal_balance == 'Debit' else (c - d)
-        acc.save()
-    messages.success(request, "Balances recalculated.")
+    company = request.company
+    drift = posting.recalculate_balances(company)
+    messages.success(request, f"Balances recalculated ({len(drift)} corrected).")
     return redirect('account_list')
 
+def ledger_page_for_request(request, account):
+    """Keyset page of the account ledger for the GET filters (start_date, end_date, search, after)."""
+    params = {k: request.GET.get(k, '') for k in ('start_date', 'end_date', 'search')}
+    rows, opening, next_cursor = ledger.ledger_page(
+        account, after=ledger.parse_cursor(request.GET.get('after')),
+        start=params['start_date'] or None, end=params['end_date'] or None, search=params['search'])
+    return params, rows, opening, next_cursor
+
 @login_required
 def account_ledger(request, account_id):
-    company = get_company(request)
+    company = request.company
     account = Account.objects.get(pk=account_id, company=company)
-    lines = JournalVoucherLine.objects.filter(account=account, journal_voucher__status='Posted').order_by('journal_voucher__jv_date')
-    
-    bal = decimal.Decimal(0)
-    for l in lines:
-        if account.normal_balance == 'Debit': bal += (l.debit_amount - l.credit_amount)
-        else: bal += (l.credit_amount - l.debit_amount)
-    return render(request, 'accounting/account_ledger.html', {'account': account, 'transaction_lines': lines, 'calculated_balance': bal})
+    params, rows, opening, next_cursor = ledger_page_for_request(request, account)
+    return render(request, 'accounting/account_ledger.html', {
+        'account': account, 'transaction_lines': rows, 'opening_balance': opening,
+        'calculated_balance': rows[-1]['balance'] if rows else opening, 'next_cursor': next_cursor,
+        'first_page': not request.GET.get('after'),
+        'start_date': params['start_date'], 'end_date': params['end_date'], 'search_query': params['search'],
+    })
+
+@login_required
+def account_ledger_json(request, account_id):
+    """Same pages as account_ledger, for infinite scroll."""
+    company = request.company
+    account = Account.objects.get(pk=account_id, company=company)
+    params, rows, opening, next_cursor = ledger_page_for_request(request, account)
+    return JsonResponse({
+        'opening_balance': f"{opening:.2f}",
+        'next_cursor': next_cursor,
+        'lines': [{
+            'id': r['id'], 'date': r['posting_date'].isoformat(), 'jv_id': r['journal_voucher_id'],
+            'jv_number': r['jv_number'], 'description': r['description'], 'line_description': r['line_description'],
+            'debit': f"{r['debit_amount']:.2f}", 'credit': f"{r['credit_amount']:.2f}", 'balance': f"{r['balance']:.2f}",
+        } for r in rows],
+    })
 
 # --- VENDORS ---
 @login_required
 def vendor_list(request):
-    company = get_company(request)
+    company = request.company
     vendors = Vendor.objects.filter(company=company)
     return render(request, 'accounting/vendor_list.html', {'vendors': vendors})
 
 @login_required
 @login_required
 def add_vendor(request):
-    company = get_company(request)
+    company = request.company
     if request.method == 'POST':
         # --- PHONE FORMATTING LOGIC ---
         raw_phone = request.POST.get('phone', '')
@@ -310,7 +301,7 @@ def add_vendor(request):
 
 @login_required
 def edit_vendor(request, vendor_id):
-    company = get_company(request)
+    company = request.company
     vendor = Vendor.objects.get(pk=vendor_id, company=company)
     if request.method == 'POST':
         vendor.name = request.POST['name']
@@ -320,7 +311,7 @@ def edit_vendor(request, vendor_id):
 
 @login_required
 def toggle_vendor_activity(request, vendor_id):
-    company = get_company(request)
+    company = request.company
     v = Vendor.objects.get(pk=vendor_id, company=company)
     v.is_active = not v.is_active
     v.save()
@@ -328,7 +319,7 @@ def toggle_vendor_activity(request, vendor_id):
 
 @login_required
 def vendor_detail(request, vendor_id):
-    company = get_company(request)
+    company = request.company
     v = Vendor.objects.get(pk=vendor_id, company=company)
     pos = PurchaseOrder.objects.filter(vendor=v)
     exps = Expense.objects.filter(vendor=v)
@@ -337,13 +328,13 @@ def vendor_detail(request, vendor_id):
 # --- CUSTOMERS ---
 @login_required
 def customer_list(request):
-    company = get_company(request)
+    company = request.company
     c = Customer.objects.filter(company=company)
     return render(request, 'accounting/customer_list.html', {'customers': c})
 
 @login_required
 def add_customer(request):
-    company = get_company(request)
+    company = request.company
     if request.method == 'POST':
         # --- PHONE FORMATTING LOGIC ---
         raw_phone = request.POST.get('phone', '')
@@ -365,7 +356,7 @@ def add_customer(request):
 
 @login_required
 def edit_customer(request, customer_id):
-    company = get_company(request)
+    company = request.company
     cust = Customer.objects.get(pk=customer_id, company=company)
     if request.method == 'POST':
         cust.name = request.POST['name']
@@ -375,7 +366,7 @@ def edit_customer(request, customer_id):
 
 @login_required
 def toggle_customer_activity(request, customer_id):
-    company = get_company(request)
+    company = request.company
     c = Customer.objects.get(pk=customer_id, company=company)
     c.is_active = not c.is_active
     c.save()
@@ -383,7 +374,7 @@ def toggle_customer_activity(request, customer_id):
 
 @login_required
 def customer_detail(request, customer_id):
-    company = get_company(request)
+    company = request.company
     cust = Customer.objects.get(pk=customer_id, company=company)
     invoices = Invoice.objects.filter(customer=cust).order_by('-invoice_date')
     return render(request, 'accounting/customer_detail.html', {'customer': cust, 'invoices': invoices})
@@ -392,7 +383,7 @@ def customer_detail(request, customer_id):
 @login_required
 @transaction.atomic
 def create_invoice(request):
-    company = get_company(request)
+    company = request.company
     customers = Customer.objects.filter(company=company, is_active=True)
     products = Product.objects.filter(company=company, is_active=True)
     projects = Project.objects.filter(company=company, status='In Progress')
@@ -425,43 +416,55 @@ def create_invoice(request):
         total = decimal.Decimal(0)
         wh, _ = Warehouse.objects.get_or_create(name="Main Warehouse", company=company)
 
+        # Resolve every product and account on the form with one query each
+        product_map = company_in_bulk(Product, company, [prods[i] for i in range(len(prods)) if prods[i] and qtys[i]])
+        account_map = company_in_bulk(Account, company, [accts[i] for i in range(len(prods)) if i < len(accts) and prods[i] and qtys[i]])
+        default_rev_acc = None
+
+        lines = []
+        sold_qty = {}  # product id -> quantity to deduct from stock
         for i in range(len(prods)):
             if prods[i] and qtys[i]:
-                p = Product.objects.get(pk=prods[i], company=company)
+                p = product_map[int(prods[i])]
                 q = decimal.Decimal(qtys[i])
                 pr = decimal.Decimal(prices[i])
                 line_tot = q * pr
                 
-                rev_acc = None
+                rev_acc_id = None
                 if i < len(accts) and accts[i]: 
-                    rev_acc = Account.objects.get(pk=accts[i], company=company)
+                    rev_acc_id = account_map[int(accts[i])].id
                 
-                if not rev_acc: 
-                    rev_acc = p.revenue_account or revenue_accounts.first()
-
-                # --- FIX IS HERE: Add company=company ---
-                InvoiceLine.objects.create(
+                if not rev_acc_id: 
+                    rev_acc_id = p.revenue_account_id
+                if not rev_acc_id:
+                    default_rev_acc = default_rev_acc or revenue_accounts.first()
+                    rev_acc_id = default_rev_acc.id
+
+                # bulk_create skips save(), so line_total is set here
+                lines.append(InvoiceLine(
                     company=company, # <--- Tag the Line Item!
                     invoice=invoice, 
                     product=p, 
-                    revenue_account=rev_acc, 
+                    revenue_account_id=rev_acc_id, 
                     description=p.name, 
                     quantity=q, 
                     unit_price=pr, 
                     line_total=line_tot
-                )
-                # ----------------------------------------
+                ))
                 
                 total += line_tot
-
-                # Deduct Inventory (Ensure StockItem has company tag too)
-                stock, created = StockItem.objects.get_or_create(
-                    product=p, 
-                    warehouse=wh, 
-                    defaults={'company': company, 'quantity': 0}
-                )
-                stock.quantity = decimal.Decimal(stock.quantity) - q
-                stock.save()
+                sold_qty[p.id] = sold_qty.get(p.id, 0) + q
+
+        InvoiceLine.objects.bulk_create(lines)
+
+        # Deduct Inventory: decrement existing stock rows in one UPDATE, create the missing ones
+        stocks = list(StockItem.objects.filter(warehouse=wh, product_id__in=sold_qty))
+        for stock in stocks:
+            stock.quantity = F('quantity') - sold_qty.pop(stock.product_id)
+        StockItem.objects.bulk_update(stocks, ['quantity'])
+        StockItem.objects.bulk_create([
+            StockItem(company=company, product_id=pid, warehouse=wh, quantity=-q) for pid, q in sold_qty.items()
+        ])
         
         invoice.total_amount = total
         invoice.save()
@@ -477,19 +480,19 @@ def create_invoice(request):
 
 @login_required
 def invoice_list(request):
-    company = get_company(request)
-    invoices = Invoice.objects.filter(company=company)
+    company = request.company
+    invoices = Invoice.objects.filter(company=company).select_related('customer')
     return render(request, 'accounting/invoice_list.html', {'invoices': invoices})
 
 @login_required
 def invoice_detail(request, invoice_id):
-    company = get_company(request)
+    company = request.company
     invoice = Invoice.objects.get(pk=invoice_id, company=company)
     return render(request, 'accounting/invoice_detail.html', {'invoice': invoice})
 
 @login_required
 def change_invoice_status(request, invoice_id, new_status):
-    company = get_company(request)
+    company = request.company
     if request.method == 'POST':
         inv = Invoice.objects.get(pk=invoice_id, company=company)
         inv.status = new_status
@@ -499,7 +502,7 @@ def change_invoice_status(request, invoice_id, new_status):
 @login_required
 @transaction.atomic
 def receive_payment(request, invoice_id):
-    company = get_company(request)
+    company = request.company
     invoice = Invoice.objects.get(pk=invoice_id, company=company)
     
     # Only show Bank accounts for deposit
@@ -522,29 +525,27 @@ def receive_payment(request, invoice_id):
         )
 
         # 1. Debit Bank (Increase Cash)
-        JournalVoucherLine.objects.create(
+        jv_lines = [JournalVoucherLine(
             company=company,  # <--- Tag Company
             journal_voucher=jv, 
             account=bank, 
             debit_amount=invoice.total_amount, 
             credit_amount=0, 
             line_description="Received"
-        )
-        bank.current_balance += invoice.total_amount
-        bank.save()
+        )]
 
         # 2. Credit Revenue (Recognize Income NOW)
         for line in invoice.lines.all():
-            JournalVoucherLine.objects.create(
+            jv_lines.append(JournalVoucherLine(
                 company=company,  # <--- Tag Company
                 journal_voucher=jv, 
-                account=line.revenue_account, 
+                account_id=line.revenue_account_id, 
                 debit_amount=0, 
                 credit_amount=line.line_total, 
                 line_description=f"Sale: {line.description}"
-            )
-            line.revenue_account.current_balance += line.line_total
-            line.revenue_account.save()
+            ))
+        JournalVoucherLine.objects.bulk_create(jv_lines)
+        posting.apply_posting(jv)
             
         return redirect('customer_detail', customer_id=invoice.customer.id)
 
@@ -553,7 +554,7 @@ def receive_payment(request, invoice_id):
 @login_required
 @transaction.atomic
 def refund_invoice(request, invoice_id):
-    company = get_company(request)
+    company = request.company
     invoice = Invoice.objects.get(pk=invoice_id, company=company)
     
     if request.method == 'POST':
@@ -571,29 +572,27 @@ def refund_invoice(request, invoice_id):
         )
 
         # Credit Bank (Money Out)
-        JournalVoucherLine.objects.create(
+        jv_lines = [JournalVoucherLine(
             company=company,  # <--- Tag Company
             journal_voucher=jv, 
             account=bank, 
             debit_amount=0, 
             credit_amount=invoice.total_amount, 
             line_description="Refund Paid"
-        )
-        bank.current_balance -= invoice.total_amount
-        bank.save()
+        )]
 
         # Debit Revenue (Reverse Sales)
         for line in invoice.lines.all():
-            JournalVoucherLine.objects.create(
+            jv_lines.append(JournalVoucherLine(
                 company=company,  # <--- Tag Company
                 journal_voucher=jv, 
-                account=line.revenue_account, 
+                account_id=line.revenue_account_id, 
                 debit_amount=line.line_total, 
                 credit_amount=0, 
                 line_description="Refund Exp"
-            )
-            line.revenue_account.current_balance -= line.line_total
-            line.revenue_account.save()
+            ))
+        JournalVoucherLine.objects.bulk_create(jv_lines)
+        posting.apply_posting(jv)
         
         return redirect('customer_detail', customer_id=invoice.customer.id)
 
@@ -604,7 +603,7 @@ def refund_invoice(request, invoice_id):
 @login_required
 @transaction.atomic
 def create_expense(request):
-    company = get_company(request)
+    company = request.company
     vendors = Vendor.objects.filter(company=company, is_active=True)
     payment_accounts = Account.objects.filter(company=company, account_type='Bank', is_active=True)
     expense_accounts = Account.objects.filter(company=company, is_active=True)
@@ -628,17 +627,20 @@ def create_expense(request):
         descs = request.POST.getlist('line_description')
         total = decimal.Decimal(0)
 
+        account_map = company_in_bulk(Account, company, [accts[i] for i in range(len(accts)) if accts[i] and amts[i]])
+        exp_lines = []
         for i in range(len(accts)):
             if accts[i] and amts[i]:
                 amt = decimal.Decimal(amts[i])
-                ExpenseLine.objects.create(
+                exp_lines.append(ExpenseLine(
                     company=company, 
                     expense=exp, 
-                    expense_account=Account.objects.get(pk=accts[i], company=company), 
+                    expense_account=account_map[int(accts[i])], 
                     description=descs[i], 
                     amount=amt
-                )
+                ))
                 total += amt
+        ExpenseLine.objects.bulk_create(exp_lines)
         
         exp.total_amount = total
         exp.save()
@@ -654,32 +656,27 @@ def create_expense(request):
         )
         
         # Credit Payment Account
-        JournalVoucherLine.objects.create(
+        jv_lines = [JournalVoucherLine(
             company=company, # <--- Tag Line
             journal_voucher=jv, 
             account=exp.payment_account, 
             credit_amount=total, 
             debit_amount=0, 
             line_description="Payment"
-        )
-        exp.payment_account.current_balance -= total
-        exp.payment_account.save()
+        )]
         
         # Debit Expense Accounts
-        for line in exp.lines.all():
-            JournalVoucherLine.objects.create(
+        for line in exp_lines:
+            jv_lines.append(JournalVoucherLine(
                 company=company, # <--- Tag Line
                 journal_voucher=jv, 
                 account=line.expense_account, 
                 debit_amount=line.amount, 
                 credit_amount=0, 
                 line_description=line.description
-            )
-            if line.expense_account.normal_balance == 'Debit': 
-                line.expense_account.current_balance += line.amount
-            else: 
-                line.expense_account.current_balance -= line.amount
-            line.expense_account.save()
+            ))
+        JournalVoucherLine.objects.bulk_create(jv_lines)
+        posting.apply_posting(jv)
         
         return redirect('expense_list')
 
@@ -693,18 +690,18 @@ def create_expense(request):
 
 @login_required
 def expense_list(request):
-    company = get_company(request)
-    exps = Expense.objects.filter(company=company)
+    company = request.company
+    exps = Expense.objects.filter(company=company).select_related('vendor', 'payment_account')
     return render(request, 'accounting/expense_list.html', {'expenses': exps})
 
 @login_required
 def expense_detail(request, expense_id):
-    company = get_company(request)
+    company = request.company
     return render(request, 'accounting/expense_detail.html', {'expense': Expense.objects.get(pk=expense_id, company=company)})
 
 @login_required
 def change_expense_status(request, expense_id, new_status):
-    company = get_company(request)
+    company = request.company
     if request.method == 'POST':
         e = Expense.objects.get(pk=expense_id, company=company)
         if e.status == 'Draft': e.status = new_status; e.save()
@@ -713,7 +710,7 @@ def change_expense_status(request, expense_id, new_status):
 # --- POS ---
 @login_required
 def create_po(request):
-    company = get_company(request)
+    company = request.company
     accounts = Account.objects.filter(company=company, is_active=True)
     vendors = Vendor.objects.filter(company=company)
     
@@ -766,13 +763,13 @@ def create_po(request):
 
 @login_required
 def po_list(request):
-    company = get_company(request)
+    company = request.company
     orders = PurchaseOrder.objects.filter(company=company)
     return render(request, 'accounting/po_list.html', {'orders': orders})
 
 @login_required
 def po_detail(request, po_id):  # <--- CHANGED 'pk' TO 'po_id' HERE
-    company = get_company(request)
+    company = request.company
     # Use po_id to find the order
     order = get_object_or_404(PurchaseOrder, pk=po_id, company=company) 
     
@@ -794,7 +791,7 @@ def po_detail(request, po_id):  # <--- CHANGED 'pk' TO 'po_id' HERE
 
 @login_required
 def change_po_status(request, po_id, new_status):
-    company = get_company(request)
+    company = request.company
     if request.method == 'POST':
         po = PurchaseOrder.objects.get(pk=po_id, company=company)
         po.status = new_status
@@ -804,13 +801,13 @@ def change_po_status(request, po_id, new_status):
 # --- INVENTORY ---
 @login_required
 def product_list(request):
-    company = get_company(request)
-    products = Product.objects.filter(company=company)
+    company = request.company
+    products = Product.objects.filter(company=company).select_related('category', 'inventory_asset_account')
     return render(request, 'accounting/product_list.html', {'products': products})
 
 @login_required
 def add_product(request):
-    company = get_company(request)
+    company = request.company
     asset_types = ['Asset', 'Other Current Assets', 'Fixed Assets', 'Other Assets']
     asset_accounts = Account.objects.filter(company=company, account_type__in=asset_types, is_active=True)
     expense_types = ['Expense', 'Expenses', 'Cost of Goods Sold', 'Other Expense']
@@ -845,14 +842,14 @@ def add_product(request):
 
 @login_required
 def delete_product(request, product_id):
-    company = get_company(request)
+    company = request.company
     if request.method == 'POST': Product.objects.get(pk=product_id, company=company).delete()
     return redirect('product_list')
 
 @login_required
 @transaction.atomic
 def adjust_stock(request, product_id):
-    company = get_company(request)
+    company = request.company
     product = Product.objects.get(pk=product_id, company=company)
     
     # 1. Ensure a Warehouse exists for THIS company
@@ -913,8 +910,6 @@ def adjust_stock(request, product_id):
                     credit_amount=value_change, 
                     line_description="Adj"
                 )
-                product.inventory_asset_account.current_balance += value_change
-                balancing_account.current_balance += value_change
             else:
                 # Decrease Inventory (Credit Asset)
                 abs_val = abs(value_change)
@@ -935,11 +930,8 @@ def adjust_stock(request, product_id):
                     credit_amount=0, 
                     line_description="Adj"
                 )
-                product.inventory_asset_account.current_balance -= abs_val
-                balancing_account.current_balance -= abs_val
             
-            product.inventory_asset_account.save()
-            balancing_account.save()
+            posting.apply_posting(jv)
         
         return redirect('stock_levels')
 
@@ -947,7 +939,7 @@ def adjust_stock(request, product_id):
 
 @login_required
 def stock_levels(request):
-    company = get_company(request)
+    company = request.company
     if not Warehouse.objects.filter(company=company).exists(): Warehouse.objects.create(name="Main Warehouse", company=company)
     stocks = StockItem.objects.filter(product__company=company).select_related('product', 'warehouse')
     total_items = stocks.aggregate(Sum('quantity'))['quantity__sum'] or 0
@@ -957,13 +949,13 @@ def stock_levels(request):
 # --- FIXED ASSETS ---
 @login_required
 def asset_list(request):
-    company = get_company(request)
+    company = request.company
     assets = FixedAsset.objects.filter(company=company)
     return render(request, 'accounting/asset_list.html', {'assets': assets})
 
 @login_required
 def add_asset(request):
-    company = get_company(request)
+    company = request.company
     
     # --- FIX 1: Broaden the search so the dropdowns are NOT empty ---
     # Look for 'Fixed Assets', 'Asset', 'Other Assets' so we find SOMETHING
@@ -1040,13 +1032,13 @@ def add_asset(request):
 
 @login_required
 def asset_detail(request, asset_id):
-    company = get_company(request)
+    company = request.company
     asset = FixedAsset.objects.get(pk=asset_id, company=company)
     return render(request, 'accounting/asset_detail.html', {'asset': asset, 'book_value': asset.current_value})
 
 @login_required
 def edit_asset(request, asset_id):
-    company = get_company(request)
+    company = request.company
     asset = FixedAsset.objects.get(pk=asset_id, company=company)
     asset_accounts = Account.objects.filter(company=company, account_type='Asset', is_active=True)
     expense_accounts = Account.objects.filter(company=company, account_type='Expense', is_active=True)
@@ -1060,14 +1052,14 @@ def edit_asset(request, asset_id):
 
 @login_required
 def depreciation_view(request):
-    company = get_company(request)
+    company = request.company
     assets = FixedAsset.objects.filter(company=company, status='Active')
     return render(request, 'accounting/depreciation_view.html', {'assets': assets})
 
 @login_required
 @transaction.atomic
 def post_depreciation(request, asset_id):
-    company = get_company(request)
+    company = request.company
     asset = FixedAsset.objects.get(pk=asset_id, company=company)
     amount = decimal.Decimal(asset.monthly_depreciation)
     
@@ -1095,8 +1087,6 @@ def post_depreciation(request, asset_id):
             credit_amount=0, 
             line_description="Depr Exp"
         )
-        asset.depreciation_expense_account.current_balance += amount
-        asset.depreciation_expense_account.save()
 
         # Credit Accumulated Depreciation
         JournalVoucherLine.objects.create(
@@ -1107,8 +1097,7 @@ def post_depreciation(request, asset_id):
             credit_amount=amount, 
             line_description="Accum Depr"
         )
-        asset.accumulated_depreciation_account.current_balance -= amount
-        asset.accumulated_depreciation_account.save()
+        posting.apply_posting(jv)
         
         messages.success(request, f"Posted ${amount:.2f} depreciation.")
     
@@ -1117,7 +1106,7 @@ def post_depreciation(request, asset_id):
 @login_required
 @transaction.atomic
 def dispose_asset(request, asset_id):
-    company = get_company(request)
+    company = request.company
     asset = FixedAsset.objects.get(pk=asset_id, company=company)
     bank_accounts = Account.objects.filter(company=company, account_type='Asset', is_active=True)
     income_expense_accounts = Account.objects.filter(company=company, account_type__in=['Revenue', 'Expense'], is_active=True)
@@ -1137,42 +1126,34 @@ def dispose_asset(request, asset_id):
         asset.save()
 
         jv = JournalVoucher.objects.create(company=company, jv_number=f"DISP-{asset.asset_number}-{timezone.now().strftime('%H%M%S')}", jv_date=disposal_date, description=f"Disposal: {asset.name}", status='Posted', posted_at=timezone.now())
-        JournalVoucherLine.objects.create(journal_voucher=jv, account=asset.asset_account, debit_amount=0, credit_amount=asset.purchase_cost, line_description="Remove Cost")
-        asset.asset_account.current_balance -= asset.purchase_cost
-        asset.asset_account.save()
-        JournalVoucherLine.objects.create(journal_voucher=jv, account=asset.accumulated_depreciation_account, debit_amount=total_depr, credit_amount=0, line_description="Remove Accum")
-        asset.accumulated_depreciation_account.current_balance += total_depr
-        asset.accumulated_depreciation_account.save()
+        JournalVoucherLine.objects.create(company=company, journal_voucher=jv, account=asset.asset_account, debit_amount=0, credit_amount=asset.purchase_cost, line_description="Remove Cost")
+        JournalVoucherLine.objects.create(company=company, journal_voucher=jv, account=asset.accumulated_depreciation_account, debit_amount=total_depr, credit_amount=0, line_description="Remove Accum")
 
         if sale_price > 0:
             bank = Account.objects.get(pk=request.POST['deposit_account'], company=company)
-            JournalVoucherLine.objects.create(journal_voucher=jv, account=bank, debit_amount=sale_price, credit_amount=0, line_description="Proceeds")
-            bank.current_balance += sale_price
-            bank.save()
+            JournalVoucherLine.objects.create(company=company, journal_voucher=jv, account=bank, debit_amount=sale_price, credit_amount=0, line_description="Proceeds")
 
         gl_acc = Account.objects.get(pk=request.POST['gl_account'], company=company)
         if gain_loss > 0:
-            JournalVoucherLine.objects.create(journal_voucher=jv, account=gl_acc, debit_amount=0, credit_amount=gain_loss, line_description="Gain")
-            gl_acc.current_balance += gain_loss
+            JournalVoucherLine.objects.create(company=company, journal_voucher=jv, account=gl_acc, debit_amount=0, credit_amount=gain_loss, line_description="Gain")
         elif gain_loss < 0:
-            JournalVoucherLine.objects.create(journal_voucher=jv, account=gl_acc, debit_amount=abs(gain_loss), credit_amount=0, line_description="Loss")
-            gl_acc.current_balance += abs(gain_loss)
-        gl_acc.save()
+            JournalVoucherLine.objects.create(company=company, journal_voucher=jv, account=gl_acc, debit_amount=abs(gain_loss), credit_amount=0, line_description="Loss")
+        posting.apply_posting(jv)
         return redirect('asset_list')
     return render(request, 'accounting/dispose_asset.html', {'asset': asset, 'bank_accounts': bank_accounts, 'income_expense_accounts': income_expense_accounts})
 
 # --- PROJECTS ---
 @login_required
 def project_list(request):
-    company = get_company(request)
+    company = request.company
     query = request.GET.get('search', '')
-    if query: p = Project.objects.filter(company=company).filter(Q(name__icontains=query) | Q(code__icontains=query))
-    else: p = Project.objects.filter(company=company)
+    p = Project.objects.filter(company=company).select_related('customer')
+    if query: p = p.filter(Q(name__icontains=query) | Q(code__icontains=query))
     return render(request, 'accounting/project_list.html', {'projects': p, 'search_query': query})
 
 @login_required
 def add_project(request):
-    company = get_company(request)
+    company = request.company
     if request.method == 'POST':
         try:
             Project.objects.create(
@@ -1189,7 +1170,7 @@ def add_project(request):
 
 @login_required
 def project_detail(request, project_id):
-    company = get_company(request)
+    company = request.company
     p = Project.objects.get(pk=project_id, company=company)
     rev = p.invoices.exclude(status='Void').aggregate(Sum('total_amount'))['total_amount__sum'] or 0
     cost = p.expenses.aggregate(Sum('total_amount'))['total_amount__sum'] or 0
@@ -1197,7 +1178,7 @@ def project_detail(request, project_id):
 
 @login_required
 def change_project_status(request, project_id, new_status):
-    company = get_company(request)
+    company = request.company
     if request.method == 'POST':
         p = Project.objects.get(pk=project_id, company=company)
         p.status = new_status
@@ -1206,20 +1187,24 @@ def change_project_status(request, project_id, new_status):
 
 @login_required
 def delete_project(request, project_id):
-    company = get_company(request)
+    company = request.company
     if request.method == 'POST': Project.objects.get(pk=project_id, company=company).delete()
     return redirect('project_list')
 
 @login_required
 def project_profitability_report(request):
-    company = get_company(request)
+    company = request.company
     pid = request.GET.get('project_id')
     projects = Project.objects.filter(company=company)
     target = projects.filter(id=pid) if pid else projects
+    # Revenue and cost per project as correlated subqueries: one query for every project
+    revenue = Invoice.objects.filter(project=OuterRef('pk')).exclude(status='Void').values('project').annotate(t=Sum('total_amount')).values('t')
+    cost = Expense.objects.filter(project=OuterRef('pk')).values('project').annotate(t=Sum('total_amount')).values('t')
+    target = target.select_related('customer').annotate(revenue=Subquery(revenue), cost=Subquery(cost))
     data, tr, tc, tp = [], 0, 0, 0
     for p in target:
-        r = p.invoices.exclude(status='Void').aggregate(Sum('total_amount'))['total_amount__sum'] or decimal.Decimal(0)
-        c = p.expenses.aggregate(Sum('total_amount'))['total_amount__sum'] or decimal.Decimal(0)
+        r = p.revenue or decimal.Decimal(0)
+        c = p.cost or decimal.Decimal(0)
         data.append({'name': p.name, 'code': p.code, 'customer': p.customer, 'status': p.status, 'revenue': r, 'cost': c, 'profit': r-c, 'margin': ((r-c)/r*100) if r else 0})
         tr += r; tc += c; tp += (r-c)
     return render(request, 'accounting/project_report.html', {'projects': projects, 'selected_project_id': int(pid) if pid else None, 'report_data': data, 'total_revenue': tr, 'total_cost': tc, 'total_profit': tp})
@@ -1227,12 +1212,12 @@ def project_profitability_report(request):
 # --- BUDGETING ---
 @login_required
 def budget_list(request):
-    company = get_company(request)
+    company = request.company
     return render(request, 'accounting/budget_list.html', {'budgets': Budget.objects.filter(company=company).order_by('-year')})
 
 @login_required
 def add_budget(request):
-    company = get_company(request)
+    company = request.company
     if request.method == 'POST':
         b = Budget.objects.create(company=company, name=request.POST['name'], year=request.POST['year'], description=request.POST['description'])
         return redirect('edit_budget', budget_id=b.id)
@@ -1240,7 +1225,7 @@ def add_budget(request):
 
 @login_required
 def edit_budget(request, budget_id):
-    company = get_company(request)
+    company = request.company
     budget = Budget.objects.get(pk=budget_id, company=company)
     accts = Account.objects.filter(company=company, account_type__in=['Revenue', 'Income', 'Other Income', 'Expense', 'Expenses', 'Cost of Goods Sold'])
     if request.method == 'POST':
@@ -1248,37 +1233,25 @@ def edit_budget(request, budget_id):
             val = request.POST.get(f'amount_{a.id}')
             if val: BudgetItem.objects.update_or_create(budget=budget, account=a, defaults={'monthly_amount': decimal.Decimal(val), 'company': company})
         return redirect('budget_list')
-    return render(request, 'accounting/edit_budget.html', {'budget': budget, 'pnl_accounts': accts, 'existing_items': {i.account.id: i.monthly_amount for i in budget.items.all()}})
+    return render(request, 'accounting/edit_budget.html', {'budget': budget, 'pnl_accounts': accts, 'existing_items': {i.account_id: i.monthly_amount for i in budget.items.all()}})
 
 @login_required
 def budget_variance(request, budget_id):
-    company = get_company(request)
+    company = request.company
     b = Budget.objects.get(pk=budget_id, company=company)
-    s, e = f"{b.year}-01-01", f"{b.year}-12-31"
-    data, tbi, tai, tbe, tae = [], 0, 0, 0, 0
-    for item in b.items.select_related('account'):
-        ann_bud = item.monthly_amount * 12
-        lines = JournalVoucherLine.objects.filter(account=item.account, journal_voucher__jv_date__range=[s, e], journal_voucher__status='Posted')
-        if item.account.normal_balance == 'Credit': # Income
-            act = lines.aggregate(n=Sum('credit_amount')-Sum('debit_amount'))['n'] or 0
-            var = act - ann_bud
-            tbi += ann_bud; tai += act
-        else:
-            act = lines.aggregate(n=Sum('debit_amount')-Sum('credit_amount'))['n'] or 0
-            var = ann_bud - act
-            tbe += ann_bud; tae += act
-        data.append({'account': item.account, 'budget': ann_bud, 'actual': act, 'variance': var, 'percent': (act/ann_bud*100) if ann_bud else 0})
-    return render(request, 'accounting/budget_variance.html', {'budget': b, 'report_data': data, 'total_budget_income': tbi, 'total_actual_income': tai, 'total_budget_expense': tbe, 'total_actual_expense': tae})
+    context = report_cache.cached_report(company, 'budget_variance', statements.budget_variance, b)
+    context['budget'] = b
+    return render(request, 'accounting/budget_variance.html', context)
 
 @login_required
 def latest_budget_variance(request):
-    company = get_company(request)
+    company = request.company
     lb = Budget.objects.filter(company=company).order_by('-year').first()
     return redirect('budget_variance', budget_id=lb.id) if lb else redirect('add_budget')
 
 @login_required
 def delete_budget(request, budget_id):
-    company = get_company(request)
+    company = request.company
     if request.method == 'POST': Budget.objects.get(pk=budget_id, company=company).delete()
     return redirect('budget_list')
 
@@ -1286,54 +1259,56 @@ def delete_budget(request, budget_id):
 @login_required
 @transaction.atomic
 def create_voucher(request):
-    company = get_company(request)
+    company = request.company
     accounts = Account.objects.filter(company=company, is_active=True)
     
     if request.method == 'POST':
-        # 1. Create Header with Company
-        v = JournalVoucher.objects.create(
-            company=company,  # <--- Tag the JV
-            jv_number=f"JV-{timezone.now().strftime('%Y%m%d-%H%M%S')}", 
-            jv_date=request.POST['jv_date'], 
-            description=request.POST['description']
-        )
-        
         accts = request.POST.getlist('account')
         debits = request.POST.getlist('debit')
         credits = request.POST.getlist('credit')
         descs = request.POST.getlist('line_description')
+        account_map = company_in_bulk(Account, company, accts)
         
+        # 1. Build Lines in memory with Company
+        lines = []
         td, tc = decimal.Decimal(0), decimal.Decimal(0)
         
         for i in range(len(accts)):
             d = decimal.Decimal(debits[i] or 0)
             c = decimal.Decimal(credits[i] or 0)
-            
-            # 2. Create Lines with Company
-            JournalVoucherLine.objects.create(
+            lines.append(JournalVoucherLine(
                 company=company,  # <--- Tag the Line
-                journal_voucher=v, 
-                account=Account.objects.get(pk=accts[i], company=company), 
+                account=account_map[int(accts[i])], 
                 debit_amount=d, 
                 credit_amount=c, 
                 line_description=descs[i]
-            )
+            ))
             td += d
             tc += c
         
         # Validation: Must Balance
         if td != tc:
-            v.delete()
             messages.error(request, "Journal Entry does not balance. Credits must equal Debits.")
             return render(request, 'accounting/create_voucher.html', {'accounts': accounts})
         
+        # 2. Create Header with Company, then all lines in one INSERT
+        v = JournalVoucher.objects.create(
+            company=company,  # <--- Tag the JV
+            jv_number=f"JV-{timezone.now().strftime('%Y%m%d-%H%M%S')}", 
+            jv_date=request.POST['jv_date'], 
+            description=request.POST['description']
+        )
+        for line in lines:
+            line.journal_voucher = v
+        JournalVoucherLine.objects.bulk_create(lines)
+        
         return redirect('voucher_list')
 
     return render(request, 'accounting/create_voucher.html', {'accounts': accounts})
 
 @login_required
 def voucher_list(request):
-    company = get_company(request)
+    company = request.company
     query = request.GET.get('search', '')
     if query: vouchers = JournalVoucher.objects.filter(company=company).filter(Q(jv_number__icontains=query) | Q(description__icontains=query))
     else: vouchers = JournalVoucher.objects.filter(company=company)
@@ -1341,7 +1316,7 @@ def voucher_list(request):
 
 @login_required
 def voucher_detail(request, jv_id):
-    company = get_company(request)
+    company = request.company
     voucher = JournalVoucher.objects.get(pk=jv_id, company=company)
     totals = voucher.lines.all().aggregate(total_debits=Sum('debit_amount'), total_credits=Sum('credit_amount'))
     return render(request, 'accounting/voucher_detail.html', {'voucher': voucher, 'total_debits': totals['total_debits'], 'total_credits': totals['total_credits']})
@@ -1349,7 +1324,7 @@ def voucher_detail(request, jv_id):
 @login_required
 @transaction.atomic
 def edit_voucher(request, jv_id):
-    company = get_company(request)
+    company = request.company
     voucher = JournalVoucher.objects.get(pk=jv_id, company=company)
     if voucher.status != 'Draft': return redirect('voucher_detail', jv_id=jv_id)
 
@@ -1363,15 +1338,19 @@ def edit_voucher(request, jv_id):
         debits = request.POST.getlist('debit')
         credits = request.POST.getlist('credit')
         descs = request.POST.getlist('line_description')
+        account_map = company_in_bulk(Account, company, accts)
         
-        for i in range(len(accts)):
-            JournalVoucherLine.objects.create(
+        JournalVoucherLine.objects.bulk_create([
+            JournalVoucherLine(
+                company=company,
                 journal_voucher=voucher,
-                account=Account.objects.get(pk=accts[i], company=company),
+                account=account_map[int(accts[i])],
                 debit_amount=decimal.Decimal(debits[i] or 0),
                 credit_amount=decimal.Decimal(credits[i] or 0),
                 line_description=descs[i]
             )
+            for i in range(len(accts))
+        ])
         return redirect('voucher_detail', jv_id=jv_id)
 
     accounts = Account.objects.filter(company=company, is_active=True)
@@ -1380,195 +1359,129 @@ def edit_voucher(request, jv_id):
 @login_required
 @transaction.atomic
 def post_voucher(request, jv_id):
-    company = get_company(request)
+    company = request.company
     if request.method == 'POST':
         v = JournalVoucher.objects.get(pk=jv_id, company=company)
         if v.status == 'Draft':
-            for line in v.lines.all():
-                bal_chg = line.debit_amount - line.credit_amount
-                if line.account.normal_balance == 'Credit': line.account.current_balance -= bal_chg
-                else: line.account.current_balance += bal_chg
-                line.account.save()
-            v.status = 'Posted'
-            v.posted_at = timezone.now()
-            v.save()
+            posting.post_draft(v)
     return redirect('voucher_detail', jv_id=jv_id)
 
 @login_required
 def upload_voucher(request):
-    company = get_company(request)
+    company = request.company
     if request.method == 'POST':
         csv_file = request.FILES['csv_file']
-        if not csv_file.name.endswith('.csv'):
+        if not csv_file.name.lower().endswith('.csv'):
             return render(request, 'accounting/upload_voucher.html', {'error': 'Not CSV'})
-        try:
-            decoded = csv_file.read().decode('utf-8').splitlines()
-            reader = csv.reader(decoded)
-            next(reader)
-            lines, td, tc = [], decimal.Decimal(0), decimal.Decimal(0)
-            for r in reader:
-                d, c = decimal.Decimal(r[1] or 0), decimal.Decimal(r[2] or 0)
-                # Assuming CSV has Account Numbers. Needs validation for company scope in real app.
-                acc = Account.objects.get(account_number=r[0], company=company)
-                lines.append({'acc': acc, 'd': d, 'c': c, 'desc': r[3]})
-                td += d
-                tc += c
-            if td != tc: raise ValueError("Unbalanced")
-            
-            with transaction.atomic():
-                v = JournalVoucher.objects.create(
-                    company=company,
-                    jv_number=f"JV-CSV-{timezone.now().strftime('%Y%m%d-%H%M%S')}",
-                    jv_date=timezone.now().date(),
-                    description=f"Upload: {csv_file.name}",
-                    status='Draft'
-                )
-                for l in lines:
-                    JournalVoucherLine.objects.create(journal_voucher=v, account=l['acc'], debit_amount=l['d'], credit_amount=l['c'], line_description=l['desc'])
-            return redirect('voucher_list')
-        except Exception as e:
-            return render(request, 'accounting/upload_voucher.html', {'error': str(e)})
+        result = importers.import_vouchers(company, csv_file)
+        if result['error_count']:
+            return render(request, 'accounting/upload_voucher.html', {
+                'error': f"Nothing was imported: {result['error_count']} problem(s) found.", 'row_errors': result['errors'],
+            })
+        messages.success(request, f"Imported {result['vouchers']} draft voucher(s) with {result['lines']} lines.")
+        return redirect('voucher_list')
     return render(request, 'accounting/upload_voucher.html')
 
+def stream_csv(rows, filename, compress=False):
+    """StreamingHttpResponse writing an iterable of rows as CSV, gzipped when compress is set."""
+    chunks = exports.csv_lines(rows)
+    if compress:
+        response = StreamingHttpResponse(exports.gzip_stream(chunks), content_type='application/gzip')
+        filename += '.gz'
+    else:
+        response = StreamingHttpResponse(chunks, content_type='text/csv')
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
 @login_required
+@ledger_conditional
 def download_single_voucher(request, jv_id):
-    company = get_company(request)
+    company = request.company
     v = JournalVoucher.objects.get(pk=jv_id, company=company)
-    resp = HttpResponse(content_type='text/csv')
-    resp['Content-Disposition'] = f'attachment; filename="JV-{v.jv_number}.csv"'
-    w = csv.writer(resp)
-    w.writerow(['JV Number', 'Date', 'Description', 'Status'])
-    w.writerow([v.jv_number, v.jv_date, v.description, v.status])
-    w.writerow([])
-    w.writerow(['Account', 'Name', 'Debit', 'Credit', 'Line Desc'])
-    for l in v.lines.all():
-        w.writerow([l.account.account_number, l.account.account_name, l.debit_amount, l.credit_amount, l.line_description])
-    return resp
+    return stream_csv(exports.single_voucher_rows(v), f"JV-{v.jv_number}.csv", compress=request.GET.get('gzip') == '1')
 
 @login_required
+@ledger_conditional
 def download_all_vouchers(request):
-    company = get_company(request)
-    resp = HttpResponse(content_type='text/csv')
-    resp['Content-Disposition'] = 'attachment; filename="All_JVs.csv"'
-    w = csv.writer(resp)
-    w.writerow(['JV Number', 'Date', 'Description', 'Status', 'Account', 'Debit', 'Credit', 'Line Desc'])
-    for v in JournalVoucher.objects.filter(company=company):
-        for l in v.lines.all():
-            w.writerow([v.jv_number, v.jv_date, v.description, v.status, l.account.account_number, l.debit_amount, l.credit_amount, l.line_description])
-    return resp
-
-# --- BANKING (SAAS) ---
-@login_required
-def bank_account_list(request):
-    company = get_company(request)
-    return render(request, 'accounting/bank_account_list.html', {'bank_accounts': BankAccount.objects.filter(company=company)})
+    """All journal lines as CSV; optional start_date, end_date, status and gzip=1 filters."""
+    company = request.company
+    rows = exports.voucher_rows(company, start=request.GET.get('start_date') or None,
+                                end=request.GET.get('end_date') or None, status=request.GET.get('status') or None)
+    return stream_csv(rows, "All_JVs.csv", compress=request.GET.get('gzip') == '1')
 
+# --- BACKGROUND EXPORTS ---
 @login_required
-def add_bank_account(request):
-    company = get_company(request)
-    
+def export_list(request):
+    """Queue a background export (POST) and list the company's export jobs."""
+    company = request.company
     if request.method == 'POST':
-        BankAccount.objects.create(
-            company=company,
-            name=request.POST['name'],
-            account_number=request.POST['account_number'],
-            gl_account=Account.objects.get(pk=request.POST['gl_account'], company=company)
-        )
-        return redirect('bank_account_list')
-    
-    # --- FIX: Look for 'Bank' OR 'Asset' accounts ---
-    # This finds your accounts whether they are labeled "Bank" or "Asset"
-    assets = Account.objects.filter(
-        company=company, 
-        account_type__in=['Bank', 'Asset'], 
-        is_active=True
-    ).order_by('account_number')
-    # ------------------------------------------------
-    
-    return render(request, 'accounting/add_bank_account.html', {'assets': assets})
-
-@login_required
-def delete_bank_account(request, bank_id):
-    company = get_company(request)
-    if request.method == 'POST': BankAccount.objects.get(pk=bank_id, company=company).delete()
-    return redirect('bank_account_list')
-
-@login_required
-def upload_bank_statement(request, bank_id):
-    company = get_company(request)
-    bank = BankAccount.objects.get(pk=bank_id, company=company)
-    
-    if request.method == 'POST':
-        csv_file = request.FILES['csv_file']
-        if not csv_file.name.endswith('.csv'):
-            messages.error(request, "Not a CSV file.")
-            return redirect('upload_bank_statement', bank_id=bank_id)
-
-        try:
-            decoded_file = csv_file.read().decode('utf-8-sig').splitlines()
-            reader = csv.reader(decoded_file)
-            next(reader, None) # Skip Header
-
-            count = 0
-            for row in reader:
-                if len(row) < 3: continue
-
-                date_str = row[0].strip()
-                description = row[1].strip()
-                amount_str = row[2].strip()
-
-                # Data Cleaning
-                clean_amount = amount_str.replace('$', '').replace(',', '').replace(' ', '')
-                if '(' in clean_amount and ')' in clean_amount:
-                    clean_amount = '-' + clean_amount.replace('(', '').replace(')', '')
-                
-                if not clean_amount: continue
-
-                # Date Parsing
-                formatted_date = None
-                for fmt in ['%m/%d/%Y', '%Y-%m-%d', '%d/%m/%Y', '%m-%d-%Y']:
-                    try:
-                        formatted_date = datetime.strptime(date_str, fmt).date()
-                        break
-                    except ValueError:
-                        continue
-                
-                if formatted_date:
-                    # --- FIX IS HERE: Added company=company ---
-                    BankStatementLine.objects.create(
-                        company=company,  # <--- Tag the Company!
-                        bank_account=bank,
-                        date=formatted_date,
-                        description=description,
-                        amount=decimal.Decimal(clean_amount)
-                    )
-                    count += 1
-            
-            messages.success(request, f"Successfully uploaded {count} lines.")
-            return redirect('reconcile_bank', bank_id=bank_id)
+        kind = request.POST.get('kind')
+        params = {k: request.POST.get(k) for k in ('start_date', 'end_date', 'status') if request.POST.get(k)}
+        if kind == 'account_activity':
+            params.setdefault('start_date', f"{timezone.now().year}-01-01")
+            params.setdefault('end_date', f"{timezone.now().year}-12-31")
+            params['account_types'] = request.POST.getlist('account_types')
+        if kind not in dict(ExportJob.KINDS):
+            messages.error(request, "Unknown export type.")
+        else:
+            ExportJob.objects.create(company=company, requested_by=request.user, kind=kind, params=params)
+            messages.success(request, "Export queued. It will be ready for download shortly.")
+        return redirect('export_list')
 
-        except Exception as e:
-            messages.error(request, f"Critical Error: {e}")
-        
-    return render(request, 'accounting/upload_bank_statement.html', {'bank_account': bank})
+    account_types = Account.objects.filter(company=company).values_list('account_type', flat=True).distinct().order_by('account_type')
+    return render(request, 'accounting/export_list.html', {
+        'jobs': ExportJob.objects.filter(company=company)[:50], 'kinds': ExportJob.KINDS, 'account_types': account_types,
+    })
 
 @login_required
-def reconcile_bank(request, bank_id):
-    company = get_company(request)
-    bank = BankAccount.objects.get(pk=bank_id, company=company)
-    s_date = request.GET.get('start_date')
-    e_date = request.GET.get('end_date')
-    
-    b_lines = BankStatementLine.objects.filter(bank_account=bank, matched_journal_line__isnull=True).order_by('date')
-    s_lines = JournalVoucherLine.objects.filter(account=bank.gl_account, reconciliation_match__isnull=True).order_by('journal_voucher__jv_date')
-    m_lines = BankStatementLine.objects.filter(bank_account=bank, matched_journal_line__isnull=False).order_by('-date')
-
-    if s_date and e_date:
-        b_lines = b_lines.filter(date__range=[s_date, e_date])
-        s_lines = s_lines.filter(journal_voucher__jv_date__range=[s_date, e_date])
-        m_lines = m_lines.filter(date__range=[s_date, e_date])
+def export_status(request, job_id):
+    """Progress of one export job, polled by the export list."""
+    job = get_object_or_404(ExportJob, pk=job_id, company=request.company)
+    return JsonResponse({
+        'status': job.status, 'rows_written': job.rows_written, 'total_rows': job.total_rows,
+        'percent': job.percent, 'error': job.error,
+        'download_url': reverse('download_export', args=[job.id]) if job.status == 'Done' else None,
+    })
 
-    return render(request, 'accounting/reconcile_bank.html', {'bank_account': bank, 'bank_lines': b_lines, 'system_lines': s_lines, 'matched_lines': m_lines, 'start_date': s_date, 'end_date': e_date})
+def read_chunks(fh, length, chunk_size=64 * 1024):
+    """Yield `length` bytes from an open file in chunks, closing it at the end."""
+    try:
+        while length > 0:
+            data = fh.read(min(chunk_size, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        fh.close()
+
+@login_required
+def download_export(request, job_id):
+    """Serve a finished export; honours a single 'Range: bytes=' header so large downloads can resume."""
+    job = get_object_or_404(ExportJob, pk=job_id, company=request.company, status='Done')
+    size = job.file.size
+    fh = job.file.open('rb')
+    m = re.match(r'^bytes=(\d*)-(\d*)$', request.headers.get('Range', ''))
+    if m and (m.group(1) or m.group(2)):
+        if m.group(1):
+            first, last = int(m.group(1)), min(int(m.group(2) or size - 1), size - 1)
+        else:  # suffix range: the last N bytes
+            first, last = max(0, size - int(m.group(2))), size - 1
+        if first > last:
+            fh.close()
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+        fh.seek(first)
+        response = StreamingHttpResponse(read_chunks(fh, last - first + 1), status=206, content_type='text/csv')
+        response['Content-Range'] = f'bytes {first}-{last}/{size}'
+        response['Content-Length'] = str(last - first + 1)
+    else:
+        response = StreamingHttpResponse(read_chunks(fh, size), content_type='text/csv')
+        response['Content-Length'] = str(size)
+    response['Accept-Ranges'] = 'bytes'
+    response['Content-Disposition'] = f'attachment; filename="{job.get_kind_display().replace(" ", "_")}_{job.pk}.csv"'
+    return response
 
 # --- Reporting Views ---
 
@@ -1578,165 +1491,63 @@ def report_index(request):
     """
     return render(request, 'accounting/report_index.html')
 
+@login_required
 def trial_balance_report(request):
     """
-    Generates and displays the Trial Balance report.
+    Trial Balance as of the end of the selected range (the last posted date
+    for "All Dates"), served from the per-company cache.
     """
-    # Your logic for calculating trial balance goes here.
-    # This is a placeholder to get the page loading.
-    # You likely had logic here to sum debits/credits per account.
-    # I will provide the basic structure we built earlier.
-    
-    report_lines = []
-    total_debits = decimal.Decimal(0)
-    total_credits = decimal.Decimal(0)
-    start_date_str = ''
-    end_date_str = ''
+    company = request.company
+    start_date_str, end_date_str = '', ''
+    tb = {'report_lines': [], 'total_debits': decimal.Decimal(0), 'total_credits': decimal.Decimal(0)}
 
     if request.method == 'POST':
-        date_option = request.POST.get('date_range_option')
-        lines_query = JournalVoucherLine.objects.filter(journal_voucher__status='Posted')
-        
-        if date_option == 'custom':
-            start_date_str = request.POST.get('start_date')
-            end_date_str = request.POST.get('end_date')
-            lines_query = lines_query.filter(journal_voucher__jv_date__lte=end_date_str)
+        if request.POST.get('date_range_option') == 'custom':
+            start_date_str = request.POST.get('start_date', '')
+            end_date_str = request.POST.get('end_date', '')
         else:
-            if lines_query.exists():
-                first_jv = JournalVoucher.objects.filter(status='Posted').order_by('jv_date').first()
-                last_jv = JournalVoucher.objects.filter(status='Posted').order_by('jv_date').last()
-                start_date_str = first_jv.jv_date.strftime('%Y-%m-%d') if first_jv else ''
-                end_date_str = last_jv.jv_date.strftime('%Y-%m-%d') if last_jv else ''
-
-        account_balances = {}
-        account_changes = lines_query.values('account_id').annotate(
-            total_debit=Sum('debit_amount'),
-            total_credit=Sum('credit_amount')
-        )
-        for change in account_changes:
-            account_balances[change['account_id']] = (change['total_debit'] or 0) - (change['total_credit'] or 0)
-
-        all_accounts = Account.objects.all().order_by('account_number')
-        for account in all_accounts:
-            balance = account_balances.get(account.id, decimal.Decimal(0))
-            final_debit = decimal.Decimal(0)
-            final_credit = decimal.Decimal(0)
-
-            if account.normal_balance == 'Debit':
-                if balance >= 0: final_debit = balance
-                else: final_credit = -balance
-            else:
-                if balance <= 0: final_debit = -balance
-                else: final_credit = balance
-
-            report_lines.append({
-                'number': account.account_number,
-                'name': account.account_name,
-                'debit': final_debit,
-                'credit': final_credit
-            })
-            total_debits += final_debit
-            total_credits += final_credit
+            first, last = statements.posted_date_range(company)
+            start_date_str = first.strftime('%Y-%m-%d') if first else ''
+            end_date_str = last.strftime('%Y-%m-%d') if last else ''
+        tb = report_cache.cached_report(company, 'trial_balance', statements.trial_balance, end_date_str or None)
 
     context = {
-        'report_lines': report_lines,
-        'total_debits': total_debits,
-        'total_credits': total_credits,
+        'report_lines': tb['report_lines'],
+        'total_debits': tb['total_debits'],
+        'total_credits': tb['total_credits'],
         'start_date': start_date_str,
         'end_date': end_date_str
     }
     return render(request, 'accounting/trial_balance_report.html', context)
 
+@login_required
+@ledger_conditional
 def download_trial_balance(request):
     """
-    Generates the CSV download for the Trial Balance.
+    Streams the Trial Balance as CSV, from the same cached computation as the report.
     """
-    # Basic CSV generation logic (simplified for the fix)
-    response = HttpResponse(content_type='text/csv')
-    response['Content-Disposition'] = 'attachment; filename="Trial_Balance.csv"'
-    writer = csv.writer(response)
-    writer.writerow(['Account Number', 'Account Name', 'Debit', 'Credit'])
-    # (You would repeat the calculation logic here to fill rows)
-    return response
+    company = request.company
+    end_date = request.GET.get('end_date') or None
+    tb = report_cache.cached_report(company, 'trial_balance', statements.trial_balance, end_date)
+
+    return stream_csv(exports.trial_balance_rows(tb), f"Trial_Balance_{end_date or 'all'}.csv")
 
 @login_required
+@ledger_conditional
 def income_statement(request):
-    company = get_company(request)
+    company = request.company
     start_date = request.GET.get('start_date') or f"{timezone.now().year}-01-01"
     end_date = request.GET.get('end_date') or f"{timezone.now().year}-12-31"
 
-    # --- HELPER FUNCTION TO CALCULATE SECTION TOTALS ---
-    def get_section_data(account_types, normal_balance):
-        accounts = Account.objects.filter(company=company, account_type__in=account_types)
-        data = []
-        total = decimal.Decimal(0)
-        
-        for acc in accounts:
-            # Calculate net movement for the period
-            lines = JournalVoucherLine.objects.filter(
-                account=acc, 
-                journal_voucher__jv_date__range=[start_date, end_date], 
-                journal_voucher__status='Posted'
-            )
-            d = lines.aggregate(Sum('debit_amount'))['debit_amount__sum'] or 0
-            c = lines.aggregate(Sum('credit_amount'))['credit_amount__sum'] or 0
-            
-            # Net change logic based on account type
-            if normal_balance == 'Credit':
-                net = c - d
-            else:
-                net = d - c
-                
-            if net != 0:
-                data.append({'name': acc.account_name, 'amount': net})
-                total += net
-        return data, total
-
-    # 1. OPERATING INCOME
-    inc_list, inc_total = get_section_data(['Revenue', 'Income'], 'Credit')
-
-    # 2. COST OF GOODS SOLD
-    cogs_list, cogs_total = get_section_data(['Cost of Goods Sold'], 'Debit')
-
-    # GROSS PROFIT = Income - COGS
-    gross_profit = inc_total - cogs_total
-
-    # 3. OPERATING EXPENSES
-    exp_list, exp_total = get_section_data(['Expense', 'Expenses'], 'Debit')
-
-    # NET OPERATING INCOME = Gross Profit - Expenses
-    net_operating_income = gross_profit - exp_total
-
-    # 4. OTHER INCOME
-    other_inc_list, other_inc_total = get_section_data(['Other Income'], 'Credit')
-
-    # 5. OTHER EXPENSES
-    other_exp_list, other_exp_total = get_section_data(['Other Expense'], 'Debit')
-
-    # NET OTHER INCOME = Other Income - Other Expenses
-    net_other_income = other_inc_total - other_exp_total
-
-    # FINAL NET INCOME
-    net_income = net_operating_income + net_other_income
-
-    return render(request, 'accounting/income_statement.html', {
-        'start_date': start_date,
-        'end_date': end_date,
-        # Data for Template
-        'inc_list': inc_list, 'inc_total': inc_total,
-        'cogs_list': cogs_list, 'cogs_total': cogs_total,
-        'gross_profit': gross_profit,
-        'exp_list': exp_list, 'exp_total': exp_total,
-        'net_operating_income': net_operating_income,
-        'other_inc_list': other_inc_list, 'other_inc_total': other_inc_total,
-        'other_exp_list': other_exp_list, 'other_exp_total': other_exp_total,
-        'net_other_income': net_other_income,
-        'net_income': net_income
-    })
+    # Sections (Income, COGS, Expenses, Other Income/Expense) and their subtotals
+    context = report_cache.cached_report(company, 'income_statement', statements.income_statement, start_date, end_date)
+    context.update({'start_date': start_date, 'end_date': end_date})
+    return render(request, 'accounting/income_statement.html', context)
 
 @login_required
+@ledger_conditional
 def balance_sheet(request):
-    company = get_company(request)
+    company = request.company
     
     # 1. Get the "As Of" Date (Default to Today if not set)
     target_date_str = request.GET.get('target_date')
@@ -1746,79 +1557,13 @@ def balance_sheet(request):
         target_date = timezone.now().date()
         target_date_str = target_date.strftime('%Y-%m-%d')
 
-    # 2. Define Account Types
-    ASSET_TYPES = ['Asset', 'Assets', 'Current Asset', 'Fixed Assets', 'Bank', 'Cash', 'Accounts Receivable', 'Inventory', 'Other Current Assets', 'Other Assets', 'Security Deposit']
-    LIABILITY_TYPES = ['Liability', 'Liabilities', 'Current Liability', 'Long Term Liabilities', 'Credit Card', 'Accounts Payable', 'Other Current Liabilities', 'Payroll Liabilities', 'Taxes Payable']
-    EQUITY_TYPES = ['Equity', 'Owner\'s Equity', 'Shareholder\'s Equity', 'Retained Earnings', 'Capital', 'Opening Balance Equity']
-
-    # 3. Helper Function to Calculate Historical Balances
-    def get_historical_balances(account_types):
-        # Fetch accounts
-        accounts = Account.objects.filter(company=company, account_type__in=account_types).order_by('account_number')
-        results = []
-        total = decimal.Decimal(0)
-        
-        for acc in accounts:
-            # Sum all journal lines for this account UP TO the target date
-            lines = JournalVoucherLine.objects.filter(
-                account=acc,
-                journal_voucher__jv_date__lte=target_date,  # <--- CRITICAL: Filter by date
-                journal_voucher__status='Posted'
-            )
-            
-            # Aggregate Debits and Credits
-            debits = lines.aggregate(Sum('debit_amount'))['debit_amount__sum'] or 0
-            credits = lines.aggregate(Sum('credit_amount'))['credit_amount__sum'] or 0
-            
-            # Calculate Balance based on Normal Balance
-            if acc.normal_balance == 'Debit':
-                bal = debits - credits
-            else:
-                bal = credits - debits
-            
-            # Only include non-zero accounts in the report
-            if bal != 0:
-                acc.calculated_balance = bal  # Attach temporary value to object
-                results.append(acc)
-                total += bal
-        
-        return results, total
-
-    # 4. Get Data
-    assets, total_assets = get_historical_balances(ASSET_TYPES)
-    liabilities, total_liabilities = get_historical_balances(LIABILITY_TYPES)
-    equity, total_equity = get_historical_balances(EQUITY_TYPES)
-
-    # 5. Calculate Net Income (Retained Earnings) for the period (Revenue - Expenses)
-    # This ensures Assets = Liabilities + Equity + Net Income
-    rev_types = ['Revenue', 'Income', 'Other Income', 'Sales']
-    exp_types = ['Expense', 'Expenses', 'Cost of Goods Sold', 'Other Expense', 'Depreciation']
-    
-    # Revenue (Credits - Debits)
-    rev_lines = JournalVoucherLine.objects.filter(company=company, account__account_type__in=rev_types, journal_voucher__jv_date__lte=target_date, journal_voucher__status='Posted')
-    rev_total = (rev_lines.aggregate(Sum('credit_amount'))['credit_amount__sum'] or 0) - (rev_lines.aggregate(Sum('debit_amount'))['debit_amount__sum'] or 0)
-
-    # Expenses (Debits - Credits)
-    exp_lines = JournalVoucherLine.objects.filter(company=company, account__account_type__in=exp_types, journal_voucher__jv_date__lte=target_date, journal_voucher__status='Posted')
-    exp_total = (exp_lines.aggregate(Sum('debit_amount'))['debit_amount__sum'] or 0) - (exp_lines.aggregate(Sum('credit_amount'))['credit_amount__sum'] or 0)
-
-    current_net_income = rev_total - exp_total
-    
-    # Add Net Income to Total Equity for balancing
-    total_equity_and_income = total_equity + current_net_income
-
-    return render(request, 'accounting/balance_sheet.html', {
-        'assets': assets,
-        'liabilities': liabilities,
-        'equity': equity,
-        'total_assets': total_assets,
-        'total_liabilities': total_liabilities,
-        'total_equity': total_equity,
-        'total_equity_and_income': total_equity_and_income,
-        'current_net_income': current_net_income,
+    # 2. Assets, Liabilities, Equity and Net Income to date
+    context = report_cache.cached_report(company, 'balance_sheet', statements.balance_sheet, target_date)
+    context.update({
         'target_date': target_date, # Date object for display
         'target_date_str': target_date_str, # String for input field
     })
+    return render(request, 'accounting/balance_sheet.html', context)
 
 def ar_aging(request):
     # Placeholder for AR Aging
@@ -1834,7 +1579,7 @@ def sales_by_customer(request):
 
 @login_required
 def custom_report(request):
-    company = get_company(request)
+    company = request.company
     
     # --- 1. POPULATE DROPDOWNS (Always run this) ---
     all_accounts = Account.objects.filter(company=company).order_by('account_number')
@@ -1871,74 +1616,11 @@ def custom_report(request):
             context['selected_types'] = selected_types
             context['selected_accounts'] = selected_acc_ids
 
-            # --- 3. FILTER ACCOUNTS ---
-            accounts = all_accounts
-            
-            # If user selected specific accounts, prioritize those
-            if selected_acc_ids:
-                accounts = accounts.filter(id__in=selected_acc_ids)
-            # Otherwise, check if they filtered by type
-            elif selected_types:
-                accounts = accounts.filter(account_type__in=selected_types)
+            # --- 3. FILTER ACCOUNTS (specific accounts win over types) ---
+            accounts = exports.report_accounts(company, selected_acc_ids, selected_types)
             
             # --- 4. BUILD REPORT DATA ---
-            report_data = []
-            
-            for acc in accounts:
-                # Get lines within date range
-                lines = JournalVoucherLine.objects.filter(
-                    account=acc,
-                    journal_voucher__jv_date__range=[start_date, end_date],
-                    journal_voucher__status='Posted'
-                ).select_related('journal_voucher').order_by('journal_voucher__jv_date')
-
-                if not lines.exists() and acc.current_balance == 0:
-                    continue  # Skip empty accounts to keep report clean
-
-                # Calculate Starting Balance (Sum of all moves BEFORE start_date)
-                past_lines = JournalVoucherLine.objects.filter(
-                    account=acc,
-                    journal_voucher__jv_date__lt=start_date,
-                    journal_voucher__status='Posted'
-                )
-                
-                start_debit = past_lines.aggregate(Sum('debit_amount'))['debit_amount__sum'] or 0
-                start_credit = past_lines.aggregate(Sum('credit_amount'))['credit_amount__sum'] or 0
-                
-                if acc.normal_balance == 'Debit':
-                    starting_bal = start_debit - start_credit
-                else:
-                    starting_bal = start_credit - start_debit
-
-                # Process current lines
-                processed_lines = []
-                running_bal = starting_bal
-                
-                for line in lines:
-                    debit = line.debit_amount
-                    credit = line.credit_amount
-                    
-                    if acc.normal_balance == 'Debit':
-                        running_bal += (debit - credit)
-                    else:
-                        running_bal += (credit - debit)
-                        
-                    processed_lines.append({
-                        'date': line.journal_voucher.jv_date,
-                        'ref': line.journal_voucher.jv_number,
-                        'desc': line.line_description or line.journal_voucher.description,
-                        'debit': debit,
-                        'credit': credit,
-                        'balance': running_bal,
-                        'id': line.journal_voucher.id 
-                    })
-
-                report_data.append({
-                    'account': acc,
-                    'starting_balance': starting_bal,
-                    'lines': processed_lines,
-                    'ending_balance': running_bal
-                })
+            report_data = statements.account_activity(company, accounts, start_date, end_date)
 
             context['report_data'] = report_data
 
@@ -1966,12 +1648,12 @@ def predict_expense_account(request):
 
 @login_required
 def bank_account_list(request):
-    company = get_company(request)
+    company = request.company
     return render(request, 'accounting/bank_account_list.html', {'bank_accounts': BankAccount.objects.filter(company=company)})
 
 @login_required
 def add_bank_account(request):
-    company = get_company(request)
+    company = request.company
     
     if request.method == 'POST':
         BankAccount.objects.create(
@@ -1995,7 +1677,7 @@ def add_bank_account(request):
 
 @login_required
 def delete_bank_account(request, bank_id):
-    company = get_company(request)
+    company = request.company
     if request.method == 'POST':
         BankAccount.objects.get(pk=bank_id, company=company).delete()
         messages.success(request, "Bank account deleted.")
@@ -2003,130 +1685,148 @@ def delete_bank_account(request, bank_id):
 
 @login_required
 def upload_bank_statement(request, bank_id):
-    company = get_company(request)
+    company = request.company
     # Ensure the bank account belongs to this company
     bank = BankAccount.objects.get(pk=bank_id, company=company)
     
     if request.method == 'POST':
-        csv_file = request.FILES['csv_file']
+        statement_file = request.FILES['csv_file']
         
         # Check file type
-        if not csv_file.name.endswith('.csv'):
-            messages.error(request, "Not a CSV file.")
+        parser = importers.statement_parser(statement_file.name, statement_file.file)
+        if parser is None:
+            messages.error(request, "Unsupported file type. Upload a CSV, OFX/QFX, QIF or camt.053 XML statement.")
             return redirect('upload_bank_statement', bank_id=bank_id)
 
-        try:
-            decoded_file = csv_file.read().decode('utf-8-sig').splitlines()
-            reader = csv.reader(decoded_file)
-            next(reader, None) # Skip Header
-
-            count = 0
-            for row in reader:
-                if len(row) < 3: continue
-
-                date_str = row[0].strip()
-                description = row[1].strip()
-                amount_str = row[2].strip()
-
-                # 1. Clean Amount
-                clean_amount = amount_str.replace('$', '').replace(',', '').replace(' ', '')
-                if '(' in clean_amount and ')' in clean_amount:
-                    clean_amount = '-' + clean_amount.replace('(', '').replace(')', '')
-                
-                if not clean_amount: continue
-
-                # 2. Parse Date
-                formatted_date = None
-                for fmt in ['%m/%d/%Y', '%Y-%m-%d', '%d/%m/%Y', '%m-%d-%Y']:
-                    try:
-                        formatted_date = datetime.strptime(date_str, fmt).date()
-                        break
-                    except ValueError:
-                        continue
-                
-                if formatted_date:
-                    # 3. Create Record with COMPANY LINK
-                    BankStatementLine.objects.create(
-                        company=company,  # <--- THIS IS THE CRITICAL FIX
-                        bank_account=bank,
-                        date=formatted_date,
-                        description=description,
-                        amount=decimal.Decimal(clean_amount)
-                    )
-                    count += 1
-            
-            messages.success(request, f"Successfully uploaded {count} lines.")
-            return redirect('reconcile_bank', bank_id=bank_id)
-
-        except Exception as e:
-            # If there is still an error, it will show up here
-            messages.error(request, f"Critical Error: {e}")
+        result = importers.import_statement_lines(bank, parser(statement_file.file))
+        messages.success(request, f"Imported {result['inserted']} lines, skipped {result['skipped']} already imported.")
+        if result['error_count']:
+            rows = ', '.join(str(row) for row, _ in result['errors'][:20])
+            messages.warning(request, f"{result['error_count']} row(s) could not be read (rows {rows}{'...' if result['error_count'] > 20 else ''}): {result['errors'][0][1]}")
+        return redirect('reconcile_bank', bank_id=bank_id)
         
     return render(request, 'accounting/upload_bank_statement.html', {'bank_account': bank})
 
 @login_required
 def reconcile_bank(request, bank_id):
-    company = get_company(request)
-    bank_account = BankAccount.objects.get(pk=bank_id, company=company)
-    
-    start_date = request.GET.get('start_date')
-    end_date = request.GET.get('end_date')
-
-    # Left Side: Bank Lines
-    bank_lines = BankStatementLine.objects.filter(
-        bank_account=bank_account, 
-        matched_journal_line__isnull=True
-    ).order_by('date')
-
-    # Right Side: GL Transactions
-    system_lines = JournalVoucherLine.objects.filter(
-        account=bank_account.gl_account,
-        reconciliation_match__isnull=True 
-    ).order_by('journal_voucher__jv_date')
-
-    if start_date and end_date:
-        bank_lines = bank_lines.filter(date__range=[start_date, end_date])
-        system_lines = system_lines.filter(journal_voucher__jv_date__range=[start_date, end_date])
-
-    # History
-    matched_lines = BankStatementLine.objects.filter(
-        bank_account=bank_account, 
-        matched_journal_line__isnull=False
-    ).order_by('-date')
-    
-    if start_date and end_date:
-        matched_lines = matched_lines.filter(date__range=[start_date, end_date])
-
+    """The workspace shell; the three line lists are loaded page by page from reconcile_lines_json."""
+    company = request.company
+    bank_account = get_object_or_404(BankAccount, pk=bank_id, company=company)
     context = {
         'bank_account': bank_account,
-        'bank_lines': bank_lines,
-        'system_lines': system_lines,
-        'matched_lines': matched_lines,
-        'start_date': start_date,
-        'end_date': end_date,
+        'groups': reconciliation.recent_groups(bank_account),
+        'start_date': request.GET.get('start_date', ''),
+        'end_date': request.GET.get('end_date', ''),
     }
     return render(request, 'accounting/reconcile_bank.html', context)
 
+@login_required
+def reconcile_lines_json(request, bank_id, side):
+    """
+    One keyset page of open bank lines ('bank'), open posted GL lines ('gl')
+    or the matched history ('matched'), plus the account's running totals.
+    """
+    company = request.company
+    bank_account = get_object_or_404(BankAccount, pk=bank_id, company=company)
+    if side not in reconciliation.PAGES:
+        return JsonResponse({'error': 'Unknown list'}, status=404)
+    rows, next_cursor = reconciliation.PAGES[side](
+        bank_account, after=ledger.parse_cursor(request.GET.get('after')),
+        start=request.GET.get('start_date') or None, end=request.GET.get('end_date') or None)
+    if side == 'gl':
+        lines = [{
+            'id': r['id'], 'date': r['posting_date'].isoformat(), 'jv_id': r['journal_voucher_id'], 'jv_number': r['jv_number'],
+            'description': r['line_description'] or r['description'], 'amount': f"{r['debit_amount'] - r['credit_amount']:.2f}",
+        } for r in rows]
+    else:
+        lines = [{
+            'id': r['id'], 'date': r['date'].isoformat(), 'description': r['description'], 'amount': f"{r['amount']:.2f}",
+            **({'jv_number': r['jv_number']} if side == 'matched' else {}),
+        } for r in rows]
+    return JsonResponse({
+        'lines': lines,
+        'next_cursor': next_cursor,
+        'totals': {
+            'statement_balance': f"{bank_account.statement_balance:.2f}",
+            'cleared_balance': f"{bank_account.cleared_balance:.2f}",
+            'difference': f"{bank_account.unreconciled_amount:.2f}",
+        },
+    })
+
+@login_required
+def auto_match_bank(request, bank_id):
+    """GET previews the automatic matches and groups; POST saves them."""
+    company = request.company
+    bank_account = get_object_or_404(BankAccount, pk=bank_id, company=company)
+    try:
+        window_days = max(0, int(request.POST.get('window_days') or request.GET.get('window_days') or reconciliation.DEFAULT_WINDOW_DAYS))
+    except ValueError:
+        window_days = reconciliation.DEFAULT_WINDOW_DAYS
+
+    if request.method == 'POST':
+        matches, groups = reconciliation.auto_reconcile(bank_account, window_days, user=request.user)
+        messages.success(request, f"Auto-matched {len(matches)} transactions and {len(groups)} groups.")
+        return redirect('reconcile_bank', bank_id=bank_id)
+
+    matches, groups = reconciliation.auto_reconcile(bank_account, window_days, preview=True)
+    return render(request, 'accounting/auto_match_preview.html', {
+        'bank_account': bank_account, 'window_days': window_days,
+        'match_count': len(matches), 'matches': matches[:reconciliation.PREVIEW_ROWS],
+        'group_count': len(groups), 'groups': groups[:reconciliation.PREVIEW_ROWS],
+    })
+
+@login_required
+def match_group(request, bank_id):
+    """Reconcile the bank lines and GL lines ticked on the reconciliation page as one group."""
+    company = request.company
+    bank_account = get_object_or_404(BankAccount, pk=bank_id, company=company)
+    if request.method == 'POST':
+        try:
+            group = reconciliation.create_group(
+                bank_account,
+                [int(i) for i in request.POST.getlist('statement_ids')],
+                [int(i) for i in request.POST.getlist('journal_line_ids')],
+                user=request.user,
+            )
+            messages.success(request, f"Grouped {group.statement_lines.count()} bank lines with {group.journal_lines.count()} GL lines.")
+        except ValueError as e:
+            messages.error(request, str(e))
+    return redirect('reconcile_bank', bank_id=bank_id)
+
+@login_required
+@require_POST
+def unmatch_group(request, group_id):
+    group = get_object_or_404(ReconciliationGroup, pk=group_id, company=request.company)
+    reconciliation.dissolve_group(group)
+    return redirect('reconcile_bank', bank_id=group.bank_account_id)
+
 @login_required
 def match_transaction(request, statement_id, jv_line_id):
-    b_line = BankStatementLine.objects.get(pk=statement_id)
-    s_line = JournalVoucherLine.objects.get(pk=jv_line_id)
-    
-    # Calculate Net GL Amount
-    sys_amt = s_line.debit_amount - s_line.credit_amount
-    
-    if b_line.amount == sys_amt:
-        b_line.matched_journal_line = s_line
-        b_line.save()
+    b_line = get_object_or_404(BankStatementLine, pk=statement_id, company=request.company)
+    try:
+        reconciliation.match_pair(b_line.bank_account, statement_id, jv_line_id)
         messages.success(request, "Transaction Matched.")
-    else:
-        messages.error(request, f"Mismatch: Bank {b_line.amount} vs GL {sys_amt}")
-        
-    return redirect('reconcile_bank', bank_id=b_line.bank_account.id)
+    except ValueError as e:
+        messages.error(request, str(e))
+    return redirect('reconcile_bank', bank_id=b_line.bank_account_id)
 
 @login_required
 def unmatch_transaction(request, statement_id):
-    b_line = BankStatementLine.objects.get(pk=statement_id)
-    b_line.matched_journal_line = None
-    b_line.save()
-    return redirect('reconcile_bank', bank_id=b_line.bank_account.id)
\ No newline at end of file
+    b_line = get_object_or_404(BankStatementLine, pk=statement_id, company=request.company)
+    reconciliation.unmatch_pair(b_line.bank_account, statement_id)
+    return redirect('reconcile_bank', bank_id=b_line.bank_account_id)
+
+# --- METRICS ---
+def prometheus_metrics(request):
+    """
+    Request histograms for Prometheus. Closed by default: open to staff users,
+    and to scrapers sending "Authorization: Bearer <settings.METRICS_TOKEN>"
+    when a token is configured. Anyone else gets a 404 without a token
+    configured and a 403 with one.
+    """
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    if not request.user.is_staff and not (token and request.headers.get('Authorization') == f"Bearer {token}"):
+        if not token:
+            raise Http404
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.exposition(), content_type=metrics.CONTENT_TYPE)